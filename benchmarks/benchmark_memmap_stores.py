@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compare the raw .mmap format with the chunked, compressed Zarr store created by
+caiman.mmapping.memmap_to_zarr: size on disk, time to read the pixels of CNMF
+patches (pixel-major access), time to read blocks of frames (frame-major
+access) and time of parallel_dot_product.
+
+Usage: python benchmark_memmap_stores.py [d1 d2 T]
+Requires the zarr package.
+"""
+
+import numpy as np
+import os
+import sys
+import tempfile
+import time
+
+import caiman as cm
+from caiman import mmapping
+from caiman.cluster import extract_patch_coordinates
+
+
+def directory_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def timeit(fun, *args, repeats=3):
+    times = []
+    for _ in range(repeats):
+        t0 = time.time()
+        fun(*args)
+        times.append(time.time() - t0)
+    return np.min(times)
+
+
+def main():
+    d1, d2, T = [int(x) for x in sys.argv[1:4]] if len(sys.argv) > 3 else (512, 512, 2000)
+    dims = (d1, d2)
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, cm.paths.memmap_frames_filename('bench', dims, T, 'C'))
+    # smooth, noisy, integer-valued data resembling raw imaging data
+    rng = np.random.RandomState(0)
+    Yr = np.memmap(fname, mode='w+', dtype=np.float32, shape=(d1 * d2, T), order='C')
+    background = 100 + 50 * rng.rand(d1 * d2, 1)
+    for t0 in range(0, T, 500):
+        n = min(500, T - t0)
+        Yr[:, t0:t0 + n] = np.round(background + 5 * rng.randn(d1 * d2, n))
+    Yr.flush()
+    del Yr
+
+    t0 = time.time()
+    fname_zarr = mmapping.memmap_to_zarr(fname)
+    print(f'conversion: {time.time() - t0:.2f}s')
+
+    idx_flat, _ = extract_patch_coordinates(dims, (24, 24), (6, 6))
+    b = rng.rand(T, 10).astype(np.float32)
+    for name, fn in (('mmap', fname), ('zarr', fname_zarr)):
+        Y, _, _ = mmapping.load_memmap(fn)
+        size = directory_size(fn) / 2**20
+        t_patch = timeit(lambda: [np.array(Y[idx]) for idx in idx_flat[:20]])
+        t_frames = timeit(lambda: np.array(Y[:, :500]))
+        t_dot = timeit(mmapping.parallel_dot_product, Y, b)
+        print(f'{name}: {size:.0f} MB, 20 patches {t_patch:.2f}s, 500 frames {t_frames:.2f}s, '
+              f'dot product {t_dot:.2f}s')
+
+
+if __name__ == "__main__":
+    main()
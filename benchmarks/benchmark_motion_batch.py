@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compare frame by frame registration (tile_and_correct) with the vectorized
+batch registration (tile_and_correct_batch) used by MotionCorrect when
+fft_batch_size is set, for rigid and piecewise rigid motion correction, and
+report the largest difference between the shifts of the two paths.
+
+Usage: python benchmark_motion_batch.py [d1 d2 T]
+"""
+
+import numpy as np
+import sys
+import time
+from scipy.ndimage import gaussian_filter, shift as nd_shift
+
+from caiman.motion_correction import tile_and_correct, tile_and_correct_batch
+
+
+def main():
+    d1, d2, T = [int(x) for x in sys.argv[1:4]] if len(sys.argv) > 3 else (512, 512, 80)
+    rng = np.random.RandomState(0)
+    template = 100 * gaussian_filter(rng.rand(d1, d2), 2)
+    imgs = np.array([nd_shift(template, 2 * rng.randn(2)) + rng.rand(d1, d2)
+                     for _ in range(T)], dtype=np.float32)
+    for max_deviation_rigid in (0, 3):
+        kwargs = dict(max_deviation_rigid=max_deviation_rigid, shifts_opencv=True,
+                      add_to_movie=0, border_nan='copy')
+        t0 = time.time()
+        res = [tile_and_correct(img, template, (48, 48), (24, 24), (6, 6), **kwargs) for img in imgs]
+        t_frame = time.time() - t0
+        t0 = time.time()
+        res_batch = tile_and_correct_batch(imgs, template, (48, 48), (24, 24), (6, 6), **kwargs)
+        t_batch = time.time() - t0
+        err = np.max([np.max(np.abs(np.subtract(r[1], rb[1]))) for r, rb in zip(res, res_batch)])
+        print(f'{"pw-rigid" if max_deviation_rigid else "rigid"}: per frame {t_frame:.2f}s, '
+              f'batch {t_batch:.2f}s, speedup {t_frame / t_batch:.1f}x, max shift difference {err:.2e}')
+
+
+if __name__ == "__main__":
+    main()
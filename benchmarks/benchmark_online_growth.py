@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Time the storage updates done by OnACID when components are added one at a
+time: appending a column to the sparse footprints Ab and a row and column to
+the dense sufficient statistic AtA. The growable buffers used by csc_append
+and grow_square are compared with reallocating and copying the arrays at every
+addition.
+
+Usage: python benchmark_online_growth.py [num_added num_pixels pixels_per_component]
+"""
+
+import numpy as np
+import sys
+import time
+from scipy.sparse import csc_matrix
+
+from caiman.source_extraction.cnmf.online_cnmf import csc_append, grow_square
+
+
+def append_copy(a, b):
+    a.data = np.concatenate((a.data, b.data))
+    a.indices = np.concatenate((a.indices, b.indices))
+    a.indptr = np.concatenate((a.indptr, (b.indptr + a.nnz)[1:]))
+    a._shape = (a.shape[0], a.shape[1] + b.shape[1])
+
+
+def grow_copy(A, n_new, dtype=None):
+    A_ = np.zeros((A.shape[0] + n_new,) * 2, dtype=A.dtype)
+    A_[:A.shape[0], :A.shape[0]] = A
+    return A_
+
+
+def main():
+    K, d, s = [int(x) for x in sys.argv[1:4]] if len(sys.argv) > 3 else (10000, 512 * 512, 150)
+    rng = np.random.RandomState(0)
+    cols = [csc_matrix((rng.rand(s).astype(np.float32), (np.sort(rng.choice(d, s, replace=False)),
+                        np.zeros(s, dtype=int))), (d, 1)) for _ in range(K)]
+    for name, append, grow in (('copy', append_copy, grow_copy),
+                               ('growable', csc_append, grow_square)):
+        Ab = csc_matrix((d, 0), dtype=np.float32)
+        t0 = time.time()
+        for col in cols:
+            append(Ab, col)
+        t_Ab = time.time() - t0
+        AtA = np.zeros((0, 0), dtype=np.float32)
+        t0 = time.time()
+        for m in range(K):
+            AtA = grow(AtA, 1, np.float32)
+            AtA[:, m] = AtA[m] = 1.
+        t_AtA = time.time() - t0
+        print(f'{name}: {K} additions, Ab {t_Ab:.2f}s, AtA {t_AtA:.2f}s')
+
+
+if __name__ == "__main__":
+    main()
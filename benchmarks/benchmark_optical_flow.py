@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compare piecewise rigid registration (tile_and_correct) with dense optical
+flow registration (tile_and_correct_flow), used by MotionCorrect when
+nonrigid_engine='optical_flow', on frames deformed by a smooth nonrigid
+displacement field. Reports the time per frame and the mean absolute
+difference between the corrected frames and the template.
+
+Usage: python benchmark_optical_flow.py [d1 d2 T]
+"""
+
+import cv2
+import numpy as np
+import sys
+import time
+from scipy.ndimage import gaussian_filter
+
+from caiman.motion_correction import tile_and_correct, tile_and_correct_flow
+
+
+def main():
+    d1, d2, T = [int(x) for x in sys.argv[1:4]] if len(sys.argv) > 3 else (512, 512, 40)
+    rng = np.random.RandomState(0)
+    template = (100 * gaussian_filter(rng.rand(d1, d2), 3)).astype(np.float32)
+    y_grid, x_grid = np.mgrid[:d1, :d2].astype(np.float32)
+    imgs = []
+    for _ in range(T):
+        phase = rng.rand(4) * 2 * np.pi
+        flow_x = 3 * rng.randn() + 2 * np.sin(y_grid / d1 * 2 * np.pi + phase[0]) * np.cos(x_grid / d2 * np.pi + phase[1])
+        flow_y = 3 * rng.randn() + 2 * np.cos(x_grid / d2 * 2 * np.pi + phase[2]) * np.sin(y_grid / d1 * np.pi + phase[3])
+        img = cv2.remap(template, x_grid - flow_x.astype(np.float32), y_grid - flow_y.astype(np.float32),
+                        cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+        imgs.append(img + rng.rand(d1, d2).astype(np.float32))
+    interior = (slice(16, -16), slice(16, -16))
+
+    def report(name, correct):
+        t0 = time.time()
+        res = [correct(img) for img in imgs]
+        t_frame = (time.time() - t0) / T
+        err = np.mean([np.nanmean(np.abs(r - template)[interior]) for r in res])
+        print(f'{name}: {1000 * t_frame:.1f}ms per frame, mean absolute error {err:.3f}')
+
+    print(f'uncorrected: mean absolute error {np.mean([np.abs(img - template)[interior].mean() for img in imgs]):.3f}')
+    for strides, upsample_factor_grid in (((96, 96), 4), ((48, 48), 4), ((24, 24), 2)):
+        report(f'pw-rigid, strides {strides}', lambda img: tile_and_correct(
+            img, template, strides, (24, 24), (8, 8), upsample_factor_grid=upsample_factor_grid,
+            max_deviation_rigid=4, shifts_opencv=False, border_nan='copy')[0])
+    for downsample in (1, 2, 4):
+        report(f'optical flow, downsample {downsample}', lambda img: tile_and_correct_flow(
+            img, template, (96, 96), (24, 24), (8, 8), border_nan='copy', downsample=downsample)[0])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compare full resolution rigid registration (register_translation) with the
+coarse to fine registration (register_translation_pyramid) used by
+MotionCorrect when pyramid_levels is set, on large frames with large shifts,
+and report the time per frame and the error of the shifts of both paths.
+
+Usage: python benchmark_pyramid_registration.py [d max_shift T]
+"""
+
+import numpy as np
+import sys
+import time
+from scipy.ndimage import gaussian_filter, shift as nd_shift
+
+from caiman.motion_correction import register_translation, register_translation_pyramid
+
+
+def main():
+    d, max_shift, T = [int(x) for x in sys.argv[1:4]] if len(sys.argv) > 3 else (1024, 50, 20)
+    rng = np.random.RandomState(0)
+    margin = max_shift + 2
+    img = 100 * gaussian_filter(rng.rand(d + 2 * margin, d + 2 * margin), 2)
+    template = img[margin:-margin, margin:-margin]
+    true_shifts = rng.uniform(-max_shift + 1, max_shift - 1, (T, 2))
+    frames = np.array([nd_shift(img, sh)[margin:-margin, margin:-margin] + rng.rand(d, d)
+                       for sh in true_shifts])
+    t0 = time.time()
+    shifts = np.array([register_translation(frame, template, upsample_factor=10,
+                                            max_shifts=(max_shift, max_shift))[0] for frame in frames])
+    t_full = (time.time() - t0) / T
+    print(f'full resolution: {1000 * t_full:.1f}ms per frame, '
+          f'max shift error {np.max(np.abs(shifts - true_shifts)):.3f}')
+    for levels in (1, 2, 3):
+        t0 = time.time()
+        shifts = np.array([register_translation_pyramid(frame, template, upsample_factor=10,
+                                                        max_shifts=(max_shift, max_shift), levels=levels)[0]
+                           for frame in frames])
+        t_pyr = (time.time() - t0) / T
+        print(f'pyramid, {levels} levels: {1000 * t_pyr:.1f}ms per frame, speedup {t_full / t_pyr:.1f}x, '
+              f'max shift error {np.max(np.abs(shifts - true_shifts)):.3f}')
+
+
+if __name__ == "__main__":
+    main()
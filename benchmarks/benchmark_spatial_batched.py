@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compare the per pixel LassoLars regression of update_spatial_components
+(method_ls='lasso_lars') with the batched solver that fits together the pixels
+searching the same components (method_ls='lasso_batched'), and report the
+largest difference between the spatial weights of the two methods.
+
+Usage: python benchmark_spatial_batched.py [num_pixels num_components T]
+"""
+
+import numpy as np
+import sys
+import time
+
+from caiman.source_extraction.cnmf.spatial import regression_ipyparallel
+
+
+def main():
+    d, K, T = [int(x) for x in sys.argv[1:4]] if len(sys.argv) > 3 else (20000, 200, 1000)
+    rng = np.random.RandomState(0)
+    C = np.vstack([np.maximum(rng.randn(K, T), 0), np.ones((1, T))])
+    cct = np.diag(C[:K].dot(C[:K].T))
+    # neighbouring pixels search the same few components, as in determine_search_location
+    comps_block = [np.append(np.sort(rng.choice(K, 3, replace=False)), K) for _ in range(d // 64 + 1)]
+    idxs_C = [comps_block[px // 64] for px in range(d)]
+    Y = np.array([rng.rand(len(idx)).dot(C[idx]) + .1 * rng.randn(T) for idx in idxs_C], dtype=np.float32)
+    sn = np.full(d, .1)
+    res = {}
+    for method in ('lasso_lars', 'lasso_batched'):
+        t0 = time.time()
+        res[method] = {px: a for px, _, a in
+                       regression_ipyparallel([Y, C, sn, idxs_C, list(range(d)), method, cct])}
+        print(f'{method}: {time.time() - t0:.2f}s')
+    err = max(np.max(np.abs(res['lasso_lars'][px] - a)) for px, a in res['lasso_batched'].items())
+    print(f'max weight difference {err:.2e}')
+
+
+if __name__ == "__main__":
+    main()
@@ -13,12 +13,16 @@ Alongside each array x we ensure the value x.dtype which stores the data type.
 # \copyright GNU General Public License v2.0
 # \date Created on Thu Oct 20 12:07:09 2016
 
+import abc
+import collections
+import concurrent.futures
 import glob
 import ipyparallel
 from ipyparallel import Client
 import logging
 import multiprocessing
 from multiprocessing import Pool
+import multiprocessing.pool
 import numpy as np
 import os
 import platform
@@ -28,7 +32,7 @@ import shutil
 import subprocess
 import sys
 import time
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 from .mmapping import load_memmap
 
@@ -167,8 +171,7 @@ def apply_to_patch(mmap_file, shape: Tuple[Any, Any, Any], dview, rf, stride, fu
     logger.debug("Flat index is of length " + str(len(idx_flat)))
     if dview is not None:
         try:
-            file_res = dview.map_sync(function_place_holder, args_in)
-            dview.results.clear()
+            file_res = get_executor(dview).map(function_place_holder, args_in)
 
         except:
             raise Exception('Something went wrong')
@@ -280,8 +283,10 @@ def stop_server(ipcluster: str = 'ipcluster', pdir: str = None, profile: str = N
         dview: Undocumented
 
     """
-    if 'multiprocessing' in str(type(dview)):
+    if isinstance(dview, multiprocessing.pool.Pool):
         dview.terminate()
+    elif isinstance(dview, concurrent.futures.Executor):
+        dview.shutdown()
     else:
         logger.info("Stopping cluster...")
         try:
@@ -342,6 +347,326 @@ def stop_server(ipcluster: str = 'ipcluster', pdir: str = None, profile: str = N
 
     logger.info("stop_cluster(): done")
 
+def attach_shared_memory(name: str):
+    """
+    Attach to an existing multiprocessing.shared_memory block without taking
+    ownership of it.
+
+    Before python 3.13 attaching registers the block with the resource tracker
+    of the attaching process, which then unlinks (or warns about) it when the
+    process exits, even though the block belongs to the process that created it.
+
+    Args:
+        name: str
+            name of the shared memory block
+
+    Returns:
+        shm: multiprocessing.shared_memory.SharedMemory
+    """
+    from multiprocessing import resource_tracker, shared_memory
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args, **kwargs: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+# shared memory blocks attached by this process, see SharedArray.get
+_attached_blocks: collections.OrderedDict = collections.OrderedDict()
+_max_attached_blocks = 32
+
+
+class SharedArray(object):
+    """
+    Picklable handle to an array published in shared memory by
+    SharedMemoryPool.publish. Only the name of the block, the shape and the
+    dtype are pickled; get() attaches to the block (once per process) and
+    returns an array backed by it, without copying.
+    """
+
+    def __init__(self, name: str, shape: Tuple, dtype, order: str = 'C'):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.order = order
+
+    def get(self) -> np.ndarray:
+        """ array backed by the shared memory block. Do not write to it unless
+        the caller owns the corresponding part of the data
+        """
+        shm = _attached_blocks.get(self.name)
+        if shm is None:
+            shm = attach_shared_memory(self.name)
+            _attached_blocks[self.name] = shm
+            _close_attached_blocks()
+        else:
+            _attached_blocks.move_to_end(self.name)
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf, order=self.order)
+
+    def __repr__(self):
+        return f'SharedArray(name={self.name}, shape={self.shape}, dtype={self.dtype})'
+
+
+def _close_attached_blocks() -> None:
+    """ detach from the least recently used blocks once too many are attached.
+    Blocks still referenced by arrays cannot be closed yet and are retried later
+    """
+    for name in list(_attached_blocks)[:-_max_attached_blocks]:
+        try:
+            _attached_blocks[name].close()
+            del _attached_blocks[name]
+        except BufferError:
+            pass
+
+
+def resolve_shared(obj):
+    """ return the array behind a SharedArray handle, or obj itself otherwise
+    """
+    if isinstance(obj, SharedArray):
+        return obj.get()
+    return obj
+
+
+class SharedMemoryPool(multiprocessing.pool.Pool):
+    """
+    multiprocessing Pool that owns an arena of shared memory blocks. Large
+    arrays that every task needs can be published once with publish(); the
+    returned SharedArray handle is sent to the workers instead of the data,
+    and workers attach to the block without copying. It can be used wherever
+    a Pool is accepted as dview.
+
+    Blocks are released with release(), or all at once when the pool is
+    terminated or joined.
+    """
+
+    def __init__(self, processes: int = None, maxtasksperchild: int = None, **kwargs):
+        self._blocks: Dict = {}
+        super().__init__(processes, maxtasksperchild=maxtasksperchild, **kwargs)
+
+    def publish(self, arr: np.ndarray, dtype=None) -> SharedArray:
+        """ copy an array into a new shared memory block
+
+        Args:
+            arr: np.ndarray
+                array to publish
+
+            dtype:
+                data type of the published array (default: that of arr)
+
+        Returns:
+            handle: SharedArray
+        """
+        from multiprocessing import shared_memory
+        arr = np.asarray(arr, dtype=dtype)
+        order = 'F' if arr.flags['F_CONTIGUOUS'] and not arr.flags['C_CONTIGUOUS'] else 'C'
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf, order=order)
+        shared[...] = arr
+        del shared
+        self._blocks[shm.name] = shm
+        return SharedArray(shm.name, arr.shape, arr.dtype, order)
+
+    def release(self, handle: SharedArray) -> None:
+        """ free the block behind a handle returned by publish """
+        shm = self._blocks.pop(handle.name, None)
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+    def release_all(self) -> None:
+        """ free all the blocks published by this pool """
+        while self._blocks:
+            _, shm = self._blocks.popitem()
+            shm.close()
+            shm.unlink()
+
+    def terminate(self):
+        super().terminate()
+        self.release_all()
+
+    def join(self):
+        super().join()
+        self.release_all()
+
+
+class Executor(abc.ABC):
+    """
+    Common interface to the parallel engines accepted as dview: None (serial),
+    a multiprocessing Pool, an ipyparallel view or a concurrent.futures
+    executor. Use get_executor(dview) to obtain one instead of testing the
+    type of dview at every call site.
+
+    Attributes:
+        local_processes: bool
+            True if the tasks run in other processes on this machine, so that
+            large arrays can be handed over through shared memory
+
+        num_workers: int
+            number of tasks the engine runs at the same time
+    """
+    local_processes = False
+    num_workers = 1
+
+    @abc.abstractmethod
+    def map(self, fn: Callable, iterable: Iterable, chunksize: int = None) -> List:
+        """ apply fn to every element of iterable and return the results in order
+
+        Args:
+            fn: callable
+                function to apply, must be picklable for process based engines
+
+            iterable:
+                arguments, one per task
+
+            chunksize: int
+                number of tasks sent to a worker at once (default: engine default)
+
+        Returns:
+            results: list
+        """
+
+    @abc.abstractmethod
+    def imap_unordered(self, fn: Callable, iterable: Iterable, chunksize: int = 1) -> Iterator:
+        """ like map, but yield the results as soon as they are available, in
+        completion order. The caller can then consume each result while the
+        others are still being computed, instead of holding all of them at once
+        """
+
+    def clear(self) -> None:
+        """ free the memory held on the workers between runs (no-op by default) """
+        pass
+
+
+class SerialExecutor(Executor):
+    """ runs the tasks in the calling process (dview=None) """
+
+    def map(self, fn, iterable, chunksize=None):
+        return list(map(fn, iterable))
+
+    def imap_unordered(self, fn, iterable, chunksize=1):
+        return map(fn, iterable)
+
+
+class PoolExecutor(Executor):
+    """ wraps a multiprocessing Pool (or a SharedMemoryPool) """
+
+    def __init__(self, pool: multiprocessing.pool.Pool):
+        self.pool = pool
+        self.local_processes = not isinstance(pool, multiprocessing.pool.ThreadPool)
+        self.num_workers = pool._processes
+
+    def map(self, fn, iterable, chunksize=None):
+        # get with a timeout so that the call can be interrupted with ctrl-c
+        return self.pool.map_async(fn, iterable, chunksize=chunksize).get(4294967)
+
+    def imap_unordered(self, fn, iterable, chunksize=1):
+        return self.pool.imap_unordered(fn, iterable, chunksize=chunksize or 1)
+
+
+class IpyparallelExecutor(Executor):
+    """ wraps an ipyparallel DirectView or LoadBalancedView. The results cached
+    by the client are cleared after every map. With echo_output=True, map
+    prints what the engines wrote to stdout and stderr
+    """
+
+    def __init__(self, view, echo_output: bool = False):
+        self.view = view
+        self.echo_output = echo_output
+        targets = view.client.ids if view.targets in (None, 'all') else view.targets
+        self.num_workers = len(targets) if isinstance(targets, (list, tuple, range)) else 1
+
+    def map(self, fn, iterable, chunksize=None):
+        kwargs = {}
+        if chunksize is not None and isinstance(self.view, ipyparallel.LoadBalancedView):
+            kwargs['chunksize'] = chunksize
+        try:
+            if not self.echo_output:
+                return list(self.view.map_sync(fn, list(iterable), **kwargs))
+            async_result = self.view.map(fn, list(iterable), block=False, **kwargs)
+            results = async_result.get()
+            for outp in async_result.stdout:
+                print(outp[:-1])
+                sys.stdout.flush()
+            for outp in async_result.stderr:
+                print(outp[:-1])
+                sys.stderr.flush()
+            return list(results)
+        finally:
+            self.view.results.clear()
+
+    def imap_unordered(self, fn, iterable, chunksize=1):
+        view = self.view
+        if not isinstance(view, ipyparallel.LoadBalancedView):
+            # a DirectView splits the tasks evenly between the engines upfront,
+            # a load balanced view on the same engines hands them out as they free up
+            view = view.client.load_balanced_view(targets=view.targets)
+        async_result = view.map(fn, list(iterable), block=False, ordered=False, chunksize=chunksize or 1)
+        try:
+            for res in async_result:
+                yield res
+        finally:
+            self.view.results.clear()
+
+    def clear(self):
+        self.view.clear()
+
+
+def _apply_to_chunk(fn: Callable, chunk: List) -> List:
+    return [fn(args) for args in chunk]
+
+
+class FuturesExecutor(Executor):
+    """ wraps a concurrent.futures ProcessPoolExecutor or ThreadPoolExecutor """
+
+    def __init__(self, executor: concurrent.futures.Executor):
+        self.executor = executor
+        self.local_processes = isinstance(executor, concurrent.futures.ProcessPoolExecutor)
+        self.num_workers = executor._max_workers
+
+    def map(self, fn, iterable, chunksize=None):
+        return list(self.executor.map(fn, iterable, chunksize=chunksize or 1))
+
+    def imap_unordered(self, fn, iterable, chunksize=1):
+        chunksize = chunksize or 1
+        iterable = list(iterable)
+        futures = [self.executor.submit(_apply_to_chunk, fn, iterable[i:i + chunksize])
+                   for i in range(0, len(iterable), chunksize)]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                for res in future.result():
+                    yield res
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def get_executor(dview) -> Executor:
+    """
+    Wrap a dview in the Executor interface
+
+    Args:
+        dview: None, Executor, multiprocessing Pool, concurrent.futures executor or ipyparallel view
+            parallel engine as returned by setup_cluster. An Executor is returned unchanged
+
+    Returns:
+        executor: Executor
+    """
+    if dview is None:
+        return SerialExecutor()
+    if isinstance(dview, Executor):
+        return dview
+    if isinstance(dview, multiprocessing.pool.Pool):
+        return PoolExecutor(dview)
+    if isinstance(dview, concurrent.futures.Executor):
+        return FuturesExecutor(dview)
+    if hasattr(dview, 'map_sync'):
+        return IpyparallelExecutor(dview)
+    raise Exception('Unsupported dview of type ' + str(type(dview)))
+
+
 def setup_cluster(backend: str = 'multiprocessing',
                   n_processes: int = None,
                   single_thread: bool = False,
@@ -351,9 +676,11 @@ def setup_cluster(backend: str = 'multiprocessing',
     Setup and/or restart a parallel cluster.
     Args:
         backend: str
-            'multiprocessing' [alias 'local'], 'ipyparallel', and 'SLURM'
+            'multiprocessing' [alias 'local'], 'shared_memory', 'ipyparallel', and 'SLURM'
             ipyparallel and SLURM backends try to restart if cluster running.
             backend='multiprocessing' raises an exception if a cluster is running.
+            backend='shared_memory' is a multiprocessing pool that can also publish
+            arrays to its workers through shared memory (see SharedMemoryPool).
         n_processes: int
             Sets number of processes to use. If None, is set automatically. 
         single_thread: bool
@@ -370,6 +697,7 @@ def setup_cluster(backend: str = 'multiprocessing',
         c: ipyparallel.Client object; only used for ipyparallel and SLURM backends, else None
         dview: multicore processing engine that is used for parallel processing. 
             If backend is 'multiprocessing' then dview is Pool object.
+            If backend is 'shared_memory' then dview is a SharedMemoryPool object.
             If backend is 'ipyparallel' then dview is a DirectView object. 
         n_processes: number of workers in dview. None means single core mode in use. 
     """
@@ -406,7 +734,7 @@ def setup_cluster(backend: str = 'multiprocessing',
             logger.info(f'Started ipyparallel cluster: Using {len(c)} processes')
             dview = c[:len(c)]
 
-        elif (backend == 'multiprocessing') or (backend == 'local'):
+        elif backend in ('multiprocessing', 'local', 'shared_memory'):
             if backend == 'local':
                 logger.info('The local backend is an alias for the multiprocessing backend, and the alias may be removed in some future version of Caiman')
             if len(multiprocessing.active_children()) > 0:
@@ -432,7 +760,10 @@ def setup_cluster(backend: str = 'multiprocessing',
                     pass
             c = None
 
-            dview = Pool(n_processes, maxtasksperchild=maxtasksperchild)
+            if backend == 'shared_memory':
+                dview = SharedMemoryPool(n_processes, maxtasksperchild=maxtasksperchild)
+            else:
+                dview = Pool(n_processes, maxtasksperchild=maxtasksperchild)
         else:
             raise Exception('Unknown Backend')
 
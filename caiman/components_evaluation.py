@@ -19,6 +19,7 @@ from scipy.stats import norm
 from typing import Any, List, Tuple, Union
 import warnings
 
+from caiman.cluster import get_executor
 from caiman.paths import caiman_datadir
 from .utils.stats import mode_robust, mode_robust_fast
 from .utils.utils import load_graph
@@ -799,14 +800,9 @@ def estimate_components_quality(traces,
                     thresh_C
                 ])
 
-            if dview is None:
-                res = map(evaluate_components_placeholder, params)
-            else:
+            if dview is not None:
                 logging.info('Component evaluation in parallel')
-                if 'multiprocessing' in str(type(dview)):
-                    res = dview.map_async(evaluate_components_placeholder, params).get(4294967)
-                else:
-                    res = dview.map_sync(evaluate_components_placeholder, params)
+            res = get_executor(dview).map(evaluate_components_placeholder, params)
 
             for r_ in res:
                 fitness_raw__, fitness_delta__, erfc_raw__, erfc_delta__, r_values__, _ = r_
@@ -2,12 +2,14 @@
 # -*- coding: utf-8 -*-
 
 import ipyparallel as parallel
-from itertools import chain
+from itertools import chain, islice
 import logging
 import numpy as np
 import os
 import pickle
+import queue
 import sys
+import threading
 import tifffile
 from typing import Any, Dict, List, Optional, Tuple, Union
 import pathlib
@@ -27,7 +29,8 @@ def load_memmap(filename: str, mode: str = 'r') -> Tuple[Any, Tuple, int]:
 
     Args:
         filename: str
-            path of the file to be loaded
+            path of the file to be loaded. Files with the .zarr extension are
+            opened as chunked stores (see ChunkedMemmap)
         mode: str
             One of 'r', 'r+', 'w+'. How to interact with files
 
@@ -46,7 +49,7 @@ def load_memmap(filename: str, mode: str = 'r') -> Tuple[Any, Tuple, int]:
         ValueError "Unknown file extension"
 
     """
-    if pathlib.Path(filename).suffix != '.mmap':
+    if pathlib.Path(filename).suffix not in ('.mmap', '.zarr'):
         logging.error(f"Unknown extension for file {filename}")
         raise ValueError(f'Unknown file extension for file {filename} (should be .mmap)')
     # Strip path components and use CAIMAN_DATA/example_movies
@@ -63,12 +66,147 @@ def load_memmap(filename: str, mode: str = 'r') -> Tuple[Any, Tuple, int]:
     #d1, d2, d3, T, order = int(fpart[-9]), int(fpart[-7]), int(fpart[-5]), int(fpart[-1]), fpart[-3]
 
     filename = caiman.paths.fn_relocated(filename)
-    Yr = np.memmap(filename, mode=mode, shape=prepare_shape((d1 * d2 * d3, T)), dtype=np.float32, order=order)
+    if pathlib.Path(filename).suffix == '.zarr':
+        Yr = ChunkedMemmap(filename, mode=mode)
+    else:
+        Yr = np.memmap(filename, mode=mode, shape=prepare_shape((d1 * d2 * d3, T)), dtype=np.float32, order=order)
     if d3 == 1:
         return (Yr, (d1, d2), T)
     else:
         return (Yr, (d1, d2, d3), T)
 
+def _open_zarr(filename: str, mode: str = 'r', shape=None, chunks=None, compressor=None):
+    try:
+        import zarr
+        from numcodecs import Blosc
+    except ImportError:
+        raise Exception("zarr library not available; install zarr and numcodecs to use chunked movie stores")
+    if mode == 'w':
+        if compressor is None:
+            compressor = Blosc(cname='zstd', clevel=3, shuffle=Blosc.BITSHUFFLE)
+        # the stores are written in the v2 format, which takes numcodecs compressors
+        # and can be read by both zarr 2 and zarr 3
+        kwargs = {'zarr_format': 2} if int(zarr.__version__.split('.')[0]) >= 3 else {}
+        return zarr.open_array(filename, mode='w', shape=shape, chunks=chunks, dtype=np.float32,
+                               compressor=compressor, **kwargs)
+    return zarr.open_array(filename, mode=mode)
+
+def _zarr_chunks(dims: Tuple, T: int, tile: int = 64, frames_per_chunk: int = 256) -> Tuple:
+    """ Chunks made of a spatial tile and a block of frames, so that both
+    patches (pixel-major access) and ranges of frames (frame-major access)
+    only touch a fraction of the store """
+    if len(dims) == 3:
+        tile_dims = (tile // 2, tile // 2, tile // 4)
+    else:
+        tile_dims = (tile,) * len(dims)
+    return tuple(int(min(t, d)) for t, d in zip(tile_dims, dims)) + (int(min(frames_per_chunk, T)),)
+
+class ChunkedMemmap(object):
+    """ A chunked, compressed movie store with the same indexing behavior as
+    the pixels x time arrays returned by load_memmap for .mmap files.
+
+    The data are kept in a Zarr directory store of shape (x, y[, z], t),
+    split in chunks spanning a spatial tile and a block of frames, so that
+    reading the time course of a patch or a range of frames only decompresses
+    the chunks that are needed. Rows index pixels flattened in 'F' order as
+    in the .mmap files. Indexing returns in-memory numpy arrays; writing to
+    a subset of the pixels rewrites the whole tiles that contain them.
+    """
+    def __init__(self, filename: str, mode: str = 'r'):
+        self.filename = filename
+        self.mode = mode
+        self._store = _open_zarr(filename, mode='r+' if mode == 'w+' else mode)
+        self.dims = self._store.shape[:-1]
+        self.shape = (int(np.prod(self.dims)), self._store.shape[-1])
+        self.dtype = self._store.dtype
+        self.ndim = 2
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __array__(self, dtype=None) -> np.ndarray:
+        return np.asarray(self[:], dtype=dtype)
+
+    def _split_key(self, key) -> Tuple:
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 2:
+            raise IndexError('ChunkedMemmap: too many indices')
+        key = key + (slice(None),) * (2 - len(key))
+        return key[0], key[1]
+
+    def _locate(self, rows) -> Tuple:
+        # bounding tiles of the requested pixels in the store and their positions within
+        idx = np.arange(self.shape[0])[rows] if isinstance(rows, slice) else np.atleast_1d(rows)
+        if idx.dtype == bool:
+            idx = np.where(idx)[0]
+        sub = np.unravel_index(idx, self.dims, order='F')
+        uniq = [np.unique(s) for s in sub]
+        selection = tuple(slice(int(u[0]), int(u[-1]) + 1) if len(u) == u[-1] - u[0] + 1 else u
+                          for u in uniq)
+        pos = tuple(s - u[0] if isinstance(sl, slice) else np.searchsorted(u, s)
+                    for s, u, sl in zip(sub, uniq, selection))
+        return selection, pos
+
+    def __getitem__(self, key) -> np.ndarray:
+        rows, cols = self._split_key(key)
+        selection, pos = self._locate(rows)
+        out = self._store.oindex[selection + (cols,)][pos]
+        return out[0] if np.isscalar(rows) else out
+
+    def __setitem__(self, key, value) -> None:
+        if self.mode == 'r':
+            raise ValueError('ChunkedMemmap: the store was opened read-only')
+        rows, cols = self._split_key(key)
+        if isinstance(rows, slice) and rows == slice(None):
+            value = np.asarray(value, dtype=self.dtype)
+            self._store[..., cols] = np.reshape(value, self.dims + value.shape[1:], order='F')
+        else:
+            # read, modify and write back the bounding tiles of the pixels
+            selection, pos = self._locate(rows)
+            block = self._store.oindex[selection + (cols,)]
+            block[pos] = value
+            self._store.oindex[selection + (cols,)] = block
+
+def memmap_to_zarr(filename: str, tile: int = 64, frames_per_chunk: int = 256, compressor=None,
+                   remove_mmap: bool = False) -> str:
+    """ Convert a memory mapped file into a chunked, compressed Zarr store
+
+    Args:
+        filename: str
+            path of the .mmap file to convert
+
+        tile: int
+            side of the spatial tile of each chunk (halved for 3D data)
+
+        frames_per_chunk: int
+            number of frames in each chunk
+
+        compressor: numcodecs codec
+            compressor used for the chunks, default blosc with zstd
+
+        remove_mmap: bool
+            whether to delete the original file after the conversion
+
+    Returns:
+        fname_new: path of the .zarr store, with the same naming scheme as the
+            original file so that load_memmap can decode its shape
+    """
+    Yr, dims, T = load_memmap(filename)
+    chunks = _zarr_chunks(dims, T, tile=tile, frames_per_chunk=frames_per_chunk)
+    fname_new = os.path.splitext(filename)[0] + '.zarr'
+    store = _open_zarr(fname_new, mode='w', shape=tuple(dims) + (T,), chunks=chunks, compressor=compressor)
+    # copy slabs along the last spatial axis, which are contiguous blocks of rows
+    plane = int(np.prod(dims[:-1]))
+    for z0 in range(0, dims[-1], chunks[-2]):
+        z1 = min(z0 + chunks[-2], dims[-1])
+        slab = np.asarray(Yr[z0 * plane:z1 * plane], dtype=np.float32)
+        store[..., z0:z1, :] = np.reshape(slab, tuple(dims[:-1]) + (z1 - z0, T), order='F')
+    del Yr
+    if remove_mmap:
+        os.remove(filename)
+    return fname_new
+
 def save_memmap_each(fnames: List[str],
                      dview=None,
                      base_name: str = None,
@@ -148,13 +286,8 @@ def save_memmap_each(fnames: List[str],
             ])
 
     # Perform the job using whatever computing framework we're set to use
-    if dview is not None:
-        if 'multiprocessing' in str(type(dview)):
-            fnames_new = dview.map_async(save_place_holder, pars).get(4294967)
-        else:
-            fnames_new = my_map(dview, save_place_holder, pars)
-    else:
-        fnames_new = list(map(save_place_holder, pars))
+    from .cluster import get_executor
+    fnames_new = get_executor(dview).map(save_place_holder, pars)
 
     return fnames_new
 
@@ -210,14 +343,8 @@ def save_memmap_join(mmap_fnames: List[str], base_name: str = None, n_chunks: in
         # last batch should include the leftover pixels
         pars[-1][-2] = d
 
-    if dview is not None:
-        if 'multiprocessing' in str(type(dview)):
-            dview.map_async(save_portion, pars).get(4294967)
-        else:
-            my_map(dview, save_portion, pars)
-
-    else:
-        list(map(save_portion, pars))
+    from .cluster import get_executor
+    get_executor(dview).map(save_portion, pars)
 
     np.savez(caiman.paths.fn_relocated(base_name + '.npz'), mmap_fnames=mmap_fnames, fname_tot=fname_tot)
 
@@ -344,7 +471,10 @@ def save_memmap(filenames: List[str],
                 border_to_0=0,
                 dview=None,
                 n_chunks: int = 100,
-                slices=None) -> str:
+                slices=None,
+                streaming: bool = False,
+                batch_size: int = 1000,
+                store: str = 'mmap') -> str:
     """ Efficiently write data from a list of tif files into a memory mappable file
 
     Args:
@@ -388,6 +518,23 @@ def save_memmap(filenames: List[str],
             directions. For instance
             slices = [slice(0,200),slice(0,100),slice(0,100)] will take
             the first 200 frames and the 100 pixels along x and y dimensions.
+
+        streaming: bool
+            if True and a single 2D movie file is passed, the file is read in
+            batches of batch_size frames and each batch is written to the
+            memory mapped file by a background thread while the next one is
+            decoded, so the movie is never fully loaded in memory. With
+            border_to_0 > 0 the file is read twice, first to find the minimum
+            of the movie
+
+        batch_size: int
+            number of frames per batch when streaming is True
+
+        store: str
+            'mmap' for a raw memory mapped file, or 'zarr' for a chunked and
+            compressed Zarr store that load_memmap opens as a ChunkedMemmap
+            (requires the zarr package)
+
     Returns:
         fname_new: the name of the mapped file, the format is such that
             the name will contain the frame dimensions and the number of frames
@@ -435,8 +582,24 @@ def save_memmap(filenames: List[str],
         fname_new = cm.save_memmap_join(fname_parts, base_name=base_name,
                                         dview=dview, n_chunks=n_chunks)
 
+    elif streaming and isinstance(filenames[0], str) and not is_3D:
+        fname_new = save_memmap_streaming(filenames[0],
+                                          base_name=base_name,
+                                          resize_fact=resize_fact,
+                                          remove_init=remove_init,
+                                          idx_xy=idx_xy,
+                                          order=order,
+                                          var_name_hdf5=var_name_hdf5,
+                                          xy_shifts=xy_shifts,
+                                          add_to_movie=add_to_movie,
+                                          border_to_0=border_to_0,
+                                          slices=slices,
+                                          batch_size=batch_size,
+                                          store=store)
+
     else:
-        # TODO: can be done online
+        if streaming:
+            logging.warning('save_memmap: streaming is only supported for a single 2D movie file, loading it in memory')
         Ttot = 0
         for idx, f in enumerate(filenames):
             if isinstance(f, str):     # Might not always be filenames.
@@ -536,6 +699,152 @@ def save_memmap(filenames: List[str],
             pass
         os.rename(fname_tot, fname_new)
 
+    if store == 'zarr' and pathlib.Path(fname_new).suffix != '.zarr':
+        fname_new = memmap_to_zarr(fname_new, remove_mmap=True)
+
+    return fname_new
+
+def save_memmap_streaming(filename: str,
+                          base_name: str = 'Yr',
+                          resize_fact: Tuple = (1, 1, 1),
+                          remove_init: int = 0,
+                          idx_xy: Tuple = None,
+                          order: str = 'F',
+                          var_name_hdf5: str = 'mov',
+                          xy_shifts: Optional[List] = None,
+                          add_to_movie: float = 0,
+                          border_to_0: int = 0,
+                          slices=None,
+                          batch_size: int = 1000,
+                          queue_size: int = 2,
+                          store: str = 'mmap') -> str:
+    """ Write a single 2D movie file into a memory mappable file with bounded memory
+
+    The movie is read in batches of frames with load_iter, each batch is
+    processed as in save_memmap and handed to a writer thread that fills the
+    preallocated memory mapped file, so that decoding the next batch overlaps
+    with writing the previous one. See save_memmap for the meaning of the
+    arguments.
+
+    Args:
+        batch_size: int
+            number of frames read and written at a time
+
+        queue_size: int
+            maximum number of processed batches waiting to be written
+
+        store: str
+            'mmap' or 'zarr', see save_memmap
+
+    Returns:
+        fname_new: the name of the mapped file
+    """
+    from caiman.source_extraction.cnmf.utilities import get_file_size
+
+    filename = caiman.paths.fn_relocated(filename)
+    _, T_in = get_file_size(filename, var_name_hdf5=var_name_hdf5)
+    if slices is not None:
+        time_sl, space_sl = slices[0], tuple(slices[1:])
+    else:
+        time_sl, space_sl = slice(remove_init, None), None
+        if idx_xy is not None:
+            if len(idx_xy) != 2:
+                raise Exception('You need to set is_3D=True for 3D data)')
+            space_sl = tuple(idx_xy)
+    frame_idx = range(T_in)[time_sl]
+    if xy_shifts is not None:
+        xy_shifts = np.asarray(xy_shifts)
+
+    fx, fy, fz = resize_fact
+    batch_starts = list(range(0, len(frame_idx), batch_size))
+    batch_lengths = [min(batch_size, len(frame_idx) - b0) for b0 in batch_starts]
+    if fz != 1:
+        batch_lengths = [max(1, int(fz * n)) for n in batch_lengths]
+    T = int(np.sum(batch_lengths))
+
+    def crop_batch(Y, b0):
+        Y = cm.movie(Y, fr=1)
+        if xy_shifts is not None:
+            shifts = xy_shifts[frame_idx[b0:b0 + len(Y)]]
+            Y = Y.apply_shifts(shifts, interpolation='cubic', remove_blanks=False)
+        if space_sl is not None:
+            Y = Y[(slice(None),) + space_sl]
+        return Y
+
+    def batches():
+        frames = cm.base.movies.load_iter(filename, subindices=frame_idx, var_name_hdf5=var_name_hdf5)
+        for b0 in batch_starts:
+            yield crop_batch(np.array(list(islice(frames, batch_size)), dtype=np.float32), b0)
+
+    if border_to_0 > 0:
+        if isinstance(slices, list):
+            raise Exception(
+                'You cannot slice in x and y and then use add_to_movie: if you only want to slice in time do not pass in a list but just a slice object'
+            )
+        # the border is set to the minimum of the whole movie (plus one, as calc_min), as in save_memmap
+        min_mov = np.nanmin([np.nanmin(Y) for Y in batches()]).tolist() + 1
+
+    def process_batch(Y):
+        if border_to_0 > 0:
+            Y[:, :border_to_0, :] = min_mov
+            Y[:, :, :border_to_0] = min_mov
+            Y[:, :, -border_to_0:] = min_mov
+            Y[:, -border_to_0:, :] = min_mov
+        if fx != 1 or fy != 1 or fz != 1:
+            Y = Y.resize(fx=fx, fy=fy, fz=fz)
+        dims = Y.shape[1:]
+        Yr = np.reshape(np.transpose(Y, [1, 2, 0]), (np.prod(dims), Y.shape[0]), order='F')
+        return dims, np.asarray(Yr, dtype=np.float32) + np.float32(0.0001) + np.float32(add_to_movie)
+
+    def writer(big_mov, write_queue, errors):
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
+            if errors:      # keep draining so that the reader never blocks
+                continue
+            t0, Yr = item
+            try:
+                big_mov[:, t0:t0 + Yr.shape[1]] = Yr
+            except Exception as e:
+                errors.append(e)
+
+    fname_new = None
+    write_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    errors: List = []
+    t_out = 0
+    for Y in batches():
+        dims, Yr = process_batch(Y)
+        if fname_new is None:
+            fname_tot = cm.paths.generate_fname_tot(base_name, dims, order)
+            fname_new = caiman.paths.fn_relocated(
+                os.path.join(os.path.split(filename)[0], fname_tot + f'_frames_{T}.' + store))
+            logging.debug(f'Streaming {T} frames to {fname_new}')
+            if store == 'zarr':
+                _open_zarr(fname_new, mode='w', shape=tuple(dims) + (T,), chunks=_zarr_chunks(dims, T))
+                big_mov = ChunkedMemmap(fname_new, mode='r+')
+            else:
+                big_mov = np.memmap(fname_new,
+                                    mode='w+',
+                                    dtype=np.float32,
+                                    shape=prepare_shape((np.prod(dims), T)),
+                                    order=order)
+            writer_thread = threading.Thread(target=writer, args=(big_mov, write_queue, errors), daemon=True)
+            writer_thread.start()
+        write_queue.put((t_out, Yr))
+        t_out += Yr.shape[1]
+
+    if fname_new is None:
+        raise Exception('save_memmap_streaming: no frames to save')
+    write_queue.put(None)
+    writer_thread.join()
+    if errors:
+        raise errors[0]
+    if t_out != T:
+        raise Exception(f'save_memmap_streaming: wrote {t_out} frames but expected {T}')
+    if store != 'zarr':
+        big_mov.flush()
+    del big_mov
     return fname_new
 
 def parallel_dot_product(A: np.ndarray, b, block_size: int = 5000, dview=None, transpose=False,
@@ -550,67 +859,73 @@ def parallel_dot_product(A: np.ndarray, b, block_size: int = 5000, dview=None, t
         b: time x comps
     """
 
+    from .cluster import SharedMemoryPool, get_executor
     pars = []
     d1, d2 = np.shape(A)
-    b = pickle.dumps(b)
-    logging.debug(f'parallel dot product block size: {block_size}')
-
-    if block_size < d1:
-        for idx in range(0, d1 - block_size, block_size):
-            idx_to_pass = list(range(idx, idx + block_size))
-            pars.append([A.filename, idx_to_pass, b, transpose])
-
-        if (idx + block_size) < d1:
-            idx_to_pass = list(range(idx + block_size, d1))
-            pars.append([A.filename, idx_to_pass, b, transpose])
-
+    b_shared = None
+    if isinstance(dview, SharedMemoryPool) and 'sparse' not in str(type(b)):
+        # publish b once instead of pickling it for every block
+        b_shared = dview.publish(b, dtype=np.float32)
+        b_orig = b
+        b = b_shared
     else:
-        idx_to_pass = list(range(d1))
-        pars.append([A.filename, idx_to_pass, b, transpose])
+        b = pickle.dumps(b)
+    try:
+        logging.debug(f'parallel dot product block size: {block_size}')
 
-    logging.debug('Start product')
-    b = pickle.loads(b)
+        if block_size < d1:
+            for idx in range(0, d1 - block_size, block_size):
+                idx_to_pass = list(range(idx, idx + block_size))
+                pars.append([A.filename, idx_to_pass, b, transpose])
 
-    if transpose:
-        output = np.zeros((d2, np.shape(b)[-1]), dtype=np.float32)
-    else:
-        output = np.zeros((d1, np.shape(b)[-1]), dtype=np.float32)
+            if (idx + block_size) < d1:
+                idx_to_pass = list(range(idx + block_size, d1))
+                pars.append([A.filename, idx_to_pass, b, transpose])
 
-    if dview is None:
-        if transpose:
-            #            b = pickle.loads(b)
-            logging.debug('Transposing')
-            for _, pr in enumerate(pars):
-                iddx, rs = dot_place_holder(pr)
-                output = output + rs
         else:
-            for _, pr in enumerate(pars):
-                iddx, rs = dot_place_holder(pr)
-                output[iddx] = rs
-
-    else:
-        for itera in range(0, len(pars), num_blocks_per_run):
+            idx_to_pass = list(range(d1))
+            pars.append([A.filename, idx_to_pass, b, transpose])
 
-            if 'multiprocessing' in str(type(dview)):
-                results = dview.map_async(dot_place_holder, pars[itera:itera + num_blocks_per_run]).get(4294967)
-            else:
-                results = dview.map_sync(dot_place_holder, pars[itera:itera + num_blocks_per_run])
+        logging.debug('Start product')
+        if b_shared is None:
+            b = pickle.loads(b)
+        else:
+            b = b_orig
 
-            logging.debug('Processed:' + str([itera, itera + len(results)]))
+        if transpose:
+            output = np.zeros((d2, np.shape(b)[-1]), dtype=np.float32)
+        else:
+            output = np.zeros((d1, np.shape(b)[-1]), dtype=np.float32)
 
+        if dview is None:
             if transpose:
+                #            b = pickle.loads(b)
                 logging.debug('Transposing')
-
-                for _, res in enumerate(results):
-                    output += res[1]
-
+                for _, pr in enumerate(pars):
+                    iddx, rs = dot_place_holder(pr)
+                    output = output + rs
             else:
-                logging.debug('Filling')
-                for res in results:
-                    output[res[0]] = res[1]
+                for _, pr in enumerate(pars):
+                    iddx, rs = dot_place_holder(pr)
+                    output[iddx] = rs
 
-            if 'multiprocessing' not in str(type(dview)):
-                dview.clear()
+        else:
+            executor = get_executor(dview)
+            for itera in range(0, len(pars), num_blocks_per_run):
+                if transpose:
+                    # keep the order of the sum deterministic
+                    for res in executor.map(dot_place_holder, pars[itera:itera + num_blocks_per_run]):
+                        output += res[1]
+                else:
+                    # every block carries its own index, fill them in as they complete
+                    for res in executor.imap_unordered(dot_place_holder, pars[itera:itera + num_blocks_per_run]):
+                        output[res[0]] = res[1]
+
+                logging.debug('Processed:' + str([itera, min(itera + num_blocks_per_run, len(pars))]))
+                executor.clear()
+    finally:
+        if b_shared is not None:
+            dview.release(b_shared)
 
     return output
 
@@ -619,7 +934,10 @@ def dot_place_holder(par: List) -> Tuple:
 
     A_name, idx_to_pass, b_, transpose = par
     A_, _, _ = load_memmap(A_name)
-    b_ = pickle.loads(b_).astype(np.float32)
+    if isinstance(b_, bytes):
+        b_ = pickle.loads(b_).astype(np.float32)
+    else:
+        b_ = b_.get()  # published by a SharedMemoryPool
 
     logging.debug((idx_to_pass[-1]))
     if 'sparse' in str(type(b_)):
@@ -48,6 +48,7 @@ from numpy.fft import ifftshift
 import os
 import sys
 import pylab as pl
+import scipy.fft
 import tifffile
 from typing import List, Optional, Tuple
 from skimage.transform import resize as resize_sk
@@ -57,6 +58,7 @@ import caiman as cm
 import caiman.base.movies
 import caiman.motion_correction
 import caiman.paths
+from .cluster import get_executor
 from .mmapping import prepare_shape
 
 try:
@@ -92,7 +94,8 @@ class MotionCorrect(object):
                  strides=(96, 96), overlaps=(32, 32), splits_els=14, num_splits_to_process_els=None,
                  upsample_factor_grid=4, max_deviation_rigid=3, shifts_opencv=True, nonneg_movie=True, gSig_filt=None,
                  use_cuda=False, border_nan=True, pw_rigid=False, num_frames_split=80, var_name_hdf5='mov',is3D=False,
-                 indices=(slice(None), slice(None)), subidx=slice(None, None, 1)):
+                 indices=(slice(None), slice(None)), subidx=slice(None, None, 1), fft_batch_size=None,
+                 pyramid_levels=0, nonrigid_engine='pwrigid', flow_downsample=1, streaming_template=False):
         """
         Constructor class for motion correction operations
 
@@ -169,6 +172,35 @@ class MotionCorrect(object):
             indices: tuple(slice), default: (slice(None), slice(None))
                Use that to apply motion correction only on a part of the FOV
 
+            fft_batch_size: int or None, default: None
+               If not None, register frames in vectorized batches of this size instead
+               of one at a time. Faster, in particular for pw-rigid motion correction.
+               Ignored for 3D data and when use_cuda is True
+
+            pyramid_levels: int, default: 0
+               If > 0, rigid shifts are estimated coarse to fine: on frames downsampled
+               by 2**pyramid_levels, then refined on a window at full resolution (see
+               register_translation_pyramid). Faster for large frames and max_shifts.
+               Ignored for 3D data and when fft_batch_size is set
+
+            nonrigid_engine: 'pwrigid' or 'optical_flow', default: 'pwrigid'
+               Registration used when pw_rigid is True. 'pwrigid' registers patches of
+               the frames (tile_and_correct). 'optical_flow' estimates the dense displacement
+               field between the template and each frame with cv2.calcOpticalFlowFarneback,
+               starting from the rigid shift, and warps the frame with cv2.remap
+               (tile_and_correct_flow); x_shifts_els and y_shifts_els then hold the
+               displacements averaged over the patches defined by strides and overlaps.
+               Not supported for 3D data
+
+            flow_downsample: int, default: 1
+               With nonrigid_engine='optical_flow', factor by which the frames are downsampled
+               to estimate the flow
+
+            streaming_template: bool, default: False
+               With niter_rig > 1, refine the rigid template in a single pass, updating it
+               as the chunks are registered and stopping once it converges, instead of
+               niter_rig - 1 full passes (see motion_correct_batch_rigid)
+
        Returns:
            self
 
@@ -207,10 +239,16 @@ class MotionCorrect(object):
         self.is3D = bool(is3D)
         self.indices = indices
         self.subidx = subidx
+        self.fft_batch_size = fft_batch_size
+        self.pyramid_levels = pyramid_levels
+        self.nonrigid_engine = nonrigid_engine
+        self.flow_downsample = flow_downsample
+        self.streaming_template = streaming_template
         if self.use_cuda and not HAS_CUDA:
             logging.debug("pycuda is unavailable. Falling back to default FFT.")
 
-    def motion_correct(self, template=None, save_movie=False):
+    def motion_correct(self, template=None, save_movie=False, order='F', base_name='memmap_',
+                       border_to_0=None, summary_images=False):
         """general function for performing all types of motion correction. The
         function will perform either rigid or piecewise rigid motion correction
         depending on the attribute self.pw_rigid and will perform high pass
@@ -225,6 +263,25 @@ class MotionCorrect(object):
             save_movie: bool, default: False
                 flag for saving motion corrected file(s) as memory mapped file(s)
 
+            order: 'F' or 'C', default: 'F'
+                with save_movie, 'F' saves one memory mapped file per input file in F order.
+                'C' writes the corrected frames of all the files directly into a single
+                memory mapped file in C order, as produced by
+                save_memmap(mc.mmap_file, base_name=base_name, order='C', border_to_0=border_to_0)
+                from the F order files, without writing and reading them again (2D data only)
+
+            base_name: str, default: 'memmap_'
+                with order='C', base of the name of the memory mapped file
+
+            border_to_0: int or None, default: None
+                with order='C', number of pixels on the border set to the minimum of the movie,
+                by default self.border_to_0, or 0 if self.border_nan is 'copy'
+
+            summary_images: bool, default: False
+                with order='C', also compute the mean, max and correlation images of the
+                corrected movie while it is written (attributes mean_img, max_img and Cn).
+                The correlation image is computed as in summary_images.correlation_image_ecobost
+
         Returns:
             self
         """
@@ -249,8 +306,15 @@ class MotionCorrect(object):
                     for m_ in cm.load(self.fname[0], var_name_hdf5=self.var_name_hdf5,
                                       subindices=slice(400))]).min()
 
+        out = None
+        if save_movie and order == 'C':
+            if self.is3D:
+                raise Exception('Saving in C order during motion correction is not supported for 3D data')
+            out = CorrectedMemmap(self.fname, base_name, indices=self.indices,
+                                  var_name_hdf5=self.var_name_hdf5, summary_images=summary_images)
+
         if self.pw_rigid:
-            self.motion_correct_pwrigid(template=template, save_movie=save_movie)
+            self.motion_correct_pwrigid(template=template, save_movie=save_movie, out=out)
             if self.is3D:
                 # TODO - error at this point after saving
                 b0 = np.ceil(np.max([np.max(np.abs(self.x_shifts_els)),
@@ -260,13 +324,20 @@ class MotionCorrect(object):
                 b0 = np.ceil(np.maximum(np.max(np.abs(self.x_shifts_els)),
                                     np.max(np.abs(self.y_shifts_els))))
         else:
-            self.motion_correct_rigid(template=template, save_movie=save_movie)
+            self.motion_correct_rigid(template=template, save_movie=save_movie, out=out)
             b0 = np.ceil(np.max(np.abs(self.shifts_rig)))
         self.border_to_0 = b0.astype(int)
-        self.mmap_file = self.fname_tot_els if self.pw_rigid else self.fname_tot_rig
+        if out is None:
+            self.mmap_file = self.fname_tot_els if self.pw_rigid else self.fname_tot_rig
+        else:
+            if border_to_0 is None:
+                border_to_0 = 0 if self.border_nan == 'copy' else self.border_to_0
+            self.mmap_file = out.finalize(border_to_0)
+            if summary_images:
+                self.mean_img, self.max_img, self.Cn = out.mean_img, out.max_img, out.Cn
         return self
 
-    def motion_correct_rigid(self, template=None, save_movie=False) -> None:
+    def motion_correct_rigid(self, template=None, save_movie=False, out=None) -> None:
         """
         Perform rigid motion correction
 
@@ -277,6 +348,9 @@ class MotionCorrect(object):
             save_movie_rigid:Bool
                 save the movies vs just get the template
 
+            out: CorrectedMemmap
+                if given with save_movie, file into which the frames are written
+
         Important Fields:
             self.fname_tot_rig: name of the mmap file saved
 
@@ -312,7 +386,11 @@ class MotionCorrect(object):
                 var_name_hdf5=self.var_name_hdf5,
                 is3D=self.is3D,
                 indices=self.indices,
-                subidx=self.subidx)
+                subidx=self.subidx,
+                fft_batch_size=self.fft_batch_size,
+                pyramid_levels=self.pyramid_levels,
+                streaming_template=self.streaming_template,
+                out=out)
             if template is None:
                 self.total_template_rig = _total_template_rig
 
@@ -320,7 +398,8 @@ class MotionCorrect(object):
             self.fname_tot_rig += [_fname_tot_rig]
             self.shifts_rig += _shifts_rig
 
-    def motion_correct_pwrigid(self, save_movie:bool=True, template:np.ndarray=None, show_template:bool=False) -> None:
+    def motion_correct_pwrigid(self, save_movie:bool=True, template:np.ndarray=None, show_template:bool=False,
+                               out=None) -> None:
         """Perform pw-rigid motion correction
 
         Args:
@@ -333,6 +412,9 @@ class MotionCorrect(object):
             show_template: boolean
                 whether to show the updated template at each iteration
 
+            out: CorrectedMemmap
+                if given with save_movie, file into which the frames are written
+
         Important Fields:
             self.fname_tot_els: name of the mmap file saved
             self.templates_els: template updated by iterating  over the chunks
@@ -372,7 +454,8 @@ class MotionCorrect(object):
                     num_splits_to_process=None, num_iter=num_iter, template=self.total_template_els,
                     shifts_opencv=self.shifts_opencv, save_movie=save_movie, nonneg_movie=self.nonneg_movie, gSig_filt=self.gSig_filt,
                     use_cuda=self.use_cuda, border_nan=self.border_nan, var_name_hdf5=self.var_name_hdf5, is3D=self.is3D,
-                    indices=self.indices)
+                    indices=self.indices, fft_batch_size=self.fft_batch_size,
+                    engine=self.nonrigid_engine, flow_downsample=self.flow_downsample, out=out)
             if not self.is3D:
                 if show_template:
                     pl.imshow(new_template_els)
@@ -1202,26 +1285,7 @@ def motion_correct_parallel(file_names, fr=10, template=None, margins_out=0,
             args_in.append((f, fr, margins_out, template, max_shift_w,
                             max_shift_h, remove_blanks, apply_smooth, save_hdf5))
 
-    try:
-        if dview is not None:
-            if 'multiprocessing' in str(type(dview)):
-                file_res = dview.map_async(
-                    process_movie_parallel, args_in).get(4294967)
-            else:
-                file_res = dview.map_sync(process_movie_parallel, args_in)
-                dview.results.clear()
-        else:
-            file_res = list(map(process_movie_parallel, args_in))
-
-    except:
-        try:
-            if (dview is not None) and 'multiprocessing' not in str(type(dview)):
-                dview.results.clear()
-
-        except UnboundLocalError:
-            logging.error('could not close client')
-
-        raise
+    file_res = get_executor(dview).map(process_movie_parallel, args_in)
 
     return file_res
 
@@ -1820,6 +1884,260 @@ def register_translation(src_image, target_image, upsample_factor=1,
 
     return shifts, src_freq, _compute_phasediff(CCmax)
 
+def _downsample_mean(img, factor):
+    """ average the image over blocks of factor x factor pixels, dropping the
+    rows and columns that do not fill a block
+    """
+    d1, d2 = img.shape[0] // factor, img.shape[1] // factor
+    return img[:d1 * factor, :d2 * factor].reshape(d1, factor, d2, factor).mean(axis=(1, 3))
+
+def register_translation_pyramid(src_image, target_image, upsample_factor=1, max_shifts=(10, 10),
+                                 levels=2, window=None, use_cuda=False):
+    """
+    Coarse to fine version of register_translation for large max_shifts.
+
+    The shift is first estimated at whole pixel resolution on the images
+    averaged over blocks of 2**levels x 2**levels pixels, where max_shifts is
+    2**levels times smaller. It is then refined, with subpixel precision, by
+    registering a window of the target with the window of the source displaced
+    by the coarse shift, both tapered by a Hann window, searching only the
+    shifts within 2**levels pixels of the coarse shift. The Fourier transforms are thus computed on images 4**levels
+    times smaller and on the windows instead of the full frames.
+
+    Args:
+        src_image: ndarray
+            image to register (2D)
+
+        target_image: ndarray
+            reference image, same size as src_image
+
+        upsample_factor: int
+            images will be registered to within 1 / upsample_factor of a pixel
+
+        max_shifts: tuple
+            max shifts in x and y
+
+        levels: int
+            number of halvings of the resolution for the coarse estimate.
+            0 is the same as register_translation
+
+        window: tuple or None
+            size of the windows used for the refinement, by default half the
+            size of the images (at least 32 pixels) along each axis
+
+        use_cuda : bool, optional
+            Use skcuda.fft (if available). Default: False
+
+    Returns:
+        shifts: ndarray
+            shifts required to register src_image with target_image, as returned
+            by register_translation
+
+        src_freq: ndarray
+            spectrum of the window of src_image (not of the full image)
+
+        phasediff: float
+            global phase difference between the two windows
+    """
+    if src_image.shape != target_image.shape:
+        raise ValueError("Error: images must really be same size for "
+                         "register_translation_pyramid")
+    if src_image.ndim != 2:
+        raise NotImplementedError("Error: register_translation_pyramid only supports 2D images")
+
+    factor = 2 ** int(levels)
+    max_shifts = np.array(max_shifts[:2], dtype=int)
+    # one more, since register_translation searches positive shifts up to max_shifts - 1
+    coarse_max_shifts = np.ceil(max_shifts / factor).astype(int) + 1
+    shape = np.array(src_image.shape)
+    if levels <= 0 or np.any(shape // factor <= 2 * coarse_max_shifts):
+        # nothing to gain on images this small
+        return register_translation(src_image, target_image, upsample_factor=upsample_factor,
+                                    max_shifts=max_shifts, use_cuda=use_cuda)
+
+    # whole pixel shift at low resolution
+    coarse = register_translation(_downsample_mean(src_image, factor), _downsample_mean(target_image, factor),
+                                  max_shifts=coarse_max_shifts, use_cuda=use_cuda)[0]
+    coarse = np.clip(coarse * factor, -max_shifts, max_shifts).astype(int)
+
+    # refinement on a window of the target and the window of the source displaced by the coarse shift
+    if window is None:
+        window = np.maximum(shape // 2, 32)
+    window = np.minimum(window, shape - np.abs(coarse))
+    start_target = (shape - np.abs(coarse) - window) // 2 + np.maximum(-coarse, 0)
+    start_src = start_target + coarse
+    src_window = src_image[start_src[0]:start_src[0] + window[0], start_src[1]:start_src[1] + window[1]]
+    target_window = target_image[start_target[0]:start_target[0] + window[0],
+                                 start_target[1]:start_target[1] + window[1]]
+    # taper the windows, the cross-correlation of their discontinuous edges
+    # (wrapped around by the FFT) would otherwise bias the subpixel estimate
+    taper = np.outer(np.hanning(window[0]), np.hanning(window[1]))
+    src_window = (src_window - src_window.mean()) * taper
+    target_window = (target_window - target_window.mean()) * taper
+    shifts_lb = np.maximum(-max_shifts, coarse - factor) - coarse
+    shifts_ub = np.minimum(max_shifts, coarse + factor) - coarse + 1
+    shifts, src_freq, phasediff = register_translation(
+        src_window, target_window, upsample_factor=upsample_factor, shifts_lb=shifts_lb,
+        shifts_ub=shifts_ub, use_cuda=use_cuda)
+    return coarse + shifts, src_freq, phasediff
+
+def _bounds_mask(size, lb, ub):
+    """ boolean mask of the admissible positions of the cross correlation along one
+    axis, reproducing the slicing performed in register_translation
+    """
+    mask = np.ones(size, dtype=bool)
+    if (lb < 0) and (ub >= 0):
+        mask[ub:lb] = False
+    else:
+        mask[:lb] = False
+        mask[ub:] = False
+    return mask
+
+def register_translation_batch(src_images, target_freq, upsample_factor=1,
+                               shifts_lb=None, shifts_ub=None, max_shifts=(10, 10)):
+    """
+    Vectorized version of register_translation for a stack of 2D images.
+
+    All images are registered in one pass: forward transforms, cross-power
+    spectra, peak search and the matrix-multiply DFT refinement are computed
+    on the whole stack at once. The spectrum of the target is passed in so that
+    it can be computed once and reused across frames.
+
+    Args:
+        src_images: ndarray
+            stack of images to register (N x d1 x d2)
+
+        target_freq: ndarray
+            spectrum of the reference image(s), either one (d1 x d2) spectrum shared
+            by all images, one per image (N x d1 x d2), or M spectra (M x d1 x d2)
+            repeating along the stack (N a multiple of M, e.g. the patches of the template
+            for a stack of the patches of several frames). The spectra must be normalized
+            by the number of pixels, see template_spectrum
+
+        upsample_factor: int
+            Images will be registered to within 1 / upsample_factor of a pixel
+
+        shifts_lb, shifts_ub: ndarray or None
+            lower and upper bounds of the shifts, either shared (2,) or per image (N x 2).
+            If None, max_shifts is used
+
+        max_shifts: tuple
+            max shifts in x and y
+
+    Returns:
+        shifts: ndarray
+            shifts (N x 2) required to register each image with the target
+
+        src_freq: ndarray
+            spectra of the images (N x d1 x d2)
+
+        phasediff: ndarray
+            global phase difference for each image (N,)
+    """
+    src_images = np.asarray(src_images, dtype=np.float64)
+    if src_images.ndim != 3:
+        raise ValueError("Error: register_translation_batch expects a stack of 2D images")
+    num_images = src_images.shape[0]
+    shape = src_images.shape[1:]
+    if target_freq.shape[-2:] != shape:
+        raise ValueError("Error: images must really be same size for "
+                         "register_translation_batch")
+
+    src_freq = template_spectrum(src_images)
+    if target_freq.ndim == 3 and len(target_freq) != num_images:
+        # the targets repeat along the stack, e.g. the patches of the template
+        image_product = (src_freq.reshape((-1,) + target_freq.shape) *
+                         target_freq.conj()).reshape(src_freq.shape)
+    else:
+        image_product = src_freq * target_freq.conj()
+    cross_correlation = scipy.fft.ifft2(image_product)
+
+    # Locate maximum within the admissible region
+    if (shifts_lb is not None) or (shifts_ub is not None):
+        shifts_lb = np.broadcast_to(shifts_lb, (num_images, 2))
+        shifts_ub = np.broadcast_to(shifts_ub, (num_images, 2))
+        mask_0 = np.array([_bounds_mask(shape[0], lb, ub)
+                           for lb, ub in zip(shifts_lb[:, 0], shifts_ub[:, 0])])
+        mask_1 = np.array([_bounds_mask(shape[1], lb, ub)
+                           for lb, ub in zip(shifts_lb[:, 1], shifts_ub[:, 1])])
+    else:
+        mask_0 = np.ones((1, shape[0]), dtype=bool)
+        mask_0[:, max_shifts[0]:-max_shifts[0]] = False
+        mask_1 = np.ones((1, shape[1]), dtype=bool)
+        mask_1[:, max_shifts[1]:-max_shifts[1]] = False
+
+    # only the rows and columns admissible for some image need to be searched
+    rows = np.flatnonzero(mask_0.any(0))
+    cols = np.flatnonzero(mask_1.any(0))
+    new_cross_corr = np.abs(cross_correlation[:, rows][:, :, cols])
+    new_cross_corr *= mask_0[:, rows, None] & mask_1[:, None, cols]
+    maxima = np.unravel_index(np.argmax(new_cross_corr.reshape(num_images, -1), axis=1),
+                              (len(rows), len(cols)))
+    midpoints = np.array([np.fix(axis_size//2) for axis_size in shape])
+
+    shifts = np.stack([rows[maxima[0]], cols[maxima[1]]], axis=1).astype(np.float64)
+    shifts = np.where(shifts > midpoints, shifts - np.array(shape), shifts)
+
+    if upsample_factor == 1:
+        CCmax = cross_correlation.reshape(num_images, -1).max(axis=1)
+    # If upsampling > 1, then refine estimate with matrix multiply DFT
+    else:
+        # Initial shift estimate in upsampled grid
+        shifts = np.round(shifts * upsample_factor) / upsample_factor
+        upsampled_region_size = int(np.ceil(upsample_factor * 1.5))
+        # Center of output array at dftshift + 1
+        dftshift = np.fix(upsampled_region_size/2.)
+        upsample_factor = np.array(upsample_factor, dtype=np.float64)
+        normalization = (np.prod(shape) * upsample_factor ** 2)
+        # Matrix multiply DFT around the current shift estimate. The kernels of
+        # _upsampled_dft factor into a part shared by all images and a per image
+        # phase ramp given by the offset. The kernels are conjugated rather than
+        # the (large) cross-power spectrum, i.e. conj(R conj(X) C) = conj(R) X conj(C)
+        sample_region_offset = dftshift - shifts * upsample_factor
+        region = np.arange(upsampled_region_size)
+        freqs_0 = ifftshift(np.arange(shape[0])) - np.floor(shape[0] // 2)
+        freqs_1 = ifftshift(np.arange(shape[1])) - np.floor(shape[1] // 2)
+        scale_0 = 1j * 2 * np.pi / (shape[0] * upsample_factor)
+        scale_1 = 1j * 2 * np.pi / (shape[1] * upsample_factor)
+        row_kernel = (np.exp(scale_0 * region[:, None] * freqs_0[None, :])[None] *
+                      np.exp(-scale_0 * sample_region_offset[:, 0, None] * freqs_0[None, :])[:, None, :])
+        col_kernel = (np.exp(scale_1 * freqs_1[:, None] * region[None, :])[None] *
+                      np.exp(-scale_1 * sample_region_offset[:, 1, None] * freqs_1[None, :])[:, :, None])
+        cross_correlation = np.matmul(np.matmul(row_kernel, image_product), col_kernel)
+        cross_correlation /= normalization
+        # Locate maximum and map back to original pixel grid
+        maxima = np.unravel_index(
+            np.argmax(np.abs(cross_correlation).reshape(num_images, -1), axis=1),
+            cross_correlation.shape[1:])
+        maxima = np.stack(maxima, axis=1).astype(np.float64) - dftshift
+        shifts = shifts + (maxima / upsample_factor)
+        CCmax = cross_correlation.reshape(num_images, -1).max(axis=1)
+
+    # If its only one row or column the shift along that dimension has no
+    # effect. We set to zero.
+    for dim in range(2):
+        if shape[dim] == 1:
+            shifts[:, dim] = 0
+
+    return shifts, src_freq, _compute_phasediff(CCmax)
+
+def template_spectrum(img):
+    """ Fourier transform of an image (or of a stack of images along the last two
+    axes) normalized by the number of pixels, as used by register_translation
+
+    Args:
+        img: ndarray
+            image (d1 x d2) or stack of images (... x d1 x d2)
+
+    Returns:
+        freq: ndarray
+            complex spectrum with the same shape as img
+    """
+    img = np.asarray(img, dtype=np.float64)
+    freq = scipy.fft.fft2(img)
+    freq *= 1. / np.prod(img.shape[-2:])
+    return freq
+
 #%%
 
 def apply_shifts_dft(src_freq, shifts, diffphase, is_freq=True, border_nan=True):
@@ -1949,6 +2267,58 @@ def apply_shifts_dft(src_freq, shifts, diffphase, is_freq=True, border_nan=True)
 
     return new_img
 
+def apply_shifts_dft_batch(imgs, shifts, diffphase, border_nan=True):
+    """ apply_shifts_dft (with is_freq=False) vectorized over a stack of 2D
+    images, each shifted by its own shift and global phase
+
+    Args:
+        imgs: ndarray
+            stack of images (N x d1 x d2)
+
+        shifts: ndarray
+            shifts to apply (N x 2)
+
+        diffphase: ndarray
+            global phase differences (N,), from register_translation
+
+        border_nan : bool or string, optional
+            specifies how to deal with borders. (True, False, 'copy', 'min')
+
+    Returns:
+        new_imgs: ndarray
+            shifted images (N x d1 x d2)
+    """
+    imgs = np.asarray(imgs, dtype=np.float64)
+    num_images, nr, nc = imgs.shape
+    shifts = np.asarray(shifts, dtype=np.float64).reshape(num_images, 2)
+    diffphase = np.broadcast_to(diffphase, (num_images,))
+    Nr = ifftshift(np.arange(-np.fix(nr/2.), np.ceil(nr/2.)))
+    Nc = ifftshift(np.arange(-np.fix(nc/2.), np.ceil(nc/2.)))
+    # the phase ramp factors into a row and a column part
+    ramp_r = np.exp(-1j * 2 * np.pi * shifts[:, 0, None] * Nr[None, :] / nr)
+    ramp_c = np.exp(-1j * 2 * np.pi * shifts[:, 1, None] * Nc[None, :] / nc) * np.exp(1j * diffphase)[:, None]
+    Greg = scipy.fft.fft2(imgs) * ramp_r[:, :, None] * ramp_c[:, None, :]
+    new_imgs = np.real(scipy.fft.ifft2(Greg))
+
+    if border_nan is not False:
+        max_shifts = np.ceil(np.maximum(0, shifts)).astype(int)
+        min_shifts = np.floor(np.minimum(0, shifts)).astype(int)
+        rows, cols = np.arange(nr), np.arange(nc)
+        if border_nan == 'copy':
+            # copy the first and last valid rows, then columns, into the border
+            rows = np.clip(rows[None, :], max_shifts[:, :1], nr + min_shifts[:, :1] - 1)
+            cols = np.clip(cols[None, :], max_shifts[:, 1:], nc + min_shifts[:, 1:] - 1)
+            new_imgs = new_imgs[np.arange(num_images)[:, None, None], rows[:, :, None], cols[:, None, :]]
+        else:
+            border = (((rows[None, :] < max_shifts[:, :1]) | (rows[None, :] >= nr + min_shifts[:, :1]))[:, :, None] |
+                      ((cols[None, :] < max_shifts[:, 1:]) | (cols[None, :] >= nc + min_shifts[:, 1:]))[:, None, :])
+            if border_nan is True:
+                new_imgs[border] = np.nan
+            elif border_nan == 'min':
+                new_imgs = np.where(border, np.nanmin(new_imgs, axis=(1, 2))[:, None, None], new_imgs)
+
+    return new_imgs
+
 
 #%%
 def sliding_window(image, overlaps, strides):
@@ -1981,6 +2351,34 @@ def sliding_window(image, overlaps, strides):
             # yield the current window
             yield (dim_1, dim_2, x, y, image[x:x + windowSize[0], y:y + windowSize[1]])
 
+def sliding_window_array(image, overlaps, strides):
+    """ the patches of sliding_window as one array, gathered from a strided
+    view of the image instead of sliced one at a time
+
+    Args:
+        image: ndarray
+            image (d1 x d2), or stack of images (... x d1 x d2) cut along the
+            last two axes
+
+        overlaps, strides: tuple
+            overlaps and strides of the patches
+
+    Returns:
+        patches: ndarray
+            patches in the order of sliding_window (... x num_patches x w1 x w2)
+
+        starts: tuple of ndarray
+            top and left borders of the rows and columns of patches in the image
+    """
+    windowSize = tuple(np.add(overlaps, strides))
+    range_1 = np.array(list(range(
+        0, image.shape[-2] - windowSize[0], strides[0])) + [image.shape[-2] - windowSize[0]])
+    range_2 = np.array(list(range(
+        0, image.shape[-1] - windowSize[1], strides[1])) + [image.shape[-1] - windowSize[1]])
+    windows = np.lib.stride_tricks.sliding_window_view(image, windowSize, axis=(-2, -1))
+    patches = windows[..., range_1[:, None], range_2[None, :], :, :]
+    return patches.reshape(image.shape[:-2] + (-1,) + windowSize), (range_1, range_2)
+
 def sliding_window_3d(image, overlaps, strides):
     """ efficiently and lazily slides a window across the image
 
@@ -2029,29 +2427,29 @@ def create_weight_matrix_for_blending(img, overlaps, strides):
     Returns:
         weight_mat: normalizing weight matrix
     """
-    shapes = np.add(strides, overlaps)
-
-    max_grid_1, max_grid_2 = np.max(
-        np.array([it[:2] for it in sliding_window(img, overlaps, strides)]), 0)
-
-    for grid_1, grid_2, _, _, _ in sliding_window(img, overlaps, strides):
+    yield from blending_weights(img.shape, overlaps, strides)
 
-        weight_mat = np.ones(shapes)
-
-        if grid_1 > 0:
-            weight_mat[:overlaps[0], :] = np.linspace(
-                0, 1, overlaps[0])[:, None]
-        if grid_1 < max_grid_1:
-            weight_mat[-overlaps[0]:,
-                       :] = np.linspace(1, 0, overlaps[0])[:, None]
-        if grid_2 > 0:
-            weight_mat[:, :overlaps[1]] = weight_mat[:, :overlaps[1]
-                                                     ] * np.linspace(0, 1, overlaps[1])[None, :]
-        if grid_2 < max_grid_2:
-            weight_mat[:, -overlaps[1]:] = weight_mat[:, -
-                                                      overlaps[1]:] * np.linspace(1, 0, overlaps[1])[None, :]
-
-        yield weight_mat
+def blending_weights(shape, overlaps, strides):
+    """ weights of create_weight_matrix_for_blending as one array (num_patches x w1 x w2),
+    in the order of sliding_window. The weights are the outer product of a row and a column
+    profile, which ramp linearly over the overlaps shared with the neighboring patches
+    """
+    shapes = np.add(strides, overlaps)
+    profiles = []
+    for d in range(2):
+        num_patches = len(range(0, shape[d] - shapes[d], strides[d])) + 1
+        profile = np.ones((num_patches, shapes[d]))
+        if overlaps[d] > 0:
+            profile[1:, :overlaps[d]] = np.linspace(0, 1, overlaps[d])
+            # as in create_weight_matrix_for_blending the ramps overwrite each other along
+            # the first axis and multiply along the second, when the overlaps exceed the strides
+            if d == 0:
+                profile[:-1, -overlaps[d]:] = np.linspace(1, 0, overlaps[d])
+            else:
+                profile[:-1, -overlaps[d]:] = profile[:-1, -overlaps[d]:] * np.linspace(1, 0, overlaps[d])
+        profiles.append(profile)
+    weights = profiles[0][:, None, :, None] * profiles[1][None, :, None, :]
+    return weights.reshape((-1,) + tuple(shapes))
 
 def high_pass_filter_space(img_orig, gSig_filt=None, freq=None, order=None):
     """
@@ -2103,7 +2501,7 @@ def high_pass_filter_space(img_orig, gSig_filt=None, freq=None, order=None):
 
 def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=None, newstrides=None, upsample_factor_grid=4,
                      upsample_factor_fft=10, show_movie=False, max_deviation_rigid=2, add_to_movie=0, shifts_opencv=False, gSig_filt=None,
-                     use_cuda=False, border_nan=True):
+                     use_cuda=False, border_nan=True, pyramid_levels=0):
     """ perform piecewise rigid motion correction iteration, by
         1) dividing the FOV in patches
         2) motion correcting each patch separately
@@ -2154,6 +2552,10 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
         border_nan : bool or string, optional
             specifies how to deal with borders. (True, False, 'copy', 'min')
 
+        pyramid_levels: int, default: 0
+            if > 0, the rigid shift is estimated coarse to fine with
+            register_translation_pyramid on images downsampled by 2**pyramid_levels
+
     Returns:
         (new_img, total_shifts, start_step, xy_grid)
             new_img: ndarray, corrected image
@@ -2173,8 +2575,16 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
     template = template + add_to_movie
 
     # compute rigid shifts
-    rigid_shts, sfr_freq, diffphase = register_translation(
-        img, template, upsample_factor=upsample_factor_fft, max_shifts=max_shifts, use_cuda=use_cuda)
+    if pyramid_levels > 0:
+        rigid_shts, sfr_freq, diffphase = register_translation_pyramid(
+            img, template, upsample_factor=upsample_factor_fft, max_shifts=max_shifts,
+            levels=pyramid_levels, use_cuda=use_cuda)
+        sfr_freq = img     # only the spectrum of a window was computed
+        is_freq = False
+    else:
+        rigid_shts, sfr_freq, diffphase = register_translation(
+            img, template, upsample_factor=upsample_factor_fft, max_shifts=max_shifts, use_cuda=use_cuda)
+        is_freq = True
 
     if max_deviation_rigid == 0:
 
@@ -2192,19 +2602,15 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
                     'The use of FFT and filtering options have not been tested. Set opencv=True')
 
             new_img = apply_shifts_dft(
-                sfr_freq, (-rigid_shts[0], -rigid_shts[1]), diffphase, border_nan=border_nan)
+                sfr_freq, (-rigid_shts[0], -rigid_shts[1]), diffphase, is_freq=is_freq, border_nan=border_nan)
 
         return new_img - add_to_movie, (-rigid_shts[0], -rigid_shts[1]), None, None
     else:
         # extract patches
-        templates = [
-            it[-1] for it in sliding_window(template, overlaps=overlaps, strides=strides)]
-        xy_grid = [(it[0], it[1]) for it in sliding_window(
-            template, overlaps=overlaps, strides=strides)]
-        num_tiles = np.prod(np.add(xy_grid[-1], 1))
-        imgs = [it[-1]
-                for it in sliding_window(img, overlaps=overlaps, strides=strides)]
-        dim_grid = tuple(np.add(xy_grid[-1], 1))
+        templates, starts = sliding_window_array(template, overlaps=overlaps, strides=strides)
+        imgs = sliding_window_array(img, overlaps=overlaps, strides=strides)[0]
+        dim_grid = tuple(len(st) for st in starts)
+        num_tiles = np.prod(dim_grid)
 
         if max_deviation_rigid is not None:
 
@@ -2219,132 +2625,479 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
             ub_shifts = None
 
         # extract shifts for each patch
-        shfts_et_all = [register_translation(
-            a, b, c, shifts_lb=lb_shifts, shifts_ub=ub_shifts, max_shifts=max_shifts, use_cuda=use_cuda) for a, b, c in zip(
-            imgs, templates, [upsample_factor_fft] * num_tiles)]
-        shfts = [sshh[0] for sshh in shfts_et_all]
-        diffs_phase = [sshh[2] for sshh in shfts_et_all]
-        # create a vector field
-        shift_img_x = np.reshape(np.array(shfts)[:, 0], dim_grid)
-        shift_img_y = np.reshape(np.array(shfts)[:, 1], dim_grid)
-        diffs_phase_grid = np.reshape(np.array(diffs_phase), dim_grid)
+        if HAS_CUDA and use_cuda:
+            shfts_et_all = [register_translation(
+                a, b, c, shifts_lb=lb_shifts, shifts_ub=ub_shifts, max_shifts=max_shifts, use_cuda=use_cuda) for a, b, c in zip(
+                imgs, templates, [upsample_factor_fft] * num_tiles)]
+            shfts = [sshh[0] for sshh in shfts_et_all]
+            diffs_phase = [sshh[2] for sshh in shfts_et_all]
+        else:
+            shfts, _, diffs_phase = register_translation_batch(
+                imgs, template_spectrum(templates), upsample_factor=upsample_factor_fft,
+                shifts_lb=lb_shifts, shifts_ub=ub_shifts, max_shifts=max_shifts)
 
         if shifts_opencv:
             if gSig_filt is not None:
                 img = img_orig
+        elif gSig_filt is not None:
+            raise Exception(
+                'The use of FFT and filtering options have not been tested. Set opencv=True')
 
-            dims = img.shape
-            x_grid, y_grid = np.meshgrid(np.arange(0., dims[1]).astype(
-                np.float32), np.arange(0., dims[0]).astype(np.float32))
-            m_reg = cv2.remap(img, cv2.resize(shift_img_y.astype(np.float32), dims[::-1]) + x_grid,
-                              cv2.resize(shift_img_x.astype(np.float32), dims[::-1]) + y_grid,
-                              cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
-                             # borderValue=add_to_movie)
-            total_shifts = [
-                    (-x, -y) for x, y in zip(shift_img_x.reshape(num_tiles), shift_img_y.reshape(num_tiles))]
-            return m_reg - add_to_movie, total_shifts, None, None
+        new_img, total_shifts, start_step, xy_grid = _apply_shifts_piecewise(
+            img, shfts, diffs_phase, dim_grid, strides, overlaps, newoverlaps=newoverlaps,
+            newstrides=newstrides, upsample_factor_grid=upsample_factor_grid,
+            shifts_opencv=shifts_opencv, border_nan=border_nan)
+        if shifts_opencv:
+            return new_img - add_to_movie, total_shifts, None, None
 
-        # create automatically upsample parameters if not passed
-        if newoverlaps is None:
-            newoverlaps = overlaps
-        if newstrides is None:
-            newstrides = tuple(
-                np.round(np.divide(strides, upsample_factor_grid)).astype(int))
+        if show_movie:
+            img = apply_shifts_dft(
+                sfr_freq, (-rigid_shts[0], -rigid_shts[1]), diffphase, is_freq=is_freq, border_nan=border_nan)
+            img_show = np.vstack([new_img, img])
 
-        newshapes = np.add(newstrides, newoverlaps)
+            img_show = cv2.resize(img_show, None, fx=1, fy=1)
 
-        imgs = [it[-1]
-                for it in sliding_window(img, overlaps=newoverlaps, strides=newstrides)]
+            cv2.imshow('frame', img_show / np.percentile(template, 99))
+            cv2.waitKey(int(1. / 500 * 1000))
 
-        xy_grid = [(it[0], it[1]) for it in sliding_window(
-            img, overlaps=newoverlaps, strides=newstrides)]
+        else:
+            try:
+                cv2.destroyAllWindows()
+            except:
+                pass
+        return new_img - add_to_movie, total_shifts, start_step, xy_grid
 
-        start_step = [(it[2], it[3]) for it in sliding_window(
-            img, overlaps=newoverlaps, strides=newstrides)]
+def _apply_shifts_piecewise(img, shfts, diffs_phase, dim_grid, strides, overlaps, newoverlaps=None,
+                            newstrides=None, upsample_factor_grid=4, shifts_opencv=False, border_nan=True,
+                            weight_matrix=None):
+    """ apply the shifts estimated for each patch of the image, either by remapping the
+    upsampled vector field with opencv or by shifting upsampled patches in the Fourier
+    domain and blending them back together
 
-        dim_new_grid = tuple(np.add(xy_grid[-1], 1))
+    Args:
+        img: ndarray 2D
+            image to correct
 
-        shift_img_x = cv2.resize(
-            shift_img_x, dim_new_grid[::-1], interpolation=cv2.INTER_CUBIC)
-        shift_img_y = cv2.resize(
-            shift_img_y, dim_new_grid[::-1], interpolation=cv2.INTER_CUBIC)
-        diffs_phase_grid_us = cv2.resize(
-            diffs_phase_grid, dim_new_grid[::-1], interpolation=cv2.INTER_CUBIC)
+        shfts: list
+            shifts estimated for each patch
 
-        num_tiles = np.prod(dim_new_grid)
+        diffs_phase: list
+            global phase difference estimated for each patch
 
-        max_shear = np.percentile(
-            [np.max(np.abs(np.diff(ssshh, axis=xxsss))) for ssshh, xxsss in itertools.product(
-                [shift_img_x, shift_img_y], [0, 1])], 75)
+        dim_grid: tuple
+            dimensions of the grid of patches
+
+        strides, overlaps: tuple
+            strides and overlaps of the patches used to estimate the shifts
+
+        newstrides, newoverlaps, upsample_factor_grid:
+            see tile_and_correct
+
+        shifts_opencv: bool
+            apply the shifts with cv2.remap
 
+        border_nan : bool or string, optional
+            specifies how to deal with borders. (True, False, 'copy', 'min')
+
+        weight_matrix: ndarray or None
+            precomputed blending weights of the upsampled patches, see blending_weights
+
+    Returns:
+        (new_img, total_shifts, start_step, xy_grid)
+    """
+    num_tiles = np.prod(dim_grid)
+    # create a vector field
+    shift_img_x = np.reshape(np.array(shfts)[:, 0], dim_grid)
+    shift_img_y = np.reshape(np.array(shfts)[:, 1], dim_grid)
+    diffs_phase_grid = np.reshape(np.array(diffs_phase), dim_grid)
+
+    if shifts_opencv:
+        dims = img.shape
+        x_grid, y_grid = np.meshgrid(np.arange(0., dims[1]).astype(
+            np.float32), np.arange(0., dims[0]).astype(np.float32))
+        m_reg = cv2.remap(img, cv2.resize(shift_img_y.astype(np.float32), dims[::-1]) + x_grid,
+                          cv2.resize(shift_img_x.astype(np.float32), dims[::-1]) + y_grid,
+                          cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+                         # borderValue=add_to_movie)
         total_shifts = [
-            (-x, -y) for x, y in zip(shift_img_x.reshape(num_tiles), shift_img_y.reshape(num_tiles))]
-        total_diffs_phase = [
-            dfs for dfs in diffs_phase_grid_us.reshape(num_tiles)]
+                (-x, -y) for x, y in zip(shift_img_x.reshape(num_tiles), shift_img_y.reshape(num_tiles))]
+        return m_reg, total_shifts, None, None
+
+    # create automatically upsample parameters if not passed
+    if newoverlaps is None:
+        newoverlaps = overlaps
+    if newstrides is None:
+        newstrides = tuple(
+            np.round(np.divide(strides, upsample_factor_grid)).astype(int))
+
+    newshapes = np.add(newstrides, newoverlaps)
+
+    imgs, (starts_1, starts_2) = sliding_window_array(img, overlaps=newoverlaps, strides=newstrides)
+    dim_new_grid = (len(starts_1), len(starts_2))
+    xy_grid = list(itertools.product(range(dim_new_grid[0]), range(dim_new_grid[1])))
+    start_step = list(itertools.product(starts_1.tolist(), starts_2.tolist()))
+
+    shift_img_x = cv2.resize(
+        shift_img_x, dim_new_grid[::-1], interpolation=cv2.INTER_CUBIC)
+    shift_img_y = cv2.resize(
+        shift_img_y, dim_new_grid[::-1], interpolation=cv2.INTER_CUBIC)
+    diffs_phase_grid_us = cv2.resize(
+        diffs_phase_grid, dim_new_grid[::-1], interpolation=cv2.INTER_CUBIC)
+
+    num_tiles = np.prod(dim_new_grid)
+
+    max_shear = np.percentile(
+        [np.max(np.abs(np.diff(ssshh, axis=xxsss))) for ssshh, xxsss in itertools.product(
+            [shift_img_x, shift_img_y], [0, 1])], 75)
+
+    total_shifts = [
+        (-x, -y) for x, y in zip(shift_img_x.reshape(num_tiles), shift_img_y.reshape(num_tiles))]
+
+    imgs = apply_shifts_dft_batch(imgs, -np.stack([shift_img_x.reshape(num_tiles), shift_img_y.reshape(num_tiles)], 1),
+                                  diffs_phase_grid_us.reshape(num_tiles), border_nan=border_nan)
+
+    new_img = np.zeros_like(img) * np.nan
+
+    if weight_matrix is None:
+        weight_matrix = blending_weights(img.shape, newoverlaps, newstrides)
+
+    if max_shear < 0.5:
+        # add the weighted patches (and the weights of their valid pixels) into the image at once
+        pixels = ((starts_1[:, None] + np.arange(newshapes[0]))[:, None, :, None] * img.shape[1] +
+                  (starts_2[:, None] + np.arange(newshapes[1]))[None, :, None, :]).ravel()
+        valid = ~np.isnan(imgs)
+        normalizer = np.bincount(pixels, weights=(valid * weight_matrix).ravel(), minlength=img.size)
+        new_img = np.bincount(pixels, weights=np.where(valid, imgs * weight_matrix, 0).ravel(),
+                              minlength=img.size)
+        with np.errstate(invalid='ignore'):
+            new_img = np.reshape(new_img / normalizer, img.shape)
+
+    else:  # in case the difference in shift between neighboring patches is larger than 0.5 pixels we do not interpolate in the overlaping area
+        half_overlap_x = int(newoverlaps[0] / 2)
+        half_overlap_y = int(newoverlaps[1] / 2)
+        for (x, y), (idx_0, idx_1), im, (_, _), weight_mat in zip(start_step, xy_grid, imgs, total_shifts, weight_matrix):
+
+            if idx_0 == 0:
+                x_start = x
+            else:
+                x_start = x + half_overlap_x
 
-        if gSig_filt is not None:
-            raise Exception(
-                'The use of FFT and filtering options have not been tested. Set opencv=True')
+            if idx_1 == 0:
+                y_start = y
+            else:
+                y_start = y + half_overlap_y
 
-        imgs = [apply_shifts_dft(im, (
-            sh[0], sh[1]), dffphs, is_freq=False, border_nan=border_nan) for im, sh, dffphs in zip(
-            imgs, total_shifts, total_diffs_phase)]
+            x_end = x + newshapes[0]
+            y_end = y + newshapes[1]
+            new_img[x_start:x_end,
+                    y_start:y_end] = im[x_start - x:, y_start - y:]
+    return new_img, total_shifts, start_step, xy_grid
 
-        normalizer = np.zeros_like(img) * np.nan
-        new_img = np.zeros_like(img) * np.nan
+class PrecomputedTemplate(object):
+    """
+    Quantities derived from a motion correction template that are the same for
+    every frame registered against it: the spectrum of the template, the spectra
+    of its patches and the weights used to blend the corrected patches back
+    together. Build it once and pass it to tile_and_correct_batch in place of
+    the template.
+
+    Calling share() moves the arrays into shared memory, so that pickling the
+    object (e.g. when sending it to the processes of a multiprocessing Pool)
+    only transfers the names of the shared blocks and workers attach without
+    copying. The process that called share() must call unlink() once the
+    workers are done.
+    """
 
-        weight_matrix = create_weight_matrix_for_blending(
-            img, newoverlaps, newstrides)
+    _arrays = ('template', 'freq', 'patches_freq', 'weight_matrix')
 
-        if max_shear < 0.5:
-            for (x, y), (_, _), im, (_, _), weight_mat in zip(start_step, xy_grid, imgs, total_shifts, weight_matrix):
+    def __init__(self, template, strides=None, overlaps=None, max_deviation_rigid=0, add_to_movie=0,
+                 newoverlaps=None, newstrides=None, upsample_factor_grid=4):
+        """
+        Args:
+            template: ndarray 2D
+                reference image
 
-                prev_val_1 = normalizer[x:x + newshapes[0], y:y + newshapes[1]]
+            strides, overlaps: tuple
+                strides and overlaps of the patches, only used if max_deviation_rigid != 0
 
-                normalizer[x:x + newshapes[0], y:y + newshapes[1]] = np.nansum(
-                    np.dstack([~np.isnan(im) * 1 * weight_mat, prev_val_1]), -1)
-                prev_val = new_img[x:x + newshapes[0], y:y + newshapes[1]]
-                new_img[x:x + newshapes[0], y:y + newshapes[1]
-                        ] = np.nansum(np.dstack([im * weight_mat, prev_val]), -1)
+            max_deviation_rigid: int
+                maximum deviation in shifts of each patch from the rigid shift. If 0 only
+                the spectrum of the whole template is computed
 
-            new_img = new_img / normalizer
+            add_to_movie: float
+                offset added to the template (and to the frames) before registration
 
-        else:  # in case the difference in shift between neighboring patches is larger than 0.5 pixels we do not interpolate in the overlaping area
-            half_overlap_x = int(newoverlaps[0] / 2)
-            half_overlap_y = int(newoverlaps[1] / 2)
-            for (x, y), (idx_0, idx_1), im, (_, _), weight_mat in zip(start_step, xy_grid, imgs, total_shifts, weight_matrix):
+            newoverlaps, newstrides, upsample_factor_grid:
+                parameters of the upsampled grid of patches, see tile_and_correct
+        """
+        self.add_to_movie = add_to_movie
+        self.template = template.astype(np.float64) + add_to_movie
+        self.freq = template_spectrum(self.template)
+        self.patches_freq = None
+        self.weight_matrix = None
+        self.dim_grid = None
+        self._shm = None
+        if max_deviation_rigid != 0:
+            patches, starts = sliding_window_array(self.template, overlaps=overlaps, strides=strides)
+            self.dim_grid = tuple(len(st) for st in starts)
+            self.patches_freq = template_spectrum(patches)
+            if newoverlaps is None:
+                newoverlaps = overlaps
+            if newstrides is None:
+                newstrides = tuple(
+                    np.round(np.divide(strides, upsample_factor_grid)).astype(int))
+            self.weight_matrix = blending_weights(self.template.shape, newoverlaps, newstrides)
+
+    @property
+    def shape(self):
+        return self.template.shape
+
+    def share(self):
+        """ move the arrays into shared memory
+        """
+        from multiprocessing import shared_memory
+        if self._shm is not None:
+            return self
+        self._shm = {}
+        for name in self._arrays:
+            arr = getattr(self, name)
+            if arr is None:
+                continue
+            shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+            shared[:] = arr
+            setattr(self, name, shared)
+            self._shm[name] = shm
+        return self
 
-                if idx_0 == 0:
-                    x_start = x
-                else:
-                    x_start = x + half_overlap_x
+    def unlink(self):
+        """ release the shared memory blocks created by share(). The arrays are copied
+        back to private memory so that the object remains usable
+        """
+        if self._shm is None:
+            return
+        for name, shm in self._shm.items():
+            setattr(self, name, np.array(getattr(self, name)))
+            shm.close()
+            shm.unlink()
+        self._shm = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_attached', None)
+        if self._shm is not None:
+            state['_shm'] = {name: (shm.name, getattr(self, name).shape, getattr(self, name).dtype.str)
+                             for name, shm in self._shm.items()}
+            for name in self._shm:
+                state[name] = None
+        return state
+
+    def __setstate__(self, state):
+        shared = state.pop('_shm')
+        self.__dict__.update(state)
+        self._shm = None
+        if shared is not None:
+            from caiman.cluster import attach_shared_memory
+            # keep references to the blocks, the arrays are only views
+            self._attached = []
+            for name, (shm_name, shape, dtype) in shared.items():
+                shm = attach_shared_memory(shm_name)
+                self._attached.append(shm)
+                setattr(self, name, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+def tile_and_correct_batch(imgs, template, strides, overlaps, max_shifts, newoverlaps=None, newstrides=None,
+                           upsample_factor_grid=4, upsample_factor_fft=10, max_deviation_rigid=2, add_to_movie=0,
+                           shifts_opencv=False, gSig_filt=None, border_nan=True):
+    """ perform piecewise rigid motion correction on a batch of frames. Equivalent to calling
+    tile_and_correct on each frame, but the registration of all frames (and of all their
+    patches) against the template is vectorized, and the spectra of the template and of its
+    patches are computed only once for the whole batch
 
-                if idx_1 == 0:
-                    y_start = y
-                else:
-                    y_start = y + half_overlap_y
+    Args:
+        imgs: ndarray 3D
+            frames to correct (T x d1 x d2)
 
-                x_end = x + newshapes[0]
-                y_end = y + newshapes[1]
-                new_img[x_start:x_end,
-                        y_start:y_end] = im[x_start - x:, y_start - y:]
+        template: ndarray or PrecomputedTemplate
+            reference image, or its precomputed spectra and blending weights. In the latter
+            case it must have been built with the same parameters (and add_to_movie)
 
-        if show_movie:
-            img = apply_shifts_dft(
-                sfr_freq, (-rigid_shts[0], -rigid_shts[1]), diffphase, border_nan=border_nan)
-            img_show = np.vstack([new_img, img])
+        strides, overlaps, max_shifts, newoverlaps, newstrides, upsample_factor_grid, upsample_factor_fft,
+        max_deviation_rigid, add_to_movie, shifts_opencv, gSig_filt, border_nan:
+            see tile_and_correct
 
-            img_show = cv2.resize(img_show, None, fx=1, fy=1)
+    Returns:
+        list of (new_img, total_shifts, start_step, xy_grid), one per frame, see tile_and_correct
+    """
+    imgs = np.array(imgs, dtype=np.float64)
+    if not isinstance(template, PrecomputedTemplate):
+        template = PrecomputedTemplate(template, strides, overlaps, max_deviation_rigid=max_deviation_rigid,
+                                       add_to_movie=add_to_movie, newoverlaps=newoverlaps, newstrides=newstrides,
+                                       upsample_factor_grid=upsample_factor_grid)
 
-            cv2.imshow('frame', img_show / np.percentile(template, 99))
-            cv2.waitKey(int(1. / 500 * 1000))
+    if gSig_filt is not None:
+        imgs_orig = imgs.copy()
+        imgs = np.array([high_pass_filter_space(img, gSig_filt) for img in imgs_orig])
 
+    imgs = imgs + add_to_movie
+    if gSig_filt is not None and shifts_opencv:
+        imgs_apply = imgs_orig
+    elif gSig_filt is not None:
+        raise Exception(
+            'The use of FFT and filtering options have not been tested. Set opencv=True')
+    else:
+        imgs_apply = imgs
+
+    # compute rigid shifts
+    rigid_shts, sfr_freqs, diffphases = register_translation_batch(
+        imgs, template.freq, upsample_factor=upsample_factor_fft, max_shifts=max_shifts)
+
+    res = []
+    if max_deviation_rigid == 0:
+        for img, rigid_sht, sfr_freq, diffphase in zip(imgs_apply, rigid_shts, sfr_freqs, diffphases):
+            if shifts_opencv:
+                new_img = apply_shift_iteration(
+                    img, (-rigid_sht[0], -rigid_sht[1]), border_nan=border_nan)
+            else:
+                new_img = apply_shifts_dft(
+                    sfr_freq, (-rigid_sht[0], -rigid_sht[1]), diffphase, border_nan=border_nan)
+            res.append((new_img - add_to_movie, (-rigid_sht[0], -rigid_sht[1]), None, None))
+        return res
+
+    # extract patches, the template spectra are shared by all frames
+    dim_grid = template.dim_grid
+    num_tiles = np.prod(dim_grid)
+    patches = sliding_window_array(imgs, overlaps=overlaps, strides=strides)[0]
+    patch_shape = patches.shape[2:]
+
+    if max_deviation_rigid is not None:
+        lb_shifts = np.repeat(np.ceil(np.subtract(
+            rigid_shts, max_deviation_rigid)).astype(int), num_tiles, axis=0)
+        ub_shifts = np.repeat(np.floor(
+            np.add(rigid_shts, max_deviation_rigid)).astype(int), num_tiles, axis=0)
+    else:
+        lb_shifts = None
+        ub_shifts = None
+
+    # extract shifts for each patch of each frame
+    shfts, _, diffs_phase = register_translation_batch(
+        patches.reshape((-1,) + patch_shape),
+        template.patches_freq, upsample_factor=upsample_factor_fft,
+        shifts_lb=lb_shifts, shifts_ub=ub_shifts, max_shifts=max_shifts)
+    shfts = shfts.reshape(len(imgs), num_tiles, 2)
+    diffs_phase = diffs_phase.reshape(len(imgs), num_tiles)
+
+    for img, shft, diff_phase in zip(imgs_apply, shfts, diffs_phase):
+        new_img, total_shifts, start_step, xy_grid = _apply_shifts_piecewise(
+            img, shft, diff_phase, dim_grid, strides, overlaps, newoverlaps=newoverlaps,
+            newstrides=newstrides, upsample_factor_grid=upsample_factor_grid,
+            shifts_opencv=shifts_opencv, border_nan=border_nan, weight_matrix=template.weight_matrix)
+        if shifts_opencv:
+            res.append((new_img - add_to_movie, total_shifts, None, None))
         else:
-            try:
-                cv2.destroyAllWindows()
-            except:
-                pass
-        return new_img - add_to_movie, total_shifts, start_step, xy_grid
+            res.append((new_img - add_to_movie, total_shifts, start_step, xy_grid))
+    return res
+
+def tile_and_correct_flow(img, template, strides, overlaps, max_shifts, add_to_movie=0, gSig_filt=None,
+                          border_nan=True, downsample=1, pyr_scale=.5, levels=3, winsize=32, iterations=3,
+                          poly_n=5, poly_sigma=1.1, refinements=1):
+    """ perform dense nonrigid motion correction of a frame by
+        1) estimating the rigid shift with register_translation
+        2) estimating the dense displacement field (optical flow) between the template
+           and the frame with cv2.calcOpticalFlowFarneback, starting from the rigid shift,
+           optionally on downsampled images
+        3) warping the frame with the displacement field and estimating the residual
+           displacements, refinements times, since a single estimate underestimates them
+        4) warping the frame with cv2.remap
+
+    The displacements averaged over the patches of the grid defined by strides and
+    overlaps are returned in place of the patch shifts of tile_and_correct, so that
+    they can be used as the shifts of pw-rigid motion correction
+
+    Args:
+        img: ndarray 2D
+            image to correct
+
+        template: ndarray
+            reference image
+
+        strides, overlaps: tuple
+            strides and overlaps of the patches over which the displacements are averaged
+
+        max_shifts: tuple
+            max shifts in x and y of the rigid shift
+
+        add_to_movie: float
+            offset added to the image before the rigid registration
+
+        gSig_filt: int or None
+            if given, the displacements are estimated on the image high pass filtered (the
+            template must already be filtered), and applied to the original image
+
+        border_nan : bool or string, optional
+            specifies how to deal with borders. (True, False, 'copy', 'min')
+
+        downsample: int
+            the optical flow is estimated on the images downsampled by this factor,
+            and upsampled to the size of the image
+
+        pyr_scale, levels, winsize, iterations, poly_n, poly_sigma:
+            parameters of cv2.calcOpticalFlowFarneback (winsize at the downsampled resolution)
+
+        refinements: int
+            number of estimates of the residual displacements after warping the frame
+
+    Returns:
+        (new_img, total_shifts, start_step, xy_grid), see tile_and_correct. start_step is None
+    """
+    img = img.astype(np.float32)
+    template = template.astype(np.float32)
+    img_reg = high_pass_filter_space(img, gSig_filt).astype(np.float32) if gSig_filt is not None else img
+    dims = img.shape
+
+    rigid_shts = register_translation(img_reg + add_to_movie, template + add_to_movie,
+                                      max_shifts=max_shifts)[0]
+    if downsample > 1:
+        dims_ds = (max(dims[0] // downsample, 1), max(dims[1] // downsample, 1))
+        img_reg = cv2.resize(img_reg, dims_ds[::-1], interpolation=cv2.INTER_AREA)
+        template = cv2.resize(template, dims_ds[::-1], interpolation=cv2.INTER_AREA)
+    else:
+        dims_ds = dims
+    scale = np.divide(dims_ds, dims)
+    # flow (x, y) such that template(p) ~ img(p + flow(p)), starting from the rigid shift
+    flow = np.empty(dims_ds + (2,), dtype=np.float32)
+    flow[..., 0] = rigid_shts[1] * scale[1]
+    flow[..., 1] = rigid_shts[0] * scale[0]
+    flow = cv2.calcOpticalFlowFarneback(template, img_reg, flow, pyr_scale, levels, winsize, iterations,
+                                        poly_n, poly_sigma, cv2.OPTFLOW_USE_INITIAL_FLOW)
+    # the polynomial expansion shrinks the displacements: warp the frame and compose
+    # the flow with the residual one, img_reg(p + flow(p + res(p)) + res(p)) ~ template(p)
+    x_grid, y_grid = np.meshgrid(np.arange(0., dims_ds[1]).astype(np.float32),
+                                 np.arange(0., dims_ds[0]).astype(np.float32))
+    for _ in range(refinements):
+        warped = cv2.remap(img_reg, x_grid + flow[..., 0], y_grid + flow[..., 1], cv2.INTER_CUBIC,
+                           borderMode=cv2.BORDER_REPLICATE)
+        res = cv2.calcOpticalFlowFarneback(template, warped, None, pyr_scale, 1, winsize, iterations,
+                                           poly_n, poly_sigma, 0)
+        flow = res + cv2.remap(flow, x_grid + res[..., 0], y_grid + res[..., 1], cv2.INTER_LINEAR,
+                               borderMode=cv2.BORDER_REPLICATE)
+    if downsample > 1:
+        flow = cv2.resize(flow, dims[::-1], interpolation=cv2.INTER_LINEAR) / scale[::-1].astype(np.float32)
+        x_grid, y_grid = np.meshgrid(np.arange(0., dims[1]).astype(np.float32),
+                                     np.arange(0., dims[0]).astype(np.float32))
+    if border_nan is True:
+        border = dict(borderMode=cv2.BORDER_CONSTANT, borderValue=np.nan)
+    elif border_nan == 'min':
+        border = dict(borderMode=cv2.BORDER_CONSTANT, borderValue=float(np.min(img)))
+    else:
+        border = dict(borderMode=cv2.BORDER_REPLICATE)
+    new_img = cv2.remap(img, x_grid + flow[..., 0], y_grid + flow[..., 1], cv2.INTER_CUBIC, **border)
+
+    # displacements averaged over the patches, with the sign of the shifts of tile_and_correct
+    patches, starts = sliding_window_array(flow.transpose(2, 0, 1), overlaps=overlaps, strides=strides)
+    mean_flow = patches.mean(axis=(-2, -1))
+    total_shifts = [(-y, -x) for x, y in zip(mean_flow[0], mean_flow[1])]
+    xy_grid = list(itertools.product(range(len(starts[0])), range(len(starts[1]))))
+    return new_img, total_shifts, None, xy_grid
 
 #%%
 def tile_and_correct_3d(img:np.ndarray, template:np.ndarray, strides:Tuple, overlaps:Tuple, max_shifts:Tuple, newoverlaps:Optional[Tuple]=None, newstrides:Optional[Tuple]=None, upsample_factor_grid:int=4,
@@ -2759,10 +3512,70 @@ def compute_metrics_motion_correction(fname, final_size_x, final_size_y, swap_di
 
 
 #%%
+def _streaming_template_rigid(fname, splits, template, num_splits_to_process=None, chunks_per_update=1,
+                              tol=1e-3, gSig_filt=None, is3D=False, **kwargs):
+    """ refine the template of rigid motion correction in a single pass over the
+    chunks of the movie, updating it as the chunks are registered: the chunks are
+    registered in groups of chunks_per_update, in random order, each group against
+    the running median (bin_median) of the means of the chunks registered so far.
+    Stops when an update changes the template by less than tol (relative norm)
+
+    Args:
+        fname: str
+            movie to register
+
+        splits: int
+            number of chunks in which the movie is subdivided
+
+        template: ndarray
+            initial template
+
+        num_splits_to_process: int or None
+            maximum number of chunks registered, all of them if None
+
+        chunks_per_update: int
+            number of chunks registered between updates of the template, e.g. the
+            number of workers of dview
+
+        tol: float
+            relative change of the template under which the refinement stops
+
+        gSig_filt, is3D, **kwargs:
+            see motion_correction_piecewise
+
+    Returns:
+        template: ndarray
+            refined template
+
+        num_chunks: int
+            number of chunks registered
+    """
+    T = cm.source_extraction.cnmf.utilities.get_file_size(fname, var_name_hdf5=kwargs.get('var_name_hdf5', 'mov'))[1]
+    idxs = np.array_split(np.arange(T), splits)
+    # random order, so that the first updates already see the whole movie
+    order = np.random.permutation(len(idxs))[:num_splits_to_process]
+    median = bin_median_3d if is3D else bin_median
+    chunk_means:List = []
+    for start in range(0, len(order), chunks_per_update):
+        res = motion_correction_piecewise(fname, [idxs[i] for i in order[start:start + chunks_per_update]],
+                                          None, None, template=template, max_deviation_rigid=0,
+                                          save_movie=False, gSig_filt=gSig_filt, is3D=is3D, **kwargs)[1]
+        chunk_means += [r[-1] for r in res]
+        new_templ = median(np.array(chunk_means), window=1)
+        if gSig_filt is not None:
+            new_templ = high_pass_filter_space(new_templ, gSig_filt)
+        change = np.linalg.norm(new_templ - template) / np.linalg.norm(template)
+        template = new_templ
+        logging.debug(f'Template updated with {len(chunk_means)} chunks, relative change {change:.2e}')
+        if change < tol and len(chunk_means) > chunks_per_update:
+            break
+    return template, len(chunk_means)
+
 def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_splits_to_process=None, num_iter=1,
                                template=None, shifts_opencv=False, save_movie_rigid=False, add_to_movie=None,
                                nonneg_movie=False, gSig_filt=None, subidx=slice(None, None, 1), use_cuda=False,
-                               border_nan=True, var_name_hdf5='mov', is3D=False, indices=(slice(None), slice(None))):
+                               border_nan=True, var_name_hdf5='mov', is3D=False, indices=(slice(None), slice(None)),
+                               fft_batch_size=None, pyramid_levels=0, streaming_template=False, out=None):
     """
     Function that perform memory efficient hyper parallelized rigid motion corrections while also saving a memory mappable file
 
@@ -2803,6 +3616,22 @@ def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_spl
         indices: tuple(slice), default: (slice(None), slice(None))
            Use that to apply motion correction only on a part of the FOV
 
+        fft_batch_size: int or None, default: None
+           If not None, frames are registered in vectorized batches of this size
+           (see tile_and_correct_batch). Ignored for 3D data and when using cuda
+
+        pyramid_levels: int, default: 0
+           if > 0, shifts are estimated coarse to fine (see register_translation_pyramid)
+
+        streaming_template: bool, default: False
+           if True and num_iter > 1, the template is refined in a single pass over the chunks
+           (or num_splits_to_process chunks), updated as groups of chunks are registered and
+           stopping once it converges, instead of num_iter - 1 passes with a fixed template
+           (see _streaming_template_rigid). The movie is then registered once more with it
+
+        out: CorrectedMemmap
+           if given, the movie is saved into it instead of a new F order file
+
     Returns:
          fname_tot_rig: str
 
@@ -2864,6 +3693,18 @@ def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_spl
     else:
         logging.debug('Adding to movie ' + str(add_to_movie))
 
+    if streaming_template and num_iter > 1:
+        # process the chunks in groups of the size of the pool, so that all the workers are busy
+        chunks_per_update = get_executor(dview).num_workers
+        new_templ, num_chunks = _streaming_template_rigid(
+            fname, splits, new_templ, num_splits_to_process=num_splits_to_process,
+            chunks_per_update=chunks_per_update, gSig_filt=gSig_filt, is3D=is3D,
+            add_to_movie=add_to_movie, max_shifts=max_shifts, dview=dview, shifts_opencv=shifts_opencv,
+            nonneg_movie=nonneg_movie, use_cuda=use_cuda, border_nan=border_nan, var_name_hdf5=var_name_hdf5,
+            indices=indices, fft_batch_size=fft_batch_size, pyramid_levels=pyramid_levels)
+        logging.info(f'Template refined on {num_chunks} of {splits} chunks')
+        num_iter = 1
+
     save_movie = False
     fname_tot_rig = None
     res_rig:List = []
@@ -2885,7 +3726,8 @@ def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_spl
                                                              dview=dview, save_movie=save_movie, base_name=base_name,
                                                              num_splits=num_splits_to_process, shifts_opencv=shifts_opencv, nonneg_movie=nonneg_movie, gSig_filt=gSig_filt,
                                                              use_cuda=use_cuda, border_nan=border_nan, var_name_hdf5=var_name_hdf5, is3D=is3D,
-                                                             indices=indices, subidx=None)
+                                                             indices=indices, subidx=None, fft_batch_size=fft_batch_size,
+                                                             pyramid_levels=pyramid_levels, out=out)
         if is3D:
             new_templ = np.nanmedian(np.stack([r[-1] for r in res_rig]), 0)           
         else:
@@ -2910,7 +3752,8 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
                                  splits=56, num_splits_to_process=None, num_iter=1,
                                  template=None, shifts_opencv=False, save_movie=False, nonneg_movie=False, gSig_filt=None,
                                  use_cuda=False, border_nan=True, var_name_hdf5='mov', is3D=False,
-                                 indices=(slice(None), slice(None))):
+                                 indices=(slice(None), slice(None)), fft_batch_size=None, engine='pwrigid',
+                                 flow_downsample=1, out=None):
     """
     Function that perform memory efficient hyper parallelized rigid motion corrections while also saving a memory mappable file
 
@@ -2960,6 +3803,21 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
         indices: tuple(slice), default: (slice(None), slice(None))
            Use that to apply motion correction only on a part of the FOV
 
+        fft_batch_size: int or None, default: None
+           If not None, frames are registered in vectorized batches of this size
+           (see tile_and_correct_batch). Ignored for 3D data and when using cuda
+
+        engine: 'pwrigid' or 'optical_flow', default: 'pwrigid'
+           registration of the frames, by the shifts of patches (tile_and_correct) or by
+           dense optical flow (tile_and_correct_flow). In the latter case the shifts returned
+           are the displacements averaged over the patches, and fft_batch_size is ignored
+
+        flow_downsample: int, default: 1
+           with engine='optical_flow', factor by which the frames are downsampled to estimate the flow
+
+        out: CorrectedMemmap
+           if given, the movie is saved into it instead of a new F order file
+
     Returns:
         fname_tot_rig: str
 
@@ -2981,6 +3839,13 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
     else:
         new_templ = template
 
+    if engine not in ('pwrigid', 'optical_flow'):
+        raise Exception('Unknown nonrigid registration engine ' + str(engine))
+    if engine == 'optical_flow':
+        if is3D:
+            raise Exception('The optical flow engine is not supported for 3D data')
+        fft_batch_size = None
+
     if np.isnan(add_to_movie):
         logging.error('The template contains NaNs. NaNs are not allowed!')
         raise Exception('The template contains NaNs. NaNs are not allowed!')
@@ -3013,7 +3878,8 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
                                                             base_name=base_name, num_splits=num_splits_to_process,
                                                             shifts_opencv=shifts_opencv, nonneg_movie=nonneg_movie, gSig_filt=gSig_filt,
                                                             use_cuda=use_cuda, border_nan=border_nan, var_name_hdf5=var_name_hdf5, is3D=is3D,
-                                                            indices=indices)
+                                                            indices=indices, fft_batch_size=fft_batch_size, engine=engine,
+                                                            flow_downsample=flow_downsample, out=out)
         if is3D:
             new_templ = np.nanmedian(np.stack([r[-1] for r in res_el]), 0)
         else:
@@ -3070,7 +3936,7 @@ def tile_and_correct_wrapper(params):
     img_name, out_fname, idxs, shape_mov, template, strides, overlaps, max_shifts,\
         add_to_movie, max_deviation_rigid, upsample_factor_grid, newoverlaps, newstrides, \
         shifts_opencv, nonneg_movie, gSig_filt, is_fiji, use_cuda, border_nan, var_name_hdf5, \
-        is3D, indices = params
+        is3D, indices, fft_batch_size, out_offset, summary_images, pyramid_levels, engine, flow_downsample = params
 
 
     if isinstance(img_name, tuple):
@@ -3085,52 +3951,159 @@ def tile_and_correct_wrapper(params):
     mc = np.zeros(imgs.shape, dtype=np.float32)
     if not imgs[0].shape == template.shape:
         template = template[indices]
-    for count, img in enumerate(imgs):
-        if count % 10 == 0:
-            logging.debug(count)
-        if is3D:
-            mc[count], total_shift, start_step, xyz_grid = tile_and_correct_3d(img, template, strides, overlaps, max_shifts,
-                                                                       add_to_movie=add_to_movie, newoverlaps=newoverlaps,
-                                                                       newstrides=newstrides,
-                                                                       upsample_factor_grid=upsample_factor_grid,
-                                                                       upsample_factor_fft=10, show_movie=False,
-                                                                       max_deviation_rigid=max_deviation_rigid,
-                                                                       shifts_opencv=shifts_opencv, gSig_filt=gSig_filt,
-                                                                       use_cuda=use_cuda, border_nan=border_nan)
-            shift_info.append([total_shift, start_step, xyz_grid])
-            
-        else:
-            mc[count], total_shift, start_step, xy_grid = tile_and_correct(img, template, strides, overlaps, max_shifts,
-                                                                       add_to_movie=add_to_movie, newoverlaps=newoverlaps,
-                                                                       newstrides=newstrides,
-                                                                       upsample_factor_grid=upsample_factor_grid,
-                                                                       upsample_factor_fft=10, show_movie=False,
-                                                                       max_deviation_rigid=max_deviation_rigid,
-                                                                       shifts_opencv=shifts_opencv, gSig_filt=gSig_filt,
-                                                                       use_cuda=use_cuda, border_nan=border_nan)
-            shift_info.append([total_shift, start_step, xy_grid])
-
+    if fft_batch_size is not None and not is3D and not (HAS_CUDA and use_cuda):
+        # register the frames in vectorized batches
+        for start in range(0, len(imgs), fft_batch_size):
+            logging.debug(start)
+            res_batch = tile_and_correct_batch(imgs[start:start + fft_batch_size], template, strides, overlaps,
+                                               max_shifts, add_to_movie=add_to_movie, newoverlaps=newoverlaps,
+                                               newstrides=newstrides, upsample_factor_grid=upsample_factor_grid,
+                                               upsample_factor_fft=10, max_deviation_rigid=max_deviation_rigid,
+                                               shifts_opencv=shifts_opencv, gSig_filt=gSig_filt,
+                                               border_nan=border_nan)
+            for count, (new_img, total_shift, start_step, xy_grid) in enumerate(res_batch, start):
+                mc[count] = new_img
+                shift_info.append([total_shift, start_step, xy_grid])
+    else:
+        for count, img in enumerate(imgs):
+            if count % 10 == 0:
+                logging.debug(count)
+            if is3D:
+                mc[count], total_shift, start_step, xyz_grid = tile_and_correct_3d(img, template, strides, overlaps, max_shifts,
+                                                                           add_to_movie=add_to_movie, newoverlaps=newoverlaps,
+                                                                           newstrides=newstrides,
+                                                                           upsample_factor_grid=upsample_factor_grid,
+                                                                           upsample_factor_fft=10, show_movie=False,
+                                                                           max_deviation_rigid=max_deviation_rigid,
+                                                                           shifts_opencv=shifts_opencv, gSig_filt=gSig_filt,
+                                                                           use_cuda=use_cuda, border_nan=border_nan)
+                shift_info.append([total_shift, start_step, xyz_grid])
+            elif engine == 'optical_flow':
+                mc[count], total_shift, start_step, xy_grid = tile_and_correct_flow(img, template, strides, overlaps,
+                                                                                max_shifts, add_to_movie=add_to_movie,
+                                                                                gSig_filt=gSig_filt, border_nan=border_nan,
+                                                                                downsample=flow_downsample)
+                shift_info.append([total_shift, start_step, xy_grid])
+            else:
+                mc[count], total_shift, start_step, xy_grid = tile_and_correct(img, template, strides, overlaps, max_shifts,
+                                                                           add_to_movie=add_to_movie, newoverlaps=newoverlaps,
+                                                                           newstrides=newstrides,
+                                                                           upsample_factor_grid=upsample_factor_grid,
+                                                                           upsample_factor_fft=10, show_movie=False,
+                                                                           max_deviation_rigid=max_deviation_rigid,
+                                                                           shifts_opencv=shifts_opencv, gSig_filt=gSig_filt,
+                                                                           use_cuda=use_cuda, border_nan=border_nan,
+                                                                           pyramid_levels=pyramid_levels)
+                shift_info.append([total_shift, start_step, xy_grid])
+
+    stats = None
     if out_fname is not None:
-        outv = np.memmap(out_fname, mode='r+', dtype=np.float32,
-                         shape=prepare_shape(shape_mov), order='F')
         if nonneg_movie:
             bias = np.float32(add_to_movie)
         else:
             bias = 0
-        outv[:, idxs] = np.reshape(
-            mc.astype(np.float32), (len(imgs), -1), order='F').T + bias
+        if out_offset is None:
+            outv = np.memmap(out_fname, mode='r+', dtype=np.float32,
+                             shape=prepare_shape(shape_mov), order='F')
+            outv[:, idxs] = np.reshape(
+                mc.astype(np.float32), (len(imgs), -1), order='F').T + bias
+        else:
+            # final C order layout, with the offset added by save_memmap (see CorrectedMemmap)
+            Y = mc + bias
+            stats = {'min': np.nanmin(Y)}
+            Y += np.float32(0.0001)
+            outv = np.memmap(out_fname, mode='r+', dtype=np.float32,
+                             shape=prepare_shape(shape_mov), order='C')
+            outv[:, idxs + out_offset] = np.reshape(Y, (len(imgs), -1), order='F').T
+            if summary_images:
+                from .summary_images import map_corr
+                valid = ~np.isnan(Y)
+                stats['sum'] = np.nansum(Y, 0, dtype=float)
+                stats['count'] = valid.sum(0)
+                stats['max'] = np.nanmax(Y, 0)
+                stats['corr'] = map_corr(np.where(valid, Y, np.nanmin(Y)))
+        del outv
     new_temp = np.nanmean(mc, 0)
     new_temp[np.isnan(new_temp)] = np.nanmin(new_temp)
+    if stats is not None:
+        return shift_info, idxs, new_temp, stats
     return shift_info, idxs, new_temp
 
+class CorrectedMemmap(object):
+    """
+    Memory mapped file in C order, in the layout of save_memmap(..., order='C'),
+    into which motion_correction_piecewise writes the corrected frames of a list
+    of movies as the chunks are processed, so that the movies are read once and
+    the corrected movie written once. The minimum of the corrected movie (for
+    border_to_0) and, with summary_images, the sums needed for the mean, max
+    and correlation images are collected from the chunks at the same time.
+    """
+
+    def __init__(self, fnames, base_name='memmap_', indices=(slice(None), slice(None)),
+                 var_name_hdf5='mov', summary_images=False):
+        Ts = []
+        for fname in fnames:
+            dims, T = cm.source_extraction.cnmf.utilities.get_file_size(fname, var_name_hdf5=var_name_hdf5)
+            Ts.append(T)
+        self.dims = np.zeros(dims)[indices].shape
+        self.T = int(np.sum(Ts))
+        self.shape = (int(np.prod(self.dims)), self.T)
+        self.offset = 0     # index of the first frame of the next movie
+        self.summary_images = summary_images
+        fname_tot = cm.paths.generate_fname_tot(base_name, self.dims, 'C') + f'_frames_{self.T}.mmap'
+        first = fnames[0][0] if isinstance(fnames[0], tuple) else fnames[0]
+        self.fname = caiman.paths.fn_relocated(os.path.join(os.path.split(first)[0], fname_tot))
+        np.memmap(self.fname, mode='w+', dtype=np.float32, shape=prepare_shape(self.shape), order='C')
+        logging.info(f'Saving file as {self.fname}')
+        self.min_mov = np.inf
+        self._sums:List = []
+
+    def collect(self, res, T):
+        """collect the statistics returned by tile_and_correct_wrapper for the
+        chunks of a movie of T frames, return the results without them"""
+        out = []
+        for shift_info, idxs, new_temp, stats in res:
+            self.min_mov = min(self.min_mov, stats['min'])
+            if self.summary_images:
+                self._sums.append(stats)
+            out.append((shift_info, idxs, new_temp))
+        self.offset += T
+        return out
+
+    def finalize(self, border_to_0=0):
+        """set the border to the minimum of the movie as save_memmap does,
+        compute the summary images and return the name of the file"""
+        if border_to_0 > 0:
+            Yr = np.memmap(self.fname, mode='r+', dtype=np.float32, shape=prepare_shape(self.shape), order='C')
+            border = np.zeros(self.dims, dtype=bool)
+            border[:border_to_0] = border[-border_to_0:] = True
+            border[:, :border_to_0] = border[:, -border_to_0:] = True
+            # value of save_memmap, see movie.calc_min
+            Yr[np.where(border.ravel(order='F'))[0]] = np.float32(self.min_mov + 1) + np.float32(0.0001)
+            Yr.flush()
+            del Yr
+        if self.summary_images:
+            from .summary_images import correlation_image_from_sums
+            self.mean_img = np.sum([st['sum'] for st in self._sums], 0) / np.maximum(
+                np.sum([st['count'] for st in self._sums], 0), 1)
+            self.max_img = np.max([st['max'] for st in self._sums], 0)
+            self.Cn = correlation_image_from_sums(*[np.sum(np.array(a), 0) for a in
+                                                    zip(*[st['corr'] for st in self._sums])])
+            self._sums = []
+        return self.fname
+
+
 def motion_correction_piecewise(fname, splits, strides, overlaps, add_to_movie=0, template=None,
                                 max_shifts=(12, 12), max_deviation_rigid=3, newoverlaps=None, newstrides=None,
                                 upsample_factor_grid=4, order='F', dview=None, save_movie=True,
                                 base_name=None, subidx = None, num_splits=None, shifts_opencv=False, nonneg_movie=False, gSig_filt=None,
                                 use_cuda=False, border_nan=True, var_name_hdf5='mov', is3D=False,
-                                indices=(slice(None), slice(None))):
+                                indices=(slice(None), slice(None)), fft_batch_size=None, pyramid_levels=0,
+                                engine='pwrigid', flow_downsample=1, out=None):
     """
-
+    Correct the chunks of frames splits of the movie fname in parallel. With
+    save_movie the corrected movie is written to a new memory mapped file in
+    the given order, or into out (CorrectedMemmap) if given.
     """
     # todo todocument
     if isinstance(fname, tuple):
@@ -3164,7 +4137,11 @@ def motion_correction_piecewise(fname, splits, strides, overlaps, add_to_movie=0
         save_movie = False
         #logging.warning('**** MOVIE NOT SAVED BECAUSE num_splits is not None ****')
 
-    if save_movie:
+    out_offset = None
+    if save_movie and out is not None:
+        fname_tot, shape_mov, out_offset = out.fname, out.shape, out.offset
+        logging.info(f'Saving frames {out_offset} to {out_offset + T} of {fname_tot}')
+    elif save_movie:
         if base_name is None:
             base_name = os.path.splitext(os.path.split(fname)[1])[0]
         base_name = caiman.paths.fn_relocated(base_name)
@@ -3181,25 +4158,40 @@ def motion_correction_piecewise(fname, splits, strides, overlaps, add_to_movie=0
     else:
         fname_tot = None
 
+    shared_template = None
+    if fft_batch_size is not None and not is3D and not (HAS_CUDA and use_cuda):
+        # compute the spectra of the template (and of its patches) and the blending
+        # weights once for all chunks
+        template = PrecomputedTemplate(template if template.shape == dims else template[indices],
+                                       strides, overlaps, max_deviation_rigid=max_deviation_rigid,
+                                       add_to_movie=np.array(add_to_movie, dtype=np.float32),
+                                       newoverlaps=newoverlaps, newstrides=newstrides,
+                                       upsample_factor_grid=upsample_factor_grid)
+        if get_executor(dview).local_processes:
+            shared_template = template.share()
+
     pars = []
     for idx in idxs:
         logging.debug(f'Processing: frames: {idx}')
         pars.append([fname, fname_tot, idx, shape_mov, template, strides, overlaps, max_shifts, np.array(
             add_to_movie, dtype=np.float32), max_deviation_rigid, upsample_factor_grid,
             newoverlaps, newstrides, shifts_opencv, nonneg_movie, gSig_filt, is_fiji,
-            use_cuda, border_nan, var_name_hdf5, is3D, indices])
+            use_cuda, border_nan, var_name_hdf5, is3D, indices, fft_batch_size,
+            out_offset, out is not None and out.summary_images, pyramid_levels, engine, flow_downsample])
 
-    if dview is not None:
-        logging.info('** Starting parallel motion correction **')
-        if HAS_CUDA and use_cuda:
-            res = dview.map(tile_and_correct_wrapper,pars)
-            dview.map(close_cuda_process, range(len(pars)))
-        elif 'multiprocessing' in str(type(dview)):
-            res = dview.map_async(tile_and_correct_wrapper, pars).get(4294967)
-        else:
-            res = dview.map_sync(tile_and_correct_wrapper, pars)
-        logging.info('** Finished parallel motion correction **')
-    else:
-        res = list(map(tile_and_correct_wrapper, pars))
+    try:
+        if dview is not None:
+            logging.info('** Starting parallel motion correction **')
+        executor = get_executor(dview)
+        res = executor.map(tile_and_correct_wrapper, pars)
+        if out_offset is not None:
+            res = out.collect(res, T)
+        if dview is not None and HAS_CUDA and use_cuda:
+            executor.map(close_cuda_process, range(len(pars)))
+        if dview is not None:
+            logging.info('** Finished parallel motion correction **')
+    finally:
+        if shared_template is not None:
+            shared_template.unlink()
 
     return fname_tot, res
@@ -12,4 +12,5 @@ from . import temporal
 from . import oasis
 from . import params
 from . import online_cnmf
+from . import online_stream
 from .cnmf import CNMF as CNMF
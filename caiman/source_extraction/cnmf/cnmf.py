@@ -23,6 +23,7 @@ See Also:
 
 from copy import deepcopy
 import cv2
+import hashlib
 import inspect
 import logging
 import numpy as np
@@ -38,11 +39,12 @@ from .initialization import initialize_components, compute_W
 from .map_reduce import run_CNMF_patches
 from .merging import merge_components
 from .params import CNMFParams
-from .pre_processing import preprocess_data
+from .pre_processing import preprocess_data, interpolate_missing_data
 from .spatial import update_spatial_components
 from .temporal import update_temporal_components, constrained_foopsi_parallel
 from .utilities import update_order
 from ... import mmapping
+from ...cluster import get_executor
 from ...components_evaluation import estimate_components_quality
 from ...motion_correction import MotionCorrect
 from ...utils.utils import save_dict_to_hdf5, load_dict_from_hdf5
@@ -60,6 +62,57 @@ try:
 except:
     def profile(a): return a
 
+# stages of CNMF.fit in the order they run, without and with patches. Each run
+# goes through a subsequence of them, depending on the parameters
+FIT_STAGES = ('preprocess', 'initialize', 'update_spatial', 'update_temporal',
+              'merge', 'refine_spatial', 'refine_temporal')
+FIT_STAGES_PATCHES = ('patches', 'merge', 'update_temporal', 'update_spatial',
+                      'refine_temporal', 'deconvolve')
+
+
+def _update_hash(h, obj):
+    """ feed a (nested) parameter value to a hashlib object """
+    if isinstance(obj, dict):
+        for key in sorted(obj, key=str):
+            h.update(str(key).encode())
+            _update_hash(h, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        h.update(b'[')
+        for item in obj:
+            _update_hash(h, item)
+        h.update(b']')
+    elif isinstance(obj, np.ndarray):
+        h.update(str((obj.dtype, obj.shape)).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif scipy.sparse.issparse(obj):
+        _update_hash(h, [obj.shape, obj.tocsc().data, obj.tocsc().indices, obj.tocsc().indptr])
+    else:
+        h.update(repr(obj).encode())
+
+
+def _params_digest(params):
+    """ hash of the parameters that affect the result of CNMF.fit """
+    h = hashlib.sha1()
+    for group, group_dict in params.to_dict().items():
+        h.update(group.encode())
+        _update_hash(h, {key: val for key, val in group_dict.items()
+                         if (group, key) not in (('data', 'checkpoint_dir'), ('patch_params', 'n_processes'))})
+    return h.hexdigest()
+
+
+def _movie_digest(Yr, num_frames=16):
+    """ hash of the shape of the movie (pixels x time) and of a few frames evenly spaced in time
+
+    Hashing the whole movie would take as long as reading it, the sampled
+    frames catch a different movie saved under the same name
+    """
+    h = hashlib.sha1()
+    T = Yr.shape[-1]
+    h.update(str(Yr.shape).encode())
+    for t in np.unique(np.linspace(0, T - 1, num_frames).astype(int)):
+        h.update(np.ascontiguousarray(Yr[:, t:t + 1], dtype=np.float32).tobytes())
+    return h.hexdigest()
+
 
 class CNMF(object):
     """  Source extraction using constrained non-negative matrix factorization.
@@ -345,8 +398,10 @@ class CNMF(object):
             data_set_name = self.params.get('data', 'var_name_hdf5')
             if motion_correct:
                 mc = MotionCorrect(fnames, dview=self.dview, **self.params.motion)
-                mc.motion_correct(save_movie=True)
-                fname_mc = mc.fname_tot_els if self.params.motion['pw_rigid'] else mc.fname_tot_rig
+                # write the corrected movie directly in C order, except for 3D data
+                fused = not self.params.get('motion', 'is3D')
+                mc.motion_correct(save_movie=True, order='C' if fused else 'F',
+                                  base_name=base_name, border_to_0=0)
                 if self.params.get('motion', 'pw_rigid'):
                     b0 = np.ceil(np.maximum(np.max(np.abs(mc.x_shifts_els)),
                                             np.max(np.abs(mc.y_shifts_els)))).astype(int)
@@ -363,8 +418,11 @@ class CNMF(object):
                 # for further details.
                 # b0 = 0 if self.params.get('motion', 'border_nan') == 'copy' else 0
                 b0 = 0
-                fname_new = mmapping.save_memmap(fname_mc, base_name=base_name, order='C',
-                                                 var_name_hdf5=data_set_name, border_to_0=b0)
+                if fused:
+                    fname_new = mc.mmap_file
+                else:
+                    fname_new = mmapping.save_memmap(mc.mmap_file, base_name=base_name, order='C',
+                                                     var_name_hdf5=data_set_name, border_to_0=b0)
             else:
                 fname_new = mmapping.save_memmap(fnames, base_name=base_name, var_name_hdf5=data_set_name, order='C')
             Yr, dims, T = mmapping.load_memmap(fname_new)
@@ -423,7 +481,8 @@ class CNMF(object):
         This method uses the cnmf algorithm to find sources in data.
 
         Args:
-            images : mapped np.ndarray of shape (t,x,y[,z]) containing the images that vary over time.
+            images : mapped np.ndarray of shape (t,x,y[,z]) containing the images that vary over time,
+                or the ChunkedMemmap (pixels x time) returned by load_memmap for a .zarr store.
 
             indices: list of slice objects along dimensions (x,y[,z]) for processing only part of the FOV
 
@@ -433,42 +492,65 @@ class CNMF(object):
         http://www.cell.com/neuron/fulltext/S0896-6273(15)01084-3
 
         """
+        # the parameters are hashed before fit changes any of them
+        checkpoint_dir = self.params.get('data', 'checkpoint_dir')
+        if checkpoint_dir is not None:
+            params_digest = _params_digest(self.params)
+
         # Todo : to compartment
         if isinstance(indices, slice):
             indices = [indices]
         if isinstance(indices, tuple):
             indices = list(indices)
         indices = [slice(None)] + indices
+        if isinstance(images, mmapping.ChunkedMemmap):
+            # pixels x time chunked store returned by load_memmap: patches and
+            # dot products read from the store directly, without patches the
+            # movie is loaded in memory
+            _, dims, T = mmapping.load_memmap(images.filename)
+            if self.params.get('patch', 'rf') is None:
+                images = np.reshape(np.array(images).T, [T] + list(dims), order='F')
+            elif len(indices) < len(dims) + 1:
+                indices = indices + [slice(None)]*(len(dims) + 1 - len(indices))
         if len(indices) < len(images.shape):
             indices = indices + [slice(None)]*(len(images.shape) - len(indices))
-        dims_orig = images.shape[1:]
-        dims_sliced = images[tuple(indices)].shape[1:]
-        is_sliced = (dims_orig != dims_sliced)
-        if self.params.get('patch', 'rf') is None and (is_sliced or 'ndarray' in str(type(images))):
-            images = images[tuple(indices)]
-            self.dview = None
-            logging.info("Parallel processing in a single patch "
-                            "is not available for loaded in memory or sliced" +
-                            " data.")
-
-        T = images.shape[0]
-        self.params.set('online', {'init_batch': T})
-        self.dims = images.shape[1:]
-        #self.params.data['dims'] = images.shape[1:]
-        Y = np.transpose(images, list(range(1, len(self.dims) + 1)) + [0])
-        Yr = np.transpose(np.reshape(images, (T, -1), order='F'))
-        if np.isfortran(Yr):
-            raise Exception('The file is in F order, it should be in C order (see save_memmap function)')
-
-        logging.info((T,) + self.dims)
-
-        # Make sure filename is pointed correctly (numpy sets it to None sometimes)
-        try:
-            Y.filename = images.filename
-            Yr.filename = images.filename
+
+        if isinstance(images, mmapping.ChunkedMemmap):
+            dims_orig = dims
+            is_sliced = False
+            self.params.set('online', {'init_batch': T})
+            self.dims = dims
+            Yr = images
             self.mmap_file = images.filename
-        except AttributeError:  # if no memmapping cause working with small data
-            pass
+        else:
+            dims_orig = images.shape[1:]
+            dims_sliced = images[tuple(indices)].shape[1:]
+            is_sliced = (dims_orig != dims_sliced)
+            if self.params.get('patch', 'rf') is None and (is_sliced or 'ndarray' in str(type(images))):
+                images = images[tuple(indices)]
+                self.dview = None
+                logging.info("Parallel processing in a single patch "
+                                "is not available for loaded in memory or sliced" +
+                                " data.")
+
+            T = images.shape[0]
+            self.params.set('online', {'init_batch': T})
+            self.dims = images.shape[1:]
+            #self.params.data['dims'] = images.shape[1:]
+            Y = np.transpose(images, list(range(1, len(self.dims) + 1)) + [0])
+            Yr = np.transpose(np.reshape(images, (T, -1), order='F'))
+            if np.isfortran(Yr):
+                raise Exception('The file is in F order, it should be in C order (see save_memmap function)')
+
+            logging.info((T,) + self.dims)
+
+            # Make sure filename is pointed correctly (numpy sets it to None sometimes)
+            try:
+                Y.filename = images.filename
+                Yr.filename = images.filename
+                self.mmap_file = images.filename
+            except AttributeError:  # if no memmapping cause working with small data
+                pass
 
         # update/set all options that depend on data dimensions
         # number of rows, columns [and depths]
@@ -492,12 +574,33 @@ class CNMF(object):
         logging.info('using ' + str(self.params.get('spatial', 'block_size_spat')) + ' block_size_spat')
         logging.info('using ' + str(self.params.get('temporal', 'block_size_temp')) + ' block_size_temp')
 
+        # stages completed in a previous run with the same movie and parameters are skipped
+        stages = FIT_STAGES if self.params.get('patch', 'rf') is None else FIT_STAGES_PATCHES
+        stages_done = ()
+        checkpoint_key = None
+        if checkpoint_dir is not None:
+            checkpoint_key = hashlib.sha1(
+                (params_digest + _movie_digest(Yr) + repr(indices)).encode()).hexdigest()
+            last_stage = self._restore_checkpoint(checkpoint_key)
+            if last_stage is not None:
+                stages_done = stages[:stages.index(last_stage) + 1]
+                logging.info('Resuming after stage ' + last_stage)
+
+        def checkpoint(stage):
+            if checkpoint_key is not None:
+                self._save_checkpoint(checkpoint_key, stage)
+
         if self.params.get('patch', 'rf') is None:  # no patches
-            logging.info('preprocessing ...')
-            Yr = self.preprocess(Yr)
-            if self.estimates.A is None:
+            if 'preprocess' not in stages_done:
+                logging.info('preprocessing ...')
+                Yr = self.preprocess(Yr)
+                checkpoint('preprocess')
+            elif self.params.get('preprocess', 'check_nan'):
+                Yr, _ = interpolate_missing_data(Yr)
+            if self.estimates.A is None and 'initialize' not in stages_done:
                 logging.info('initializing ...')
                 self.initialize(Y)
+                checkpoint('initialize')
 
             if self.params.get('patch', 'only_init'):  # only return values after initialization
                 if not (self.params.get('init', 'method_init') == 'corr_pnr' and
@@ -533,32 +636,40 @@ class CNMF(object):
 
                 return self
 
-            logging.info('update spatial ...')
-            self.update_spatial(Yr, use_init=True)
+            if 'update_spatial' not in stages_done:
+                logging.info('update spatial ...')
+                self.update_spatial(Yr, use_init=True)
+                checkpoint('update_spatial')
 
-            logging.info('update temporal ...')
             if not self.skip_refinement:
                 # set this to zero for fast updating without deconvolution
                 self.params.set('temporal', {'p': 0})
             else:
                 self.params.set('temporal', {'p': self.params.get('preprocess', 'p')})
-                logging.info('deconvolution ...')
-
-            self.update_temporal(Yr)
+            if 'update_temporal' not in stages_done:
+                logging.info('update temporal ...')
+                if self.skip_refinement:
+                    logging.info('deconvolution ...')
+                self.update_temporal(Yr)
+                checkpoint('update_temporal')
 
             if not self.skip_refinement:
                 logging.info('refinement...')
-                if self.params.get('merging', 'do_merge'):
+                if self.params.get('merging', 'do_merge') and 'merge' not in stages_done:
                     logging.info('merging components ...')
                     self.merge_comps(Yr, mx=50, fast_merge=True, max_merge_area=self.params.get('merging', 'max_merge_area'))
+                    checkpoint('merge')
 
-                logging.info('Updating spatial ...')
-
-                self.update_spatial(Yr, use_init=False)
+                if 'refine_spatial' not in stages_done:
+                    logging.info('Updating spatial ...')
+                    self.update_spatial(Yr, use_init=False)
+                    checkpoint('refine_spatial')
                 # set it back to original value to perform full deconvolution
                 self.params.set('temporal', {'p': self.params.get('preprocess', 'p')})
-                logging.info('update temporal ...')
-                self.update_temporal(Yr, use_init=False)
+                if 'refine_temporal' not in stages_done:
+                    logging.info('update temporal ...')
+                    self.update_temporal(Yr, use_init=False)
+                    checkpoint('refine_temporal')
             # else:
             #     todo : ask for those..
                 # C, f, S, bl, c1, neurons_sn, g1, YrA, lam = self.estimates.C, self.estimates.f, self.estimates.S, self.estimates.bl, self.estimates.c1, self.estimates.neurons_sn, self.estimates.g, self.estimates.YrA, self.estimates.lam
@@ -586,20 +697,24 @@ class CNMF(object):
                 logging.info(
                     ('Setting the stride to 10% of 2*rf automatically:' + str(self.params.get('patch', 'stride'))))
 
-            if not isinstance(images, np.memmap):
+            if not isinstance(images, (np.memmap, mmapping.ChunkedMemmap)):
                 raise Exception(
                     'You need to provide a memory mapped file as input if you use patches!!')
 
-            self.estimates.A, self.estimates.C, self.estimates.YrA, self.estimates.b, self.estimates.f, \
-                self.estimates.sn, self.estimates.optional_outputs = run_CNMF_patches(
-                    images.filename, self.dims + (T,), self.params,
-                    dview=self.dview, memory_fact=self.params.get('patch', 'memory_fact'),
-                    gnb=self.params.get('init', 'nb'), border_pix=self.params.get('patch', 'border_pix'),
-                    low_rank_background=self.params.get('patch', 'low_rank_background'),
-                    del_duplicates=self.params.get('patch', 'del_duplicates'),
-                    indices=indices)
-
-            self.estimates.bl, self.estimates.c1, self.estimates.g, self.estimates.neurons_sn = None, None, None, None
+            if 'patches' not in stages_done:
+                self.estimates.A, self.estimates.C, self.estimates.YrA, self.estimates.b, self.estimates.f, \
+                    self.estimates.sn, self.estimates.optional_outputs = run_CNMF_patches(
+                        images.filename, self.dims + (T,), self.params,
+                        dview=self.dview, memory_fact=self.params.get('patch', 'memory_fact'),
+                        gnb=self.params.get('init', 'nb'), border_pix=self.params.get('patch', 'border_pix'),
+                        low_rank_background=self.params.get('patch', 'low_rank_background'),
+                        del_duplicates=self.params.get('patch', 'del_duplicates'),
+                        indices=indices,
+                        checkpoint=None if checkpoint_key is None else
+                            self._checkpoint_file(checkpoint_key, '_patches'))
+
+                self.estimates.bl, self.estimates.c1, self.estimates.g, self.estimates.neurons_sn = None, None, None, None
+                checkpoint('patches')
             logging.info("merging")
             self.estimates.merged_ROIs = [0]
 
@@ -607,43 +722,59 @@ class CNMF(object):
             if self.params.get('init', 'center_psf'):  # merge taking best neuron
                 if self.params.get('patch', 'nb_patch') > 0:
 
-                    while len(self.estimates.merged_ROIs) > 0:
-                        self.merge_comps(Yr, mx=np.Inf, fast_merge=True)
+                    if 'merge' not in stages_done:
+                        while len(self.estimates.merged_ROIs) > 0:
+                            self.merge_comps(Yr, mx=np.Inf, fast_merge=True)
+                        checkpoint('merge')
 
-                    logging.info("update temporal")
-                    self.update_temporal(Yr, use_init=False)
+                    if 'update_temporal' not in stages_done:
+                        logging.info("update temporal")
+                        self.update_temporal(Yr, use_init=False)
+                        checkpoint('update_temporal')
 
                     self.params.set('spatial', {'se': np.ones((1,) * len(self.dims), dtype=np.uint8)})
-                    logging.info('update spatial ...')
-                    self.update_spatial(Yr, use_init=False)
-
-                    logging.info("update temporal")
-                    self.update_temporal(Yr, use_init=False)
+                    if 'update_spatial' not in stages_done:
+                        logging.info('update spatial ...')
+                        self.update_spatial(Yr, use_init=False)
+                        checkpoint('update_spatial')
+
+                    if 'refine_temporal' not in stages_done:
+                        logging.info("update temporal")
+                        self.update_temporal(Yr, use_init=False)
+                        checkpoint('refine_temporal')
                 else:
-                    while len(self.estimates.merged_ROIs) > 0:
-                        self.merge_comps(Yr, mx=np.Inf, fast_merge=True)
+                    if 'merge' not in stages_done:
+                        while len(self.estimates.merged_ROIs) > 0:
+                            self.merge_comps(Yr, mx=np.Inf, fast_merge=True)
+                        checkpoint('merge')
                         #if len(self.estimates.merged_ROIs) > 0:
                             #not_merged = np.setdiff1d(list(range(len(self.estimates.YrA))),
                             #                          np.unique(np.concatenate(self.estimates.merged_ROIs)))
                             #self.estimates.YrA = np.concatenate([self.estimates.YrA[not_merged],
                             #                           np.array([self.estimates.YrA[m].mean(0) for ind, m in enumerate(self.estimates.merged_ROIs) if not self.empty_merged[ind]])])
-                    if self.params.get('init', 'nb') == 0:
-                        self.estimates.W, self.estimates.b0 = compute_W(
-                            Yr, self.estimates.A.toarray(), self.estimates.C, self.dims,
-                            self.params.get('init', 'ring_size_factor') *
-                            self.params.get('init', 'gSiz')[0],
-                            ssub=self.params.get('init', 'ssub_B'))
-                    if len(self.estimates.C):
-                        self.deconvolve()
-                        self.estimates.C = self.estimates.C.astype(np.float32)
-                    else:
-                        self.estimates.S = self.estimates.C
+                    if 'deconvolve' not in stages_done:
+                        if self.params.get('init', 'nb') == 0:
+                            self.estimates.W, self.estimates.b0 = compute_W(
+                                Yr, self.estimates.A.toarray(), self.estimates.C, self.dims,
+                                self.params.get('init', 'ring_size_factor') *
+                                self.params.get('init', 'gSiz')[0],
+                                ssub=self.params.get('init', 'ssub_B'))
+                        if len(self.estimates.C):
+                            self.deconvolve()
+                            self.estimates.C = self.estimates.C.astype(np.float32)
+                        else:
+                            self.estimates.S = self.estimates.C
+                        checkpoint('deconvolve')
             else:
-                while len(self.estimates.merged_ROIs) > 0:
-                    self.merge_comps(Yr, mx=np.Inf)
+                if 'merge' not in stages_done:
+                    while len(self.estimates.merged_ROIs) > 0:
+                        self.merge_comps(Yr, mx=np.Inf)
+                    checkpoint('merge')
 
-                logging.info("update temporal")
-                self.update_temporal(Yr, use_init=False)
+                if 'update_temporal' not in stages_done:
+                    logging.info("update temporal")
+                    self.update_temporal(Yr, use_init=False)
+                    checkpoint('update_temporal')
 
         self.estimates.normalize_components()
         return self
@@ -663,6 +794,50 @@ class CNMF(object):
         else:
             raise Exception("File extension not supported for cnmf.save")
 
+    def _checkpoint_file(self, key, suffix=''):
+        return os.path.join(self.params.get('data', 'checkpoint_dir'), 'cnmf_' + key + suffix + '.hdf5')
+
+    def _save_checkpoint(self, key, stage):
+        '''save the object after a completed stage of fit, replacing the previous checkpoint
+
+        Args:
+            key: str
+                hash of the movie and of the parameters the fit was started with
+
+            stage: str
+                name of the completed stage, one of FIT_STAGES or FIT_STAGES_PATCHES
+        '''
+        filename = self._checkpoint_file(key)
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        # write to a temporary file first, a crash while saving keeps the previous checkpoint
+        save_dict_to_hdf5(dict(self.__dict__, checkpoint_key=key, checkpoint_stage=stage), filename + '.tmp')
+        os.replace(filename + '.tmp', filename)
+        logging.info('Saved checkpoint after stage ' + stage + ' to ' + filename)
+
+    def _restore_checkpoint(self, key):
+        '''restore the object from the checkpoint saved by _save_checkpoint, if any
+
+        Args:
+            key: str
+                hash of the movie and of the parameters the fit was started with
+
+        Returns:
+            stage: str or None
+                last completed stage, None if there is no checkpoint for this key
+        '''
+        filename = self._checkpoint_file(key)
+        if not os.path.exists(filename):
+            return None
+        saved = load_CNMF(filename, dview=self.dview)
+        if getattr(saved, 'checkpoint_key', None) != key:
+            return None
+        n_processes = self.params.get('patch', 'n_processes')
+        for attr, val in saved.__dict__.items():
+            if attr not in ('dview', 'checkpoint_key', 'checkpoint_stage'):
+                setattr(self, attr, val)
+        self.params.set('patch', {'n_processes': n_processes})
+        return saved.checkpoint_stage
+
     def remove_components(self, ind_rm):
         """
         Remove a specified list of components from the CNMF object.
@@ -680,7 +855,7 @@ class CNMF(object):
                 self.params.get('online', 'use_dense'), self.estimates.Ab_dense,
                 self.estimates.AtA, self.estimates.CY, self.estimates.CC, self.M, self.N,
                 self.estimates.noisyC, self.estimates.OASISinstances, self.estimates.C_on,
-                self.params.get('online', 'expected_comps'))
+                self.params.get('online', 'expected_comps'), groups=self.estimates.groups)
         self.params.set('online', {'expected_comps': expected_comps})
 
     def compute_residuals(self, Yr):
@@ -750,13 +925,7 @@ class CNMF(object):
         args_in = [(F[jj], None, jj, None, None, None, None,
                     args) for jj in range(F.shape[0])]
 
-        if 'multiprocessing' in str(type(self.dview)):
-            results = self.dview.map_async(
-                constrained_foopsi_parallel, args_in).get(4294967)
-        elif self.dview is not None:
-            results = self.dview.map_sync(constrained_foopsi_parallel, args_in)
-        else:
-            results = list(map(constrained_foopsi_parallel, args_in))
+        results = get_executor(self.dview).map(constrained_foopsi_parallel, args_in)
 
         if sys.version_info >= (3, 0):
             results = list(zip(*results))
@@ -18,6 +18,7 @@ from .utilities import detrend_df_f, decimation_matrix
 from .spatial import threshold_components
 from .temporal import constrained_foopsi_parallel
 from .merging import merge_iteration, merge_components
+from ...cluster import get_executor
 from ...components_evaluation import (
         evaluate_components_CNN, estimate_components_quality_auto,
         select_components_from_metrics, compute_eccentricity)
@@ -1202,13 +1203,7 @@ class Estimates(object):
         args_in = [(F[jj], None, jj, None, None, None, None,
                     args) for jj in range(F.shape[0])]
 
-        if 'multiprocessing' in str(type(dview)):
-            results = dview.map_async(
-                constrained_foopsi_parallel, args_in).get(4294967)
-        elif dview is not None:
-            results = dview.map_sync(constrained_foopsi_parallel, args_in)
-        else:
-            results = list(map(constrained_foopsi_parallel, args_in))
+        results = get_executor(dview).map(constrained_foopsi_parallel, args_in)
 
         results = list(zip(*results))
 
@@ -1231,14 +1226,7 @@ class Estimates(object):
                 args_in = [(self.F_dff[jj], None, jj, 0, 0, self.g[jj], None,
                         args) for jj in range(F.shape[0])]
 
-                if 'multiprocessing' in str(type(dview)):
-                    results = dview.map_async(
-                        constrained_foopsi_parallel, args_in).get(4294967)
-                elif dview is not None:
-                    results = dview.map_sync(constrained_foopsi_parallel,
-                                             args_in)
-                else:
-                    results = list(map(constrained_foopsi_parallel, args_in))
+                results = get_executor(dview).map(constrained_foopsi_parallel, args_in)
 
                 results = list(zip(*results))
                 order = list(results[7])
@@ -15,16 +15,18 @@ Function for implementing parallel scalable segmentation of two photon imaging d
 #\date Created on Wed Feb 17 14:58:26 2016
 
 from copy import copy, deepcopy
+import h5py
 import logging
 import numpy as np
 import os
+import pickle
 import scipy
 from sklearn.decomposition import NMF
 import time
 from typing import Set
 
-from ...mmapping import load_memmap
-from ...cluster import extract_patch_coordinates
+from ...mmapping import load_memmap, ChunkedMemmap
+from ...cluster import extract_patch_coordinates, get_executor
 
 #%%
 def cnmf_patches(args_in):
@@ -108,10 +110,16 @@ def cnmf_patches(args_in):
     # insert slice for timesteps, equivalent to :
     slices.insert(0, slice(timesteps))
 
-    images = np.reshape(Yr.T, [timesteps] + list(dims), order='F')
-    if params.get('patch', 'in_memory'):
+    if isinstance(Yr, ChunkedMemmap):
+        # read only the pixels in the bounding box of the patch from the chunked store
+        box = np.meshgrid(*[np.arange(sl.start, sl.stop) for sl in slices[1:]], indexing='ij')
+        idx_box = np.ravel_multi_index(box, dims, order='F').ravel(order='F')
+        images = np.reshape(Yr[idx_box].T, [timesteps] + list(box[0].shape), order='F')
+    elif params.get('patch', 'in_memory'):
+        images = np.reshape(Yr.T, [timesteps] + list(dims), order='F')
         images = np.array(images[tuple(slices)], dtype=np.float32)
     else:
+        images = np.reshape(Yr.T, [timesteps] + list(dims), order='F')
         images = images[slices]
 
     logger.debug(name_log+'file loaded')
@@ -120,6 +128,7 @@ def cnmf_patches(args_in):
 
         opts = copy(params)
         opts.set('patch', {'n_processes': 1, 'rf': None, 'stride': None})
+        opts.set('data', {'checkpoint_dir': None})
         for group in ('init', 'temporal', 'spatial'):
             opts.set(group, {'nb': params.get('patch', 'nb_patch')})
         for group in ('preprocess', 'temporal'):
@@ -135,12 +144,118 @@ def cnmf_patches(args_in):
                 cnm.params.to_dict(), cnm.estimates.YrA]
     else:
         return None
+
+
+def _cnmf_patches_indexed(args):
+    """ run cnmf_patches and return the result with the position of the patch
+    and the wall time spent on it. With seeded=True the random generator is
+    seeded with the position of the patch during its fit
+    """
+    jj, args_in, seeded = args
+    st = time.time()
+    if seeded:
+        # the order in which the components are updated is random (app_vertex_cover),
+        # seeding with the position of the patch makes its result independent of the
+        # patches processed before it, be it by the same worker or before a resume
+        rng_state = np.random.get_state()
+        np.random.seed(jj)
+    try:
+        res = cnmf_patches(args_in)
+    finally:
+        if seeded:
+            np.random.set_state(rng_state)
+    return jj, res, time.time() - st
+
+
+def _load_patch_result(checkpoint, jj):
+    """ load the result of a patch saved by _save_patch_result """
+    with h5py.File(checkpoint, 'r') as h5file:
+        return pickle.loads(h5file['patches/' + str(jj)][()].tobytes())
+
+
+def _save_patch_result(checkpoint, jj, fff):
+    """ append the result of a patch to the checkpoint file, as a pickled blob """
+    if fff is not None:
+        # the parameters of the patch are not used when assembling the FOV
+        fff = fff[:12] + [None] + fff[13:]
+    with h5py.File(checkpoint, 'a') as h5file:
+        h5file['patches/' + str(jj)] = np.void(pickle.dumps(fff, pickle.HIGHEST_PROTOCOL))
+
+
+def _completed_patches(checkpoint, num_patches):
+    """ indices of the patches whose results are stored in the checkpoint file """
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return []
+    try:
+        with h5py.File(checkpoint, 'r') as h5file:
+            if h5file.attrs.get('num_patches') != num_patches:
+                raise ValueError('Different number of patches')
+            return sorted(int(jj) for jj in h5file.get('patches', {}).keys())
+    except (OSError, ValueError, KeyError) as e:
+        # a file truncated by a crash while writing cannot be trusted
+        logging.warning(f'Discarding patch checkpoint {checkpoint}: {e}')
+        os.remove(checkpoint)
+        return []
+
+
+def estimate_patch_costs(idx_flat, dims, Yr=None, num_frames=500) -> np.ndarray:
+    """Estimate the relative cost of fitting CNMF on each patch
+
+    The cost grows with the number of pixels of the patch (border patches are
+    smaller). If the movie is passed, the pixel count is weighted by the mean
+    (positive) local correlation of the patch, computed on the first frames,
+    as a proxy for the density of active neurons.
+
+    Args:
+        idx_flat: list of np.ndarray
+            flattened (order='F') pixel indices of each patch, as returned by
+            extract_patch_coordinates
+
+        dims: tuple
+            dimensions of the FOV
+
+        Yr: np.ndarray or ChunkedMemmap
+            movie (pixels x time). If None only the size of the patches is used
+
+        num_frames: int
+            number of frames used to compute the correlation image
+
+    Returns:
+        costs: np.ndarray
+            relative cost of each patch
+    """
+    costs = np.array([len(idx) for idx in idx_flat], dtype=float)
+    if Yr is not None:
+        from ...summary_images import local_correlations_fft
+        T = Yr.shape[-1]
+        Y = np.array(Yr[:, :min(T, num_frames)], dtype=np.float32)
+        Cn = local_correlations_fft(np.reshape(Y.T, [Y.shape[1]] + list(dims), order='F'),
+                                    swap_dim=False)
+        Cn = np.maximum(np.nan_to_num(Cn.ravel(order='F')), 0)
+        costs *= 1 + np.array([Cn[idx].mean() for idx in idx_flat])
+    return costs
+
+
+def _permute_rows(arr, order):
+    """ in place arr[:] = arr[order], with one row of extra memory """
+    done = np.zeros(len(order), dtype=bool)
+    for start in range(len(order)):
+        if done[start] or order[start] == start:
+            continue
+        tmp = arr[start].copy()
+        i = start
+        while order[i] != start:
+            arr[i] = arr[order[i]]
+            done[i] = True
+            i = order[i]
+        arr[i] = tmp
+        done[i] = True
 # %%
 
 
 def run_CNMF_patches(file_name, shape, params, gnb=1, dview=None,
                      memory_fact=1, border_pix=0, low_rank_background=True,
-                     del_duplicates=False, indices=[slice(None)]*3):
+                     del_duplicates=False, indices=[slice(None)]*3, checkpoint=None):
     """Function that runs CNMF in patches
 
      Either in parallel or sequentially, and return the result for each.
@@ -185,6 +300,11 @@ def run_CNMF_patches(file_name, shape, params, gnb=1, dview=None,
         indices: List[slice]
             TODO
 
+        checkpoint: str
+            hdf5 file where the result of each patch is saved as soon as it completes. Patches already
+            stored in the file are not processed again. The caller must make sure that the file was
+            written for the same movie and parameters
+
     Returns:
 
         A_tot: matrix containing all the components from all the patches
@@ -245,141 +365,169 @@ def run_CNMF_patches(file_name, shape, params, gnb=1, dview=None,
                 foo.reshape(dims, order='F')))
     logging.info('Patch size: {0}'.format(id_2d))
     st = time.time()
-    if dview is not None:
-        if 'multiprocessing' in str(type(dview)):
-            file_res = dview.map_async(cnmf_patches, args_in).get(4294967)
-        else:
-            try:
-                file_res = dview.map_sync(cnmf_patches, args_in)
-                dview.results.clear()
-            except:
-                print('Something went wrong')
-                raise
-            finally:
-                logging.info('Patch processing complete')
-
-    else:
-        file_res = list(map(cnmf_patches, args_in))
 
-    logging.info('Elapsed time for processing patches: \
-                 {0}s'.format(str(time.time() - st).split('.')[0]))
-    # count components
-    count = 0
-    count_bgr = 0
-    patch_id = 0
-    num_patches = len(file_res)
-    for jj, fff in enumerate(file_res):
-        if fff is not None:
-            idx_, shapes, A, b, C, f, S, bl, c1, neurons_sn, g, sn, _, YrA = fff
-            for _ in range(np.shape(b)[-1]):
-                count_bgr += 1
-
-            A = A.tocsc()
-            if del_duplicates:
-                keep = []
-                for ii in range(np.shape(A)[-1]):
-                    neuron_center = (np.array(scipy.ndimage.center_of_mass(
-                        A[:, ii].toarray().reshape(shapes, order='F'))) -
-                        np.array(shapes) / 2. + np.array(patch_centers[jj]))
-                    if np.argmin([np.linalg.norm(neuron_center - p) for p in
-                                  np.array(patch_centers)]) == jj:
-                        keep.append(ii)
-                A = A[:, keep]
-                file_res[jj][2] = A
-                file_res[jj][4] = C[keep]
-                if S is not None:
-                    file_res[jj][6] = S[keep]
-                    file_res[jj][7] = bl[keep]
-                    file_res[jj][8] = c1[keep]
-                    file_res[jj][9] = neurons_sn[keep]
-                    file_res[jj][10] = g[keep]
-                file_res[jj][-1] = YrA[keep]
-
-            # for ii in range(np.shape(A)[-1]):
-            #     new_comp = A[:, ii] / np.sqrt(A[:, ii].power(2).sum())
-            #     if new_comp.sum() > 0:
-            #         count += 1
-            count += np.sum(A.sum(0) > 0)
-
-            patch_id += 1
-
-    # INITIALIZING
+    num_patches = len(args_in)
     nb_patch = params.get('patch', 'nb_patch')
-    C_tot = np.zeros((count, T), dtype=np.float32)
-    if params.get('init', 'center_psf'):
-        S_tot = np.zeros((count, T), dtype=np.float32)
-    else:
-        S_tot = None
-    YrA_tot = np.zeros((count, T), dtype=np.float32)
-    F_tot = np.zeros((max(0, num_patches * nb_patch), T), dtype=np.float32)
+    center_psf = params.get('init', 'center_psf')
+    # the traces are accumulated in buffers that grow as needed; each patch
+    # returns at most K components
+    K = params.get('init', 'K')
+    capacity = num_patches * (K if K else 4)
+    C_tot = np.zeros((capacity, T), dtype=np.float32)
+    YrA_tot = np.zeros((capacity, T), dtype=np.float32)
+    S_tot = np.zeros((capacity, T), dtype=np.float32) if center_psf else None
     mask = np.zeros(d, dtype=np.uint8)
     sn_tot = np.zeros((d))
 
-    f_tot, bl_tot, c1_tot, neurons_sn_tot, g_tot, idx_tot, id_patch_tot, shapes_tot = [
-    ], [], [], [], [], [], [], []
-    patch_id, empty, count_bgr, count = 0, 0, 0, 0
-    idx_tot_B, idx_tot_A, a_tot, b_tot = [], [], [], []
-    idx_ptr_B, idx_ptr_A = [0], [0]
-
-    # instead of filling in the matrices, construct lists with their non-zero
-    # entries and coordinates
+    # per patch outputs that are kept, indexed by the position of the patch in the grid
+    patch_out = {}
+    a_data, a_indices, a_patch = [], [], []
+    empty, count = 0, 0
+
+    # patches are handed out one at a time, so that the workers that are done pick up
+    # the remaining ones; 'size' and 'activity' send the most expensive ones first so
+    # that the workers finish together
+    schedule = params.get('patch', 'schedule')
+    if schedule == 'grid':
+        costs = None
+        tasks = list(enumerate(args_in))
+    elif schedule in ('size', 'activity'):
+        costs = estimate_patch_costs(idx_flat, dims, load_memmap(file_name)[0] if schedule == 'activity' else None)
+        tasks = [(jj, args_in[jj]) for jj in np.argsort(-costs, kind='stable')]
+    else:
+        raise Exception('Unknown patch schedule ' + str(schedule))
+    patch_times = np.zeros(num_patches)
+
+    completed = _completed_patches(checkpoint, num_patches)
+    completed_set = set(completed)
+    if checkpoint is not None:
+        logging.info(f'Resuming with {len(completed)} of {num_patches} patches completed')
+        if not completed:
+            with h5py.File(checkpoint, 'w') as h5file:
+                h5file.attrs['num_patches'] = num_patches
+        tasks = [task for task in tasks if task[0] not in completed_set]
+
+    def results():
+        for jj in completed:
+            yield jj, _load_patch_result(checkpoint, jj), 0.
+        for jj, fff, elapsed in get_executor(dview).imap_unordered(
+                _cnmf_patches_indexed, [(jj, args, checkpoint is not None) for jj, args in tasks]):
+            if checkpoint is not None:
+                _save_patch_result(checkpoint, jj, fff)
+            yield jj, fff, elapsed
+
+    # patches are folded into the accumulators as soon as they complete, and
+    # their results discarded, instead of holding the results of all patches
     logging.info('Embedding patches results into whole FOV')
-    for fff in file_res:
-        if fff is not None:
-
-            idx_, shapes, A, b, C, f, S, bl, c1, neurons_sn, g, sn, _, YrA = fff
-            A = A.tocsc()
-
-            # check A for nans, which result in corrupted outputs.  Better to fail here if any found
-            nnan = np.isnan(A.data).sum()
-            if nnan > 0:
-                raise RuntimeError('found %d/%d nans in A, cannot continue' % (nnan, len(A.data)))
-
-            sn_tot[idx_] = sn
-            f_tot.append(f)
-            bl_tot.append(bl)
-            c1_tot.append(c1)
-            neurons_sn_tot.append(neurons_sn)
-            g_tot.append(g)
-            idx_tot.append(idx_)
-            shapes_tot.append(shapes)
-            mask[idx_] += 1
-
-            if scipy.sparse.issparse(b):
-                b = scipy.sparse.csc_matrix(b)
-                b_tot.append(b.data)
-                idx_ptr_B += list(b.indptr[1:] - b.indptr[:-1])
-                idx_tot_B.append(idx_[b.indices])
-            else:
-                for ii in range(np.shape(b)[-1]):
-                    b_tot.append(b[:, ii])
-                    idx_tot_B.append(idx_)
-                    idx_ptr_B.append(len(idx_))
-                    # F_tot[patch_id, :] = f[ii, :]
-            count_bgr += b.shape[-1]
-            if nb_patch >= 0:
-                F_tot[patch_id * nb_patch:(patch_id + 1) * nb_patch] = f
-            else:  # full background per patch
-                F_tot = np.concatenate([F_tot, f])
+    for jj, fff, elapsed in results():
+        patch_times[jj] = elapsed
+        if fff is None:
+            empty += 1
+            continue
 
+        idx_, shapes, A, b, C, f, S, bl, c1, neurons_sn, g, sn, _, YrA = fff
+        del fff
+        A = A.tocsc()
+        if del_duplicates:
+            keep = []
             for ii in range(np.shape(A)[-1]):
-                new_comp = A[:, ii]  # / np.sqrt(A[:, ii].power(2).sum())
-                if new_comp.sum() > 0:
-                    a_tot.append(new_comp.toarray().flatten())
-                    idx_tot_A.append(idx_)
-                    idx_ptr_A.append(len(idx_))
-                    C_tot[count, :] = C[ii, :]
-                    if params.get('init', 'center_psf'):
-                        S_tot[count, :] = S[ii, :]
-                    YrA_tot[count, :] = YrA[ii, :]
-                    id_patch_tot.append(patch_id)
-                    count += 1
-
-            patch_id += 1
+                neuron_center = (np.array(scipy.ndimage.center_of_mass(
+                    A[:, ii].toarray().reshape(shapes, order='F'))) -
+                    np.array(shapes) / 2. + np.array(patch_centers[jj]))
+                if np.argmin([np.linalg.norm(neuron_center - p) for p in
+                              np.array(patch_centers)]) == jj:
+                    keep.append(ii)
+            A = A[:, keep]
+            C = C[keep]
+            if S is not None:
+                S = S[keep]
+                bl = bl[keep]
+                c1 = c1[keep]
+                neurons_sn = neurons_sn[keep]
+                g = g[keep]
+            YrA = YrA[keep]
+
+        # check A for nans, which result in corrupted outputs.  Better to fail here if any found
+        nnan = np.isnan(A.data).sum()
+        if nnan > 0:
+            raise RuntimeError('found %d/%d nans in A, cannot continue' % (nnan, len(A.data)))
+
+        sn_tot[idx_] = sn
+        mask[idx_] += 1
+
+        if scipy.sparse.issparse(b):
+            b = scipy.sparse.csc_matrix(b)
+            b_out = (b.data, list(b.indptr[1:] - b.indptr[:-1]), idx_[b.indices])
         else:
-            empty += 1
+            b_out = ([b[:, ii] for ii in range(np.shape(b)[-1])],
+                     [len(idx_)] * np.shape(b)[-1], [idx_] * np.shape(b)[-1])
+        patch_out[jj] = (f, bl, c1, neurons_sn, g, idx_, shapes, b_out, b.shape[-1])
+
+        for ii in range(np.shape(A)[-1]):
+            new_comp = A[:, ii]  # / np.sqrt(A[:, ii].power(2).sum())
+            if new_comp.sum() > 0:
+                if count == len(C_tot):
+                    capacity = 2 * len(C_tot)
+                    for buf in (C_tot, YrA_tot, S_tot):
+                        if buf is not None:
+                            buf.resize((capacity, T), refcheck=False)
+                a_data.append(new_comp.data)
+                a_indices.append(idx_[new_comp.indices])
+                a_patch.append(jj)
+                C_tot[count, :] = C[ii, :]
+                if center_psf:
+                    S_tot[count, :] = S[ii, :]
+                YrA_tot[count, :] = YrA[ii, :]
+                count += 1
 
+    logging.info('Elapsed time for processing patches: \
+                 {0}s'.format(str(time.time() - st).split('.')[0]))
     logging.debug('Skipped %d empty patches', empty)
+    if num_patches > 0:
+        logging.info('Time per patch: median {0:.2f}s, max {1:.2f}s (patch {2}), total {3:.2f}s'.format(
+            np.median(patch_times), patch_times.max(), np.argmax(patch_times), patch_times.sum()))
+
+    # patches complete in any order: put components and backgrounds back in grid order
+    order = np.argsort(a_patch, kind='stable')
+    for buf in (C_tot, YrA_tot, S_tot):
+        if buf is not None:
+            buf.resize((count, T), refcheck=False)
+            _permute_rows(buf, order)
+    a_data = [a_data[i] for i in order]
+    idx_tot_A = [a_indices[i] for i in order]
+    idx_ptr_A = [0] + [len(a_indices[i]) for i in order]
+    patch_ids = sorted(patch_out)
+    id_patch_tot = np.searchsorted(patch_ids, np.array(a_patch, dtype=int)[order]).tolist()
+    del a_indices, a_patch
+
+    f_tot, bl_tot, c1_tot, neurons_sn_tot, g_tot, idx_tot, shapes_tot = [
+    ], [], [], [], [], [], []
+    idx_tot_B, b_tot = [], []
+    idx_ptr_B = [0]
+    count_bgr = 0
+    F_tot = np.zeros((max(0, num_patches * nb_patch), T), dtype=np.float32)
+    for patch_id, jj in enumerate(patch_ids):
+        f, bl, c1, neurons_sn, g, idx_, shapes, (b_data, b_ptr, b_idx), n_bgr = patch_out.pop(jj)
+        f_tot.append(f)
+        bl_tot.append(bl)
+        c1_tot.append(c1)
+        neurons_sn_tot.append(neurons_sn)
+        g_tot.append(g)
+        idx_tot.append(idx_)
+        shapes_tot.append(shapes)
+        if isinstance(b_data, list):
+            b_tot += b_data
+            idx_tot_B += b_idx
+        else:
+            b_tot.append(b_data)
+            idx_tot_B.append(b_idx)
+        idx_ptr_B += b_ptr
+        count_bgr += n_bgr
+        if nb_patch >= 0:
+            F_tot[patch_id * nb_patch:(patch_id + 1) * nb_patch] = f
+        else:  # full background per patch
+            F_tot = np.concatenate([F_tot, f])
+
     if count_bgr > 0:
         idx_tot_B = np.concatenate(idx_tot_B)
         b_tot = np.concatenate(b_tot)
@@ -391,13 +539,15 @@ def run_CNMF_patches(file_name, shape, params, gnb=1, dview=None,
 
     if len(idx_tot_A):
         idx_tot_A = np.concatenate(idx_tot_A)
-        a_tot = np.concatenate(a_tot)
+        a_tot = np.concatenate(a_data)
         idx_ptr_A = np.cumsum(np.array(idx_ptr_A))
+    else:
+        a_tot = []
+    del a_data
     A_tot = scipy.sparse.csc_matrix(
         (a_tot, idx_tot_A, idx_ptr_A), shape=(d, count), dtype=np.float32)
+    del a_tot
 
-    C_tot = C_tot[:count, :]
-    YrA_tot = YrA_tot[:count, :]
     F_tot = F_tot[:count_bgr]
 
     optional_outputs = dict()
@@ -414,6 +564,8 @@ def run_CNMF_patches(file_name, shape, params, gnb=1, dview=None,
     optional_outputs['B'] = B_tot
     optional_outputs['F'] = F_tot
     optional_outputs['mask'] = mask
+    optional_outputs['patch_times'] = patch_times
+    optional_outputs['patch_costs'] = costs
 
     logging.info("Constructing background")
 
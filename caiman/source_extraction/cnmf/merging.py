@@ -16,6 +16,7 @@ import scipy
 from scipy.sparse import csgraph, csc_matrix, lil_matrix, csr_matrix
 
 from .spatial import update_spatial_components, threshold_components
+from ...cluster import get_executor
 from .temporal import update_temporal_components
 from .deconvolution import constrained_foopsi
 from .utilities import update_order_greedy
@@ -204,13 +205,7 @@ def merge_components(Y, A, b, C, R, f, S, sn_pix, temporal_params,
             tps = [temporal_params]*nbmrg
             gs = [g]*nbmrg
             
-            if dview is None:
-               merge_res = list(map(merge_iter, zip(Acsc_mats, C_to_norms, Ctmp_mats, fms, gs, g_idxs, indxs, tps)))
-            elif 'multiprocessin' in str(type(dview)):
-               merge_res = list(dview.map(merge_iter, zip(Acsc_mats, C_to_norms, Ctmp_mats, fms, gs, g_idxs, indxs, tps)))
-            else:
-               merge_res = list(dview.map_sync(merge_iter, zip(Acsc_mats, C_to_norms, Ctmp_mats, fms, gs, g_idxs, indxs, tps)))
-               dview.results.clear()        
+            merge_res = get_executor(dview).map(merge_iter, zip(Acsc_mats, C_to_norms, Ctmp_mats, fms, gs, g_idxs, indxs, tps))
             #merge_res = list(dview.map(merge_iter, zip(Acsc_mats, C_to_norms, Ctmp_mats, fms, gs, g_idxs, indxs, tps)))
             bl_merged = np.array([res[0] for res in merge_res])
             c1_merged = np.array([res[1] for res in merge_res])
@@ -22,10 +22,129 @@ cdef struct Pool:
     Py_ssize_t l
 
 
+cdef struct _State:
+    # pointers to the state of an OASIS instance, for use without the GIL
+    vector[Pool]* P
+    vector[SINGLE]* y
+    Py_ssize_t* i
+    unsigned int* t
+    SINGLE g, g2, lam, s_min, b, d, r
+    SINGLE* h
+    SINGLE* g12
+    SINGLE* g11g11
+    SINGLE* g11g12
+
+
 cdef min1000(a):
     return a if a < 1000 else 1000
 
 
+cdef inline Py_ssize_t _min1000(Py_ssize_t a) nogil:
+    return a if a < 1000 else 1000
+
+
+cdef inline bint _ar2_violation(_State s, Py_ssize_t i) nogil:
+    """whether the pools i-1 and i of an AR(2) instance violate the constraints"""
+    cdef Py_ssize_t l
+    cdef double tmp
+    if i == 1:
+        return s.P[0][0].w * s.d > s.P[0][1].v - s.s_min
+    l = s.P[0][i - 1].l
+    if l >= 1000:
+        if s.d != s.r:
+            tmp = s.P[0][i - 1].v * s.d**(l + 1) / (s.d - s.r)
+        else:
+            tmp = (s.P[0][i - 1].v * s.d**l * (l + 1) -
+                   s.P[0][i - 2].w * s.d**(l + 2) * (l + 1))
+    else:
+        tmp = s.h[l] * s.P[0][i - 1].v + s.g12[l] * s.P[0][i - 2].w
+    return tmp > s.P[0][i].v - s.s_min
+
+
+@cython.cdivision(True)
+cdef void _fit_next(_State s, SINGLE yt) noexcept nogil:
+    """fit next time step t, see OASIS.fit_next"""
+    cdef Pool newpool
+    cdef Py_ssize_t i, j, k
+    cdef SINGLE tmp
+    cdef vector[Pool]* P = s.P
+    if s.g2 == 0:  # AR(1)
+        newpool.v = yt - s.b - s.lam * (1 - s.g)
+        newpool.w, newpool.t, newpool.l = 1, s.t[0], 1
+        P.push_back(newpool)
+        s.t[0] += 1
+        i = s.i[0] + 1
+        while (i > 0 and  # backtrack until violations fixed
+               (P[0][i - 1].v / P[0][i - 1].w * s.g**P[0][i - 1].l +
+                s.s_min > P[0][i].v / P[0][i].w)):
+            i -= 1
+            # merge two pools
+            P[0][i].v += P[0][i + 1].v * s.g**P[0][i].l
+            P[0][i].w += P[0][i + 1].w * s.g**(2 * P[0][i].l)
+            P[0][i].l += P[0][i + 1].l
+            P.pop_back()
+    else:  # AR(2)
+        s.y.push_back(yt - s.b - s.lam * (1 - s.g - s.g2))
+        newpool.v = fmax(0, s.y[0][s.t[0]])
+        newpool.w, newpool.t, newpool.l = newpool.v, s.t[0], 1
+        P.push_back(newpool)
+        s.t[0] += 1
+        i = s.i[0] + 1
+        while i > 0 and _ar2_violation(s, i):  # backtrack until violations fixed
+            i -= 1
+            # merge two pools
+            P[0][i].l += P[0][i + 1].l
+            k = P[0][i].l - 1
+            if i > 0:
+                if k >= 1000:
+                    k = 999  # precomputed kernel shorter than ISI -> simply truncate
+                tmp = 0
+                for j in range(_min1000(P[0][i].l)):
+                    tmp += s.h[j] * s.y[0][P[0][i].t + j]
+                P[0][i].v = ((tmp - s.g11g12[k] * P[0][i - 1].w) /
+                             s.g11g11[k])
+                P[0][i].w = (s.h[k] * P[0][i].v +
+                             s.g12[k] * P[0][i - 1].w)
+            else:  # update first pool
+                tmp = 0
+                for j in range(P[0][i].l):
+                    tmp += s.d**j * s.y[0][j]
+                P[0][i].v = fmax(0, tmp * (1 - s.d * s.d) /
+                                 (1 - s.d**(2 * P[0][i].l)))
+                P[0][i].w = s.d**k * P[0][i].v
+            P.pop_back()
+    s.i[0] = i
+
+
+@cython.cdivision(True)
+cdef void _c_of_last_pool(_State s, SINGLE* c, Py_ssize_t num) noexcept nogil:
+    """write the denoised calcium of the last num time steps of the last pool into c"""
+    cdef Pool* last = &s.P[0][s.i[0]]
+    cdef Py_ssize_t k, off = last.l - num
+    cdef SINGLE tmp
+    for k in range(num):
+        c[k] = 0
+    if s.g2 == 0:  # AR(1)
+        tmp = last.v / last.w
+        for k in range(off, _min1000(last.l)):
+            c[k - off] = tmp * s.h[k]
+        # # more accurate exponential decay instead truncation
+        # for k in range(1000, last.l):
+        #     c[k] = c[k - 1] * s.g
+    elif s.i[0] == 0:  # AR(2), first pool
+        tmp = last.v
+        for k in range(last.l):
+            if k >= off:
+                c[k - off] = tmp
+            tmp = tmp * s.d
+    else:  # AR(2)
+        for k in range(off, _min1000(last.l)):
+            c[k - off] = s.h[k] * last.v + s.g12[k] * s.P[0][s.i[0] - 1].w
+        # # more accurate exponential decay instead truncation
+        # for k in range(1000, last.l):
+        #     c[k] = c[k - 1] * s.d
+
+
 cdef class OASIS:
     """
     Deconvolution class implementing OASIS
@@ -137,72 +256,59 @@ cdef class OASIS:
                 self.i = -1
             self._y = [0] * num_empty_samples
 
+    cdef _State _state(self):
+        cdef _State s
+        s.P, s.y, s.i, s.t = &self.P, &self._y, &self.i, &self.t
+        s.g, s.g2, s.lam, s.s_min, s.b, s.d, s.r = (
+            self.g, self.g2, self.lam, self.s_min, self.b, self.d, self.r)
+        s.h, s.g12, s.g11g11, s.g11g12 = &self.h[0], &self.g12[0], &self.g11g11[0], &self.g11g12[0]
+        return s
+
+    def __reduce__(self):
+        # the precomputed kernels are stored along with the pools and the trace (AR(2)),
+        # recomputing them from the single precision parameters would not reproduce them
+        return (OASIS, (self.g, self.lam, self.s_min, self.b, 0, self.g2), self.__getstate__())
+
+    def __getstate__(self):
+        cdef Py_ssize_t j, n = self.P.size()
+        v, w = np.empty(n, dtype='float32'), np.empty(n, dtype='float32')
+        t, l = np.empty(n, dtype=np.intp), np.empty(n, dtype=np.intp)
+        cdef SINGLE[:] v_ = v, w_ = w
+        cdef Py_ssize_t[:] t_ = t, l_ = l
+        for j in range(n):
+            v_[j], w_[j], t_[j], l_[j] = self.P[j].v, self.P[j].w, self.P[j].t, self.P[j].l
+        kernels = np.empty((4, 1000), dtype='float32')
+        cdef SINGLE[:, :] k_ = kernels
+        for j in range(1000):
+            k_[0, j], k_[1, j], k_[2, j], k_[3, j] = self.h[j], self.g12[j], self.g11g11[j], self.g11g12[j]
+        return {'v': v, 'w': w, 'pool_t': t, 'pool_l': l, 'kernels': kernels, 'd': self.d, 'r': self.r,
+                'y': np.array(self._y, dtype='float32'), 't': self.t}
+
+    def __setstate__(self, state):
+        cdef Py_ssize_t j
+        cdef Pool pool
+        cdef SINGLE[:] v_ = np.asarray(state['v'], dtype='float32')
+        cdef SINGLE[:] w_ = np.asarray(state['w'], dtype='float32')
+        cdef Py_ssize_t[:] t_ = np.asarray(state['pool_t'], dtype=np.intp)
+        cdef Py_ssize_t[:] l_ = np.asarray(state['pool_l'], dtype=np.intp)
+        cdef SINGLE[:, :] k_ = np.asarray(state['kernels'], dtype='float32')
+        for j in range(1000):
+            self.h[j], self.g12[j], self.g11g11[j], self.g11g12[j] = k_[0, j], k_[1, j], k_[2, j], k_[3, j]
+        self.d, self.r = state['d'], state['r']
+        self.P.clear()
+        self.P.reserve(v_.shape[0])
+        for j in range(v_.shape[0]):
+            pool.v, pool.w, pool.t, pool.l = v_[j], w_[j], t_[j], l_[j]
+            self.P.push_back(pool)
+        self._y = state['y']
+        self.t = state['t']
+        self.i = self.P.size() - 1
+
     def fit_next(self, yt):
         """
         fit next time step t
         """
-        cdef Pool newpool
-        cdef Py_ssize_t j, k
-        cdef np.ndarray[SINGLE, ndim = 1] h, g12, g11g11, g11g12
-        cdef SINGLE tmp
-        if self.g2 == 0:  # AR(1)
-            newpool.v = yt - self.b - self.lam * (1 - self.g)
-            newpool.w, newpool.t, newpool.l = 1, self.t, 1
-            self.P.push_back(newpool)
-            self.t += 1
-            self.i += 1
-            while (self.i > 0 and  # backtrack until violations fixed
-                   (self.P[self.i - 1].v / self.P[self.i - 1].w * self.g**self.P[self.i - 1].l +
-                    self.s_min > self.P[self.i].v / self.P[self.i].w)):
-                self.i -= 1
-                # merge two pools
-                self.P[self.i].v += self.P[self.i + 1].v * self.g**self.P[self.i].l
-                self.P[self.i].w += self.P[self.i + 1].w * self.g**(2 * self.P[self.i].l)
-                self.P[self.i].l += self.P[self.i + 1].l
-                self.P.pop_back()
-        else:  # AR(2)
-            self._y.push_back(yt - self.b - self.lam * (1 - self.g - self.g2))
-            newpool.v = fmax(0, self._y[self.t])
-            newpool.w, newpool.t, newpool.l = newpool.v, self.t, 1
-            self.P.push_back(newpool)
-            self.t += 1
-            self.i += 1
-            while (self.i > 0 and  # backtrack until violations fixed
-                   (((((self.P[self.i - 1].v * self.d**(self.P[self.i - 1].l + 1) /
-                        (self.d - self.r))
-                       if self.d != self.r else
-                       (self.P[self.i - 1].v * self.d**self.P[self.i - 1].l * \
-                        (self.P[self.i - 1].l + 1) -
-                        self.P[self.i - 2].w * self.d**(self.P[self.i - 1].l + 2) * \
-                        (self.P[self.i - 1].l + 1)))
-                       if self.P[self.i - 1].l >= 1000 else
-                       (self.h[self.P[self.i - 1].l] * self.P[self.i - 1].v +
-                        self.g12[self.P[self.i - 1].l] * self.P[self.i - 2].w)) >
-                       self.P[self.i].v - self.s_min)
-                    if self.i > 1 else
-                    (self.P[self.i - 1].w * self.d > self.P[self.i].v - self.s_min))):
-                self.i -= 1
-                # merge two pools
-                self.P[self.i].l += self.P[self.i + 1].l
-                k = self.P[self.i].l - 1
-                if self.i > 0:
-                    if k >= 1000:
-                        k = 999  # precomputed kernel shorter than ISI -> simply truncate
-                    tmp = 0
-                    for j in range(min1000(self.P[self.i].l)):
-                        tmp += self.h[j] * self._y[self.P[self.i].t + j]
-                    self.P[self.i].v = ((tmp - self.g11g12[k] * self.P[self.i - 1].w) /
-                                        self.g11g11[k])
-                    self.P[self.i].w = (self.h[k] * self.P[self.i].v +
-                                        self.g12[k] * self.P[self.i - 1].w)
-                else:  # update first pool
-                    tmp = 0
-                    for j in range(self.P[self.i].l):
-                        tmp += self.d**j * self._y[j]
-                    self.P[self.i].v = fmax(0, tmp * (1 - self.d * self.d) /
-                                            (1 - self.d**(2 * self.P[self.i].l)))
-                    self.P[self.i].w = self.d**k * self.P[self.i].v
-                self.P.pop_back()
+        _fit_next(self._state(), yt)
 
     def fit_next_tmp(self, yt, num):
         """
@@ -471,27 +577,8 @@ cdef class OASIS:
         return denoised calcium of last pool, i.e. the part of c that actually changed
         """
         cdef np.ndarray[SINGLE, ndim = 1] c
-        cdef Py_ssize_t k
-        cdef SINGLE tmp
         c = np.zeros(self.P[self.i].l, dtype='float32')
-        if self.g2 == 0:  # AR(1)
-            tmp = self.P[self.i].v / self.P[self.i].w
-            for k in range(min1000(self.P[self.i].l)):
-                c[k] = tmp * self.h[k]
-            # # more accurate exponential decay instead truncation
-            # for k in range(1000, self.P[self.i].l):
-            #     c[k] = c[k - 1] * self.g
-        else:  # AR(2)
-            if self.i == 0:  # first pool
-                c[0] = self.P[0].v
-                for k in range(1, self.P[0].l):
-                    c[k] = c[k - 1] * self.d
-            else:
-                for k in range(min1000(self.P[self.i].l)):
-                    c[k] = self.h[k] * self.P[self.i].v + self.g12[k] * self.P[self.i - 1].w
-                # # more accurate exponential decay instead truncation
-                # for k in range(1000, self.P[self.i].l):
-                #     c[k] = c[k - 1] * self.d
+        _c_of_last_pool(self._state(), &c[0], self.P[self.i].l)
         return c
 
     def remove_last_pool(self):
@@ -591,6 +678,45 @@ cdef class OASIS:
             return self.get_s(self.P[self.i].t + self.P[self.i].l)
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def fit_next_all(list oases, SINGLE[:] y, SINGLE[:, ::1] C=None, Py_ssize_t t=0):
+    """
+    fit the next time step of many OASIS instances with a single call, which
+    releases the GIL while the instances are updated
+
+    Parameters
+    ----------
+    oases : list of OASIS
+        instances to update
+    y : array of float32
+        next value of the trace of each instance
+    C : 2d array of float32, optional
+        if given, the denoised calcium of the last pool of instance n, i.e. the
+        part that changed, is written into C[n, t - l + 1:t + 1] with l the
+        length of the pool (at most t + 1)
+    t : int
+        time step of y in C
+    """
+    cdef Py_ssize_t n, l, N = len(oases)
+    cdef bint write_c = C is not None
+    cdef vector[_State] states
+    cdef OASIS o
+    if y.shape[0] != N or (write_c and (C.shape[0] != N or C.shape[1] <= t)):
+        raise ValueError('The sizes of y and C do not match the number of instances')
+    states.reserve(N)
+    for o in oases:
+        states.push_back(o._state())
+    with nogil:
+        for n in range(N):
+            _fit_next(states[n], y[n])
+            if write_c:
+                l = states[n].P[0][states[n].i[0]].l
+                if l > t + 1:
+                    l = t + 1
+                _c_of_last_pool(states[n], &C[n, t + 1 - l], l)
+
+
 @cython.cdivision(True)
 def oasisAR1(np.ndarray[SINGLE, ndim=1] y, SINGLE g, SINGLE lam=0, SINGLE s_min=0):
     """ Infer the most likely discretized spike train underlying an AR(1) fluorescence trace
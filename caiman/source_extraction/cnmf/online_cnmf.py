@@ -14,17 +14,23 @@ imaging data in real time. In Advances in Neural Information Processing Systems
 @url http://papers.nips.cc/paper/6832-onacid-online-analysis-of-calcium-imaging-data-in-real-time
 """
 
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import logging
 from math import sqrt
 from multiprocessing import cpu_count
 import numpy as np
+import os
+import pickle
+import queue
 from scipy.ndimage import percentile_filter
 from scipy.sparse import coo_matrix, csc_matrix, spdiags, hstack
 from scipy.stats import norm
 from sklearn.decomposition import NMF
 from sklearn.preprocessing import normalize
 import tensorflow as tf
+import threading
 from time import time
 from typing import List, Tuple
 
@@ -33,15 +39,16 @@ import caiman.paths
 from .cnmf import CNMF
 from .estimates import Estimates
 from .initialization import imblur, initialize_components, hals, downscale
-from .oasis import OASIS
+from .oasis import OASIS, fit_next_all
 from .params import CNMFParams
 from .pre_processing import get_noise_fft
-from .utilities import (update_order, get_file_size, peak_local_max, decimation_matrix,
+from .utilities import (update_order, update_order_incremental, get_file_size, peak_local_max, decimation_matrix,
                         gaussian_filter, uniform_filter)
 from ... import mmapping
+from ...cluster import get_executor
 from ...components_evaluation import compute_event_exceptionality
 from ...motion_correction import (motion_correct_iteration_fast,
-                                  tile_and_correct, tile_and_correct_3d,
+                                  tile_and_correct, tile_and_correct_3d, tile_and_correct_flow,
                                   high_pass_filter_space, sliding_window,
                                   register_translation_3d, apply_shifts_dft)
 from ...utils.utils import save_dict_to_hdf5, load_dict_from_hdf5, parmap, load_graph
@@ -58,6 +65,12 @@ try:
 except:
     def profile(a): return a
 
+# version of the format of OnACID.save_state, and attributes that are not
+# saved since they are recreated when the state is loaded
+ONACID_STATE_VERSION = 1
+_TRANSIENT_ATTRS = ('dview', 'loaded_model', 'tf_in', 'tf_out')
+
+
 class OnACID(object):
     """  Source extraction of streaming data using online matrix factorization.
     The class can be initialized by passing a "params" object for setting up
@@ -266,7 +279,7 @@ class OnACID(object):
         self.estimates.sn = np.array(np.std(self.estimates.Yres_buf,axis=0))
         self.estimates.vr = np.array(np.var(self.estimates.Yres_buf,axis=0))
         self.estimates.mn = self.estimates.Yres_buf.mean(0)
-        self.estimates.mean_buff = self.estimates.Yres_buf.mean(0)
+        self.estimates.mean_buff = self.estimates.Yres_buf.running_mean()
         self.estimates.ind_new = []
         if self.params.get('online', 'use_corr_img'):
             self.estimates.rho_buf = None
@@ -284,6 +297,7 @@ class OnACID(object):
         self.estimates.AtA = (self.estimates.Ab.T.dot(self.estimates.Ab)).toarray()
         self.estimates.AtY_buf = self.estimates.Ab.T.dot(self.estimates.Yr_buf.T)
         self.estimates.groups = list(map(list, update_order(self.estimates.Ab)[0]))
+        self.num_groups_greedy = len(self.estimates.groups)
         self.update_counter = 2**np.linspace(0, 1, self.N, dtype=np.float32)
         self.estimates.CC = np.ascontiguousarray(self.estimates.CC)
         self.estimates.CY = np.ascontiguousarray(self.estimates.CY)
@@ -294,42 +308,7 @@ class OnACID(object):
             self.time_spend = 0
             self.comp_upd:List = []
         # setup per patch classifier
-
-        if self.params.get('online', 'path_to_model') is None or self.params.get('online', 'sniper_mode') is False:
-            loaded_model = None
-            self.params.set('online', {'sniper_mode': False})
-            self.tf_in = None
-            self.tf_out = None
-        else:
-            try:
-                from tensorflow.keras.models import model_from_json
-                logging.info('Using Keras')
-                use_keras = True
-            except(ModuleNotFoundError):
-                use_keras = False
-                logging.info('Using Tensorflow')
-            if use_keras:
-                path = self.params.get('online', 'path_to_model').split(".")[:-1]
-                json_path = ".".join(path + ["json"])
-                model_path = ".".join(path + ["h5"])
-                json_file = open(json_path, 'r')
-                loaded_model_json = json_file.read()
-                json_file.close()
-                loaded_model = model_from_json(loaded_model_json)
-                loaded_model.load_weights(model_path)
-                #opt = tf.keras.optimizers.rmsprop(lr=0.0001, decay=1e-6)
-                #loaded_model.compile(loss=tf.keras.losses.categorical_crossentropy,
-                #                     optimizer=opt, metrics=['accuracy'])
-                self.tf_in = None
-                self.tf_out = None
-            else:
-                path = self.params.get('online', 'path_to_model').split(".")[:-1]
-                model_path = '.'.join(path + ['h5', 'pb'])
-                loaded_model = load_graph(model_path)
-                self.tf_in = loaded_model.get_tensor_by_name('prefix/conv2d_1_input:0')
-                self.tf_out = loaded_model.get_tensor_by_name('prefix/output_node0:0')
-                loaded_model = tf.Session(graph=loaded_model)
-        self.loaded_model = loaded_model
+        self._load_classifier()
 
         if self.is1p:
             from skimage.morphology import disk
@@ -341,14 +320,6 @@ class OnACID(object):
             self._dims_B = ((self.estimates.dims[0] - 1) // ssub_B + 1,
                             (self.estimates.dims[1] - 1) // ssub_B + 1)
 
-            def get_indices_of_pixels_on_ring(self, pixel):
-                pixel = np.unravel_index(pixel, self._dims_B, order='F')
-                x = pixel[0] + self._ringidx[0]
-                y = pixel[1] + self._ringidx[1]
-                inside = (x >= 0) * (x < self._dims_B[0]) * (y >= 0) * (y < self._dims_B[1])
-                return np.ravel_multi_index((x[inside], y[inside]), self._dims_B, order='F')
-            self.get_indices_of_pixels_on_ring = get_indices_of_pixels_on_ring.__get__(self)
-
             # generate list of indices of XX' that get accessed
             if self.params.get('online', 'full_XXt'):
                 l = np.prod(self._dims_B)
@@ -378,6 +349,7 @@ class OnACID(object):
             self.estimates.max_img = Yres.max(-1)
 
         self.comp_upd = []
+        self.shapes_deferred = False
         self.t_shapes:List = []
         self.t_detect:List = []
         self.t_motion:List = []
@@ -385,8 +357,55 @@ class OnACID(object):
 
         return self
 
+    def _load_classifier(self):
+        """load the CNN classifier of candidate components (sniper_mode)"""
+        if self.params.get('online', 'path_to_model') is None or self.params.get('online', 'sniper_mode') is False:
+            loaded_model = None
+            self.params.set('online', {'sniper_mode': False})
+            self.tf_in = None
+            self.tf_out = None
+        else:
+            try:
+                from tensorflow.keras.models import model_from_json
+                logging.info('Using Keras')
+                use_keras = True
+            except(ModuleNotFoundError):
+                use_keras = False
+                logging.info('Using Tensorflow')
+            if use_keras:
+                path = self.params.get('online', 'path_to_model').split(".")[:-1]
+                json_path = ".".join(path + ["json"])
+                model_path = ".".join(path + ["h5"])
+                json_file = open(json_path, 'r')
+                loaded_model_json = json_file.read()
+                json_file.close()
+                loaded_model = model_from_json(loaded_model_json)
+                loaded_model.load_weights(model_path)
+                #opt = tf.keras.optimizers.rmsprop(lr=0.0001, decay=1e-6)
+                #loaded_model.compile(loss=tf.keras.losses.categorical_crossentropy,
+                #                     optimizer=opt, metrics=['accuracy'])
+                self.tf_in = None
+                self.tf_out = None
+            else:
+                path = self.params.get('online', 'path_to_model').split(".")[:-1]
+                model_path = '.'.join(path + ['h5', 'pb'])
+                loaded_model = load_graph(model_path)
+                self.tf_in = loaded_model.get_tensor_by_name('prefix/conv2d_1_input:0')
+                self.tf_out = loaded_model.get_tensor_by_name('prefix/output_node0:0')
+                loaded_model = tf.Session(graph=loaded_model)
+        self.loaded_model = loaded_model
+
+    def get_indices_of_pixels_on_ring(self, pixel):
+        """indices of the (downsampled) pixels on the ring around pixel (1p data)"""
+        pixel = np.unravel_index(pixel, self._dims_B, order='F')
+        x = pixel[0] + self._ringidx[0]
+        y = pixel[1] + self._ringidx[1]
+        inside = (x >= 0) * (x < self._dims_B[0]) * (y >= 0) * (y < self._dims_B[1])
+        return np.ravel_multi_index((x[inside], y[inside]), self._dims_B, order='F')
+
     @profile
-    def fit_next(self, t, frame_in, num_iters_hals=3):
+    def fit_next(self, t, frame_in, num_iters_hals=3, find_new=True, shape_update=True,
+                 AtY=None, AtWy=None, noise_update=True):
         """
         This method fits the next frame using the CaImAn online algorithm and
         updates the object.
@@ -400,6 +419,24 @@ class OnACID(object):
 
             num_iters_hals: int, optional
                 maximal number of iterations for HALS (NNLS via blockCD)
+
+            find_new: bool, optional
+                search for new components in this frame (if update_num_comps is set)
+
+            shape_update: bool, optional
+                if False a shape update due at this frame is deferred to the next frame
+                where shape_update is True
+
+            AtY: array, optional
+                projection Ab.T.dot(frame_in) of the frame on the current shapes, if
+                already computed (see fit_next_batch)
+
+            AtWy: array, optional
+                for 1p data, projection of the frame on AtW, if already computed
+
+            noise_update: bool, optional
+                update the mean and variance of the residuals. fit_next_batch sets it
+                to False when it updates them for a block of frames at once
         """
 
         t_start = time()
@@ -413,7 +450,7 @@ class OnACID(object):
         frame = frame_in.astype(np.float32)
         self.estimates.Yr_buf.append(frame)
         if len(self.estimates.ind_new) > 0:
-            self.estimates.mean_buff = self.estimates.Yres_buf.mean(0)
+            self.estimates.mean_buff = self.estimates.Yres_buf.running_mean()
 
         if (not self.params.get('online', 'simultaneously')) or self.params.get('preprocess', 'p') == 0:
             # get noisy fluor value via NNLS (project data on shapes & demix)
@@ -423,16 +460,16 @@ class OnACID(object):
                     frame, self.estimates.Ab, C_in, self.estimates.AtA, Atb=self.estimates.Atb,
                     AtW=self.estimates.AtW, AtWA=self.estimates.AtWA, iters=num_iters_hals,
                     groups=self.estimates.groups, ssub_B=ssub_B, 
-                    downscale_matrix=self.estimates.downscale_matrix if ssub_B > 1 else None)
+                    downscale_matrix=self.estimates.downscale_matrix if ssub_B > 1 else None,
+                    AtY=AtY, AtWy=AtWy)
             else:
                 self.estimates.C_on[:self.M, t], self.estimates.noisyC[:self.M, t] = HALS4activity(
-                    frame, self.estimates.Ab, C_in, self.estimates.AtA, iters=num_iters_hals, groups=self.estimates.groups)
+                    frame, self.estimates.Ab, C_in, self.estimates.AtA, iters=num_iters_hals,
+                    groups=self.estimates.groups, AtY=AtY)
             if self.params.get('preprocess', 'p'):
-                # denoise & deconvolve
-                for i, o in enumerate(self.estimates.OASISinstances):
-                    o.fit_next(self.estimates.noisyC[nb_ + i, t])
-                    self.estimates.C_on[nb_ + i, t - o.get_l_of_last_pool() +
-                              1: t + 1] = o.get_c_of_last_pool()
+                # denoise & deconvolve all components with a single call
+                fit_next_all(self.estimates.OASISinstances, self.estimates.noisyC[nb_:self.M, t],
+                             self.estimates.C_on[nb_:self.M], t)
 
         else:
             if self.is1p:
@@ -441,8 +478,10 @@ class OnACID(object):
             # update buffer, initialize C with previous value
             self.estimates.C_on[:, t] = self.estimates.C_on[:, t - 1]
             self.estimates.noisyC[:, t] = self.estimates.C_on[:, t - 1]
-            self.estimates.AtY_buf = np.concatenate((self.estimates.AtY_buf[:, 1:], self.estimates.Ab.T.dot(frame)[:, None]), 1) \
-                if self.params.get('online', 'n_refit') else self.estimates.Ab.T.dot(frame)[:, None]
+            if AtY is None:
+                AtY = self.estimates.Ab.T.dot(frame)
+            self.estimates.AtY_buf = np.concatenate((self.estimates.AtY_buf[:, 1:], AtY[:, None]), 1) \
+                if self.params.get('online', 'n_refit') else AtY[:, None]
             # demix, denoise & deconvolve
             (self.estimates.C_on[:self.M, t + 1 - mbs:t + 1], self.estimates.noisyC[:self.M, t + 1 - mbs:t + 1],
                 self.estimates.OASISinstances) = demix_and_deconvolve(
@@ -455,21 +494,22 @@ class OnACID(object):
                           1] = o.get_c_of_last_pool()
 
         #self.estimates.mean_buff = self.estimates.Yres_buf.mean(0)
-        res_frame = frame - self.estimates.Ab.dot(self.estimates.C_on[:self.M, t])
-        if self.is1p:
-            self.estimates.b0 = self.estimates.b0 * (t-1)/t + res_frame/t
-            res_frame -= self.estimates.b0
-            res_frame -= (self.estimates.W.dot(res_frame) if ssub_B == 1 else
-                          self.estimates.upscale_matrix.dot(self.estimates.W.dot(
-                            self.estimates.downscale_matrix.dot(res_frame))))
-        mn_ = self.estimates.mn.copy()
-        self.estimates.mn = (t-1)/t*self.estimates.mn + res_frame/t
-        self.estimates.vr = (t-1)/t*self.estimates.vr + (res_frame - mn_)*(res_frame - self.estimates.mn)/t
-        self.estimates.sn = np.sqrt(self.estimates.vr)
+        if noise_update or self.is1p:
+            res_frame = frame - self.estimates.Ab.dot(self.estimates.C_on[:self.M, t])
+            if self.is1p:
+                self.estimates.b0 = self.estimates.b0 * (t-1)/t + res_frame/t
+                res_frame -= self.estimates.b0
+                res_frame -= (self.estimates.W.dot(res_frame) if ssub_B == 1 else
+                              self.estimates.upscale_matrix.dot(self.estimates.W.dot(
+                                self.estimates.downscale_matrix.dot(res_frame))))
+            mn_ = self.estimates.mn.copy()
+            self.estimates.mn = (t-1)/t*self.estimates.mn + res_frame/t
+            self.estimates.vr = (t-1)/t*self.estimates.vr + (res_frame - mn_)*(res_frame - self.estimates.mn)/t
+            self.estimates.sn = np.sqrt(self.estimates.vr)
         
         t_new = time()
         num_added = 0
-        if self.params.get('online', 'update_num_comps'):
+        if self.params.get('online', 'update_num_comps') and find_new:
 
             if self.params.get('online', 'use_corr_img'):
                 corr_img_mode = 'simple'  #'exponential'  # 'cumulative'
@@ -481,8 +521,8 @@ class OnACID(object):
                     self.estimates.num_neigbors, self.estimates.corrM,
                     del_frames=[self.estimates.Yres_buf[self.estimates.Yres_buf.cur]]
                     if corr_img_mode == 'simple' else None)
-            self.estimates.mean_buff += (res_frame-self.estimates.Yres_buf[self.estimates.Yres_buf.cur])/self.params.get('online', 'minibatch_shape')
             self.estimates.Yres_buf.append(res_frame)
+            self.estimates.mean_buff = self.estimates.Yres_buf.running_mean()
 
             res_frame = np.reshape(res_frame, self.estimates.dims, order='F')
 
@@ -529,6 +569,7 @@ class OnACID(object):
                 use_peak_max=self.params.get('online', 'use_peak_max'),
                 mean_buff=self.estimates.mean_buff,
                 tf_in=self.tf_in, tf_out=self.tf_out,
+                cnn_thread=self.params.get('online', 'cnn_thread'),
                 ssub_B=ssub_B, W=self.estimates.W if self.is1p else None,
                 b0=self.estimates.b0 if self.is1p else None,
                 corr_img=self.estimates.corr_img if use_corr else None,
@@ -609,9 +650,7 @@ class OnACID(object):
 
                 # self.estimates.AtA = (Ab_.T.dot(Ab_)).toarray()
                 # faster incremental update of AtA instead of above line:
-                AtA = self.estimates.AtA
-                self.estimates.AtA = np.zeros((self.M, self.M), dtype=np.float32)
-                self.estimates.AtA[:-num_added, :-num_added] = AtA
+                self.estimates.AtA = grow_square(self.estimates.AtA, num_added, np.float32)
                 if self.params.get('online', 'use_dense'):
                     self.estimates.AtA[:, -num_added:] = self.estimates.Ab.T.dot(
                         self.estimates.Ab_dense[:, self.M - num_added:self.M])
@@ -637,9 +676,7 @@ class OnACID(object):
                         # self.estimates.AtWA = self.estimates.AtW.dot(Ab_).toarray()
                         # faster incremental update of AtW and AtWA instead of above lines:
                         csr_append(self.estimates.AtW, Ab_.T[-num_added:].dot(self.estimates.W))
-                        AtWA = self.estimates.AtWA
-                        self.estimates.AtWA = np.zeros((self.M, self.M), dtype=np.float32)
-                        self.estimates.AtWA[:-num_added, :-num_added] = AtWA
+                        self.estimates.AtWA = grow_square(self.estimates.AtWA, num_added, np.float32)
                         self.estimates.AtWA[:, -num_added:] = self.estimates.AtW.dot(
                             Ab_[:, -num_added:]).toarray()
                         self.estimates.AtWA[-num_added:] = self.estimates.AtW[-num_added:].dot(
@@ -652,9 +689,7 @@ class OnACID(object):
                         # self.estimates.AtWA = self.estimates.AtW.dot(A_ds).toarray()
                         # faster incremental update of AtW and AtWA instead of above lines:
                         csr_append(self.estimates.AtW, A_ds.T[-num_added:].dot(self.estimates.W))
-                        AtWA = self.estimates.AtWA
-                        self.estimates.AtWA = np.zeros((self.M, self.M), dtype=np.float32)
-                        self.estimates.AtWA[:-num_added, :-num_added] = AtWA
+                        self.estimates.AtWA = grow_square(self.estimates.AtWA, num_added, np.float32)
                         self.estimates.AtWA[:, -num_added:] = self.estimates.AtW.dot(
                             A_ds[:, -num_added:]).toarray()
                         self.estimates.AtWA[-num_added:] = self.estimates.AtW[-num_added:].dot(
@@ -678,11 +713,11 @@ class OnACID(object):
                 if self.is1p:  # subtract background
                     if ssub_B == 1:
                         x = (y - self.estimates.Ab.dot(ccf).T - self.estimates.b0).T
-                        y -= self.estimates.W.dot(x).T
+                        y = y - self.estimates.W.dot(x).T
                     else:
                         x = self.estimates.downscale_matrix.dot(
                             y.T - self.estimates.Ab.dot(ccf) - self.estimates.b0[:, None])
-                        y -= self.estimates.upscale_matrix.dot(self.estimates.W.dot(x)).T
+                        y = y - self.estimates.upscale_matrix.dot(self.estimates.W.dot(x)).T
                     y -= self.estimates.b0
                     # self.estimates.XXt += x.dot(x.T)
                     # exploit that we only access some elements of XXt, hence update only these
@@ -723,11 +758,11 @@ class OnACID(object):
             if self.is1p:  # subtract background
                 if ssub_B == 1:
                     x = (y - self.estimates.Ab.dot(ccf).T - self.estimates.b0).T
-                    y -= self.estimates.W.dot(x).T
+                    y = y - self.estimates.W.dot(x).T
                 else:
                     x = self.estimates.downscale_matrix.dot(
                         y.T - self.estimates.Ab.dot(ccf) - self.estimates.b0[:, None])
-                    y -= self.estimates.upscale_matrix.dot(self.estimates.W.dot(x)).T
+                    y = y - self.estimates.upscale_matrix.dot(self.estimates.W.dot(x)).T
                 y -= self.estimates.b0
                 # self.estimates.XXt += x.dot(x.T)
                 # exploit that we only access some elements of XXt, hence update only these
@@ -757,9 +792,11 @@ class OnACID(object):
 
         # update shapes
         t_sh = time()
+        shapes_due = ((t + 1 - self.params.get('online', 'init_batch')) %
+                      self.params.get('online', 'update_freq') == 0) or getattr(self, 'shapes_deferred', False)
+        self.shapes_deferred = shapes_due and not shape_update
         if not self.params.get('online', 'dist_shape_update'):  # bulk shape update
-            if ((t + 1 - self.params.get('online', 'init_batch')) %
-                    self.params.get('online', 'update_freq') == 0):
+            if shapes_due and shape_update:
                 logging.info('Updating Shapes')
 
                 if self.N > self.params.get('online', 'max_comp_update_shape'):
@@ -784,7 +821,15 @@ class OnACID(object):
                         indicator_components=indicator_components, sn=self.estimates.sn,
                         q=0.5, iters=self.params.get('online', 'iters_shape'))
 
-                self.estimates.AtA = (Ab_.T.dot(Ab_)).toarray()
+                if indicator_components is None:
+                    self.estimates.AtA = (Ab_.T.dot(Ab_)).toarray()
+                    changed = np.arange(self.M)
+                else:  # only the background and the updated components changed
+                    changed = np.concatenate([np.arange(nb_), indicator_components + nb_])
+                    self.estimates.AtA = update_AtA(self.estimates.AtA, Ab_, changed)
+                self.estimates.groups, self.num_groups_greedy = update_order_incremental(
+                    self.estimates.groups, self.estimates.AtA, changed=changed,
+                    num_groups_greedy=self.num_groups_greedy)
                 if self.is1p and ((t + 1 - self.params.get('online', 'init_batch')) %
                     (self.params.get('online', 'W_update_factor') * self.params.get('online', 'update_freq')) == 0):
                     W = self.estimates.W
@@ -819,13 +864,8 @@ class OnACID(object):
 #                            #return np.linalg.solve(a[0], a[1])
 #                            return np.linalg.solve(XXt_mats[p], XXt_vecs[p])
                        # W.data = np.concatenate(list(map(process_pixel2, range(W.shape[0]))))
-                        if self.dview is None: 
-                            W.data = np.concatenate(list(map(inv_mat_vec, zip(XXt_mats, XXt_vecs))))
-                        elif 'multiprocessing' in str(type(self.dview)):
-                            W.data = np.concatenate(list(self.dview.imap(inv_mat_vec, zip(XXt_mats, XXt_vecs), chunksize=256)))
-                        else:
-                            W.data = np.concatenate(list(self.dview.map_sync(inv_mat_vec, zip(XXt_mats, XXt_vecs))))
-                            self.dview.results.clear()
+                        W.data = np.concatenate(get_executor(self.dview).map(
+                            inv_mat_vec, zip(XXt_mats, XXt_vecs), chunksize=256))
                            
                        #W.data = np.concatenate(parmap(process_pixel2, range(W.shape[0])))
                        #W.data = np.concatenate(parmap(process_pixel2, zip(XXt_mats, XXt_vecs)))
@@ -874,7 +914,9 @@ class OnACID(object):
                     self.estimates.Ab = Ab_
                     self.ind_A = list(
                         [(self.estimates.Ab.indices[self.estimates.Ab.indptr[ii]:self.estimates.Ab.indptr[ii + 1]]) for ii in range(self.params.get('init', 'nb'), self.M)])
-                    self.estimates.groups = list(map(list, update_order(Ab_)[0]))
+                    self.estimates.groups, self.num_groups_greedy = update_order_incremental(
+                        self.estimates.groups, self.estimates.AtA, removed=ind_zero,
+                        num_groups_greedy=self.num_groups_greedy)
 
                 if self.params.get('online', 'n_refit'):
                     self.estimates.AtY_buf = Ab_.T.dot(self.estimates.Yr_buf.T)
@@ -882,7 +924,7 @@ class OnACID(object):
         else:  # distributed shape update
             self.update_counter *= 2**(-1. / self.params.get('online', 'update_freq'))
             # if not num_added:
-            if (not num_added) and (time() - t_start < 2*self.time_spend / (t - self.params.get('online', 'init_batch') + 1)):
+            if (not num_added) and shape_update and (time() - t_start < 2*self.time_spend / (t - self.params.get('online', 'init_batch') + 1)):
                 candidates = np.where(self.update_counter <= 1)[0]
                 if len(candidates):
                     indicator_components = candidates[:self.N // mbs + 1]
@@ -898,19 +940,19 @@ class OnACID(object):
                             indicator_components=indicator_components, update_bkgrd=update_bkgrd,
                             Ab_dense=self.estimates.Ab_dense[:, :self.M], sn=self.estimates.sn,
                             q=0.5, iters=self.params.get('online', 'iters_shape'))
-                        if update_bkgrd:
-                            self.estimates.AtA = (Ab_.T.dot(Ab_)).toarray()
-                        else:
-                            indicator_components += nb_
-                            self.estimates.AtA[indicator_components, indicator_components[:, None]] = \
-                                self.estimates.Ab_dense[:, indicator_components].T.dot(
-                                self.estimates.Ab_dense[:, indicator_components])
                     else:
                         Ab_, self.ind_A, _ = update_shapes(
                             self.estimates.CY, self.estimates.CC, Ab_, self.ind_A,
                             indicator_components=indicator_components, update_bkgrd=update_bkgrd,
                             q=0.5, iters=self.params.get('online', 'iters_shape'))
-                        self.estimates.AtA = (Ab_.T.dot(Ab_)).toarray()
+                    # only the updated components (and the background) changed
+                    changed = indicator_components + nb_
+                    if update_bkgrd:
+                        changed = np.concatenate([np.arange(nb_), changed])
+                    self.estimates.AtA = update_AtA(self.estimates.AtA, Ab_, changed)
+                    self.estimates.groups, self.num_groups_greedy = update_order_incremental(
+                        self.estimates.groups, self.estimates.AtA, changed=changed,
+                        num_groups_greedy=self.num_groups_greedy)
                 else:
                     self.comp_upd.append(0)
                 self.estimates.Ab = Ab_
@@ -921,11 +963,97 @@ class OnACID(object):
 
         return self
 
-    def initialize_online(self, model_LN=None, T=None):
+    def fit_next_batch(self, t, frames, num_iters_hals=3):
+        """
+        Fits a block of consecutive frames, with the same results as calling
+        fit_next on each of them up to numerical precision. It is meant for
+        processing stored data: the frames are projected on the shapes with one
+        sparse matrix product per block rather than one per frame, and unless
+        new components are searched for (or the data are 1p) the mean and
+        variance of the residuals are updated once per block.
+
+        Args
+            t : int
+                time of the first frame, measured in number of frames
+
+            frames : array
+                array of shape (# of frames, x * y [ * z]) with the flattened frames
+
+            num_iters_hals: int, optional
+                maximal number of iterations for HALS (NNLS via blockCD)
+        """
+        frames = np.asarray(frames, dtype=np.float32)
+        if self.params.get('online', 'dist_shape_update'):  # shapes can change at every frame
+            for k, frame in enumerate(frames):
+                self.fit_next(t + k, frame, num_iters_hals=num_iters_hals)
+            return self
+        init_batch = self.params.get('online', 'init_batch')
+        update_freq = self.params.get('online', 'update_freq')
+        ssub_B = self.params.get('init', 'ssub_B') * self.params.get('init', 'ssub')
+        # residuals are needed at every frame to search for new components and for the 1p background
+        noise_per_frame = self.is1p or self.params.get('online', 'update_num_comps')
+        j = 0
+        while j < len(frames):
+            # the shapes are constant until the next shape update, at the last frame of the segment
+            if getattr(self, 'shapes_deferred', False):
+                end = j + 1
+            else:
+                end = min(j + (init_batch - 1 - t - j) % update_freq + 1, len(frames))
+            Y = frames[j:end].T
+            AtY = self.estimates.Ab.T.dot(Y)
+            if self.is1p:
+                Y_ds = Y if ssub_B == 1 else self.estimates.downscale_matrix.dot(Y) * ssub_B**2
+                AtWy = self.estimates.AtW.dot(Y_ds)
+            # traces as fitted at each frame, before the deconvolution revises them
+            C = np.zeros((self.M, end - j), dtype=np.float32)
+            for k in range(j, end):
+                if not noise_per_frame and k == end - 1 and k > j:
+                    self._update_noise(t + j, Y[:, :k - j], C[:, :k - j])
+                self.fit_next(t + k, frames[k], num_iters_hals=num_iters_hals, AtY=AtY[:, k - j],
+                              AtWy=AtWy[:, k - j] if self.is1p else None,
+                              noise_update=noise_per_frame or k == end - 1)
+                if self.M > AtY.shape[0]:  # components were added
+                    AtY = np.vstack([AtY, self.estimates.Ab[:, AtY.shape[0]:self.M].T.dot(Y)])
+                    if self.is1p:
+                        AtWy = np.vstack([AtWy, self.estimates.AtW[AtWy.shape[0]:].dot(Y_ds)])
+                elif not noise_per_frame:
+                    C[:, k - j] = self.estimates.C_on[:self.M, t + k]
+            j = end
+        return self
+
+    def _update_noise(self, t, Y, C):
+        """Updates the mean and variance of the residuals with the frames t, t+1, ...
+        given as the columns of Y, with traces C, by merging the statistics of the
+        block with the running ones (which average over t - 1 frames)"""
+        res = Y - self.estimates.Ab.dot(C)
+        n_a, n_b = t - 1, res.shape[1]
+        n = n_a + n_b
+        mn_b = res.mean(1)
+        delta = mn_b - self.estimates.mn
+        M2 = n_a * self.estimates.vr + ((res - mn_b[:, None])**2).sum(1) + delta**2 * n_a * n_b / n
+        self.estimates.mn = (self.estimates.mn + delta * n_b / n).astype(self.estimates.mn.dtype)
+        self.estimates.vr = (M2 / n).astype(self.estimates.vr.dtype)
+        self.estimates.sn = np.sqrt(self.estimates.vr)
+
+    def initialize_online(self, model_LN=None, T=None, Y=None):
+        """Initialize the online algorithm on the first init_batch frames
+
+        Args:
+            model_LN: ring CNN model of the background (optional)
+
+            T: int
+                total number of frames to be processed (default: from the files in fnames times epochs)
+
+            Y: np.ndarray
+                first frames of the movie (time x dims). If None they are read from the first file in fnames
+        """
         fls = self.params.get('data', 'fnames')
         opts = self.params.get_group('online')
-        Y = caiman.load(fls[0], subindices=slice(0, opts['init_batch'],
-                 None), var_name_hdf5=self.params.get('data', 'var_name_hdf5')).astype(np.float32)
+        if Y is None:
+            Y = caiman.load(fls[0], subindices=slice(0, opts['init_batch'],
+                     None), var_name_hdf5=self.params.get('data', 'var_name_hdf5')).astype(np.float32)
+        else:
+            Y = caiman.movie(np.asarray(Y[:opts['init_batch']], dtype=np.float32))
         if model_LN is not None:
             Y = Y - caiman.movie(np.squeeze(model_LN.predict(np.expand_dims(Y, -1))))
             Y = np.maximum(Y, 0)
@@ -1031,10 +1159,13 @@ class OnACID(object):
             self.estimates.lam = np.zeros(nr)
         else:
             raise Exception('Unknown initialization method!')
-        dims, Ts = get_file_size(fls, var_name_hdf5=self.params.get('data', 'var_name_hdf5'))
         dims = Y.shape[1:]
         self.params.set('data', {'dims': dims})
-        T1 = np.array(Ts).sum()*self.params.get('online', 'epochs') if T is None else T
+        if T is None:
+            _, Ts = get_file_size(fls, var_name_hdf5=self.params.get('data', 'var_name_hdf5'))
+            T1 = np.array(Ts).sum()*self.params.get('online', 'epochs')
+        else:
+            T1 = T
         self._prepare_object(Yr, T1)
         if opts['show_movie']:
             self.bnd_AC = np.percentile(np.ravel(self.estimates.A.dot(self.estimates.C)),
@@ -1058,6 +1189,42 @@ class OnACID(object):
             raise Exception("Unsupported file extension")
 
 
+    def save_state(self, filename, t):
+        """save the state of an online fit after t frames, including the
+        buffers, sufficient statistics and deconvolution pools, so that the fit
+        can be resumed at frame t, possibly on another machine, with
+        load_OnACID_state. Unlike save, this can be called between two frames
+        and not only after the fit is finalized
+
+        Args:
+            filename: str
+                path to the file written (pickle format)
+
+            t: int
+                number of frames fitted so far, i.e. index of the next frame
+        """
+        # the spare capacity of the sparse matrices (see csc_append) is not saved
+        for val in self.estimates.__dict__.values():
+            if hasattr(val, '_append_buffers'):
+                del val._append_buffers
+        state = {key: val for key, val in self.__dict__.items() if key not in _TRANSIENT_ATTRS}
+        state['t'] = t
+        filename = caiman.paths.fn_relocated(filename)
+        # write to a temporary file first, a crash while saving keeps the previous state
+        # protocol 5 restores the arrays as views on the pickled buffers, which
+        # cannot be resized in place when components are added (see fit_next)
+        with open(filename + '.tmp', 'wb') as f:
+            pickle.dump({'version': ONACID_STATE_VERSION, 'state': state}, f, 4)
+        os.replace(filename + '.tmp', filename)
+
+    def _reserve_frames(self, T):
+        """make room for the traces of T frames"""
+        for key in ('C_on', 'noisyC'):
+            C = getattr(self.estimates, key)
+            if C.shape[1] < T:
+                setattr(self.estimates, key, np.concatenate(
+                    [C, np.zeros((C.shape[0], T - C.shape[1]), dtype=C.dtype)], axis=1))
+
     def mc_next(self, t, frame):
         if self.params.motion['nonneg_movie']:
             frame = frame-self.min_mov
@@ -1079,7 +1246,13 @@ class OnACID(object):
             templ *= self.img_norm
         if self.is1p:
             templ = high_pass_filter_space(templ, self.params.motion['gSig_filt'])
-        if self.params.get('motion', 'pw_rigid'):
+        if (self.params.get('motion', 'pw_rigid') and not self.params.get('motion', 'is3D') and
+                self.params.get('motion', 'nonrigid_engine') == 'optical_flow'):
+            frame_cor, shift, _, xy_grid = tile_and_correct_flow(
+                frame, templ, self.params.motion['strides'], self.params.motion['overlaps'],
+                self.params.motion['max_shifts'], add_to_movie=0, gSig_filt=None, border_nan='copy',
+                downsample=self.params.motion['flow_downsample'])
+        elif self.params.get('motion', 'pw_rigid'):
             tac = tile_and_correct_3d if self.params.get('motion', 'is3D') else tile_and_correct
             frame_cor, shift, _, xy_grid = tac(
                 frame, templ, self.params.motion['strides'], self.params.motion['overlaps'],
@@ -1190,6 +1363,29 @@ class OnACID(object):
         t = init_batch
         self.Ab_epoch:List = []
         t_online = []
+        t_read = []     # time spent waiting for the next frame
+        t_prep = []     # time spent downsampling and normalizing each frame
+        latency_control = self._latency_controller()
+        # without the ring CNN the frames are downsampled and normalized by
+        # the reader, otherwise after the background is removed
+        prep_in_reader = model_LN is None
+        # without motion correction (which uses the fit of the previous frame)
+        # the frames can be fitted in blocks
+        batch_frames = self.params.get('online', 'batch_frames')
+        block = [] if (batch_frames > 1 and model_LN is None and latency_control is None and not
+                       (self.params.get('online', 'motion_correct') or self.params.get('online', 'show_movie'))) else None
+
+        def fit_block():
+            t_block = time()
+            self.fit_next_batch(t - len(block), np.array(block))
+            t_online.extend([(time() - t_block) / len(block)] * len(block))
+            del block[:]
+
+        def read_frames(Y_):
+            for frame in Y_:
+                t_prep_start = time()
+                frame_ = self._prepare_frame(frame) if prep_in_reader else None
+                yield frame, frame_, time() - t_prep_start
         if extra_files == 0:     # check whether there are any additional files
             process_files = fls[:init_files]     # end processing at this file
             init_batc_iter = [init_batch]         # place where to start
@@ -1216,15 +1412,19 @@ class OnACID(object):
         #     Go through all files
             for file_count, ffll in enumerate(process_files):
                 logging.warning('Now processing file {}'.format(ffll))
-                Y_ = caiman.base.movies.load_iter(
+                Y_ = read_frames(caiman.base.movies.load_iter(
                     ffll, var_name_hdf5=self.params.get('data', 'var_name_hdf5'),
-                    subindices=slice(init_batc_iter[file_count], None, None))
+                    subindices=slice(init_batc_iter[file_count], None, None)))
+                if self.params.get('online', 'n_prefetch') > 0:
+                    Y_ = Prefetcher(Y_, self.params.get('online', 'n_prefetch'))
 
                 old_comps = self.N     # number of existing components
                 frame_count = -1
                 while True:   # process each file
                     try:
-                        frame = next(Y_)
+                        t_wait = time()
+                        frame, frame_, t_frame_prep = next(Y_)
+                        t_read.append(time() - t_wait)
                         if model_LN is not None:
                             if self.params.get('ring_CNN', 'remove_activity'):
                                 activity = self.estimates.Ab[:,:self.N].dot(self.estimates.C_on[:self.N, t-1]).reshape(self.params.get('data', 'dims'), order='F')
@@ -1249,26 +1449,24 @@ class OnACID(object):
                             old_comps = self.N
 
                         # Downsample and normalize
-                        frame_ = frame.copy().astype(np.float32)
-                        if self.params.get('online', 'ds_factor') > 1:
-                            frame_ = cv2.resize(frame_, self.img_norm.shape[::-1])
-
-                        if self.params.get('online', 'normalize'):
-                            frame_ -= self.img_min     # make data non-negative
-
-                        # Motion Correction
-                        t_mot = time()
-                        if self.params.get('online', 'motion_correct'):    # motion correct
-                            frame_cor = self.mc_next(t, frame_)
-                        else:
-                            templ = None
-                            frame_cor = frame_
-                        self.t_motion.append(time() - t_mot)
-                        
-                        if self.params.get('online', 'normalize'):
-                            frame_cor = frame_cor/self.img_norm
-                        # Fit next frame
-                        self.fit_next(t, frame_cor.reshape(-1, order='F'))
+                        if not prep_in_reader:
+                            t_prep_start = time()
+                            frame_ = self._prepare_frame(frame)
+                            t_frame_prep = time() - t_prep_start
+                        t_prep.append(t_frame_prep)
+
+                        if block is not None:   # fit the frames by blocks
+                            self.t_motion.append(0.)
+                            if self.params.get('online', 'normalize'):
+                                frame_ = frame_/self.img_norm
+                            block.append(frame_.reshape(-1, order='F'))
+                            t += 1
+                            if len(block) == batch_frames:
+                                fit_block()
+                            continue
+
+                        # Motion correct and fit next frame
+                        frame_cor = self.process_frame(t, frame_, latency_control)
                         # Show
                         if self.params.get('online', 'show_movie'):
                             self.t = t
@@ -1287,9 +1485,77 @@ class OnACID(object):
                         t_online.append(time() - t_frame_start)
                     except  (StopIteration, RuntimeError):
                         break
-        
+                if block:
+                    fit_block()
+                if isinstance(Y_, Prefetcher):
+                    Y_.close()
+
             self.Ab_epoch.append(self.estimates.Ab.copy())
 
+        self._finalize_estimates(t, epochs, frame.shape if self.params.get('online', 'ds_factor') > 1 else None)
+        if self.params.get('online', 'save_online_movie'):
+            out.release()
+        if self.params.get('online', 'show_movie'):
+            cv2.destroyAllWindows()
+        self.t_online = t_online
+        self.t_read = t_read
+        self.t_prep = t_prep
+        if latency_control is not None:
+            self.timing_log = latency_control.timing_log()
+
+        return self
+
+    def process_frame(self, t, frame_, latency_control=None):
+        """Motion correct a frame prepared by _prepare_frame, normalize it and
+        fit it as the t-th frame
+
+        Args:
+            t: int
+                time measured in number of frames
+
+            frame_: np.ndarray
+                downsampled, nonnegative frame
+
+            latency_control: LatencyController
+                if given, decides how much work is done on the frame and records its timing
+
+        Returns:
+            frame_cor: np.ndarray
+                motion corrected (and normalized) frame
+        """
+        fit_options = {} if latency_control is None else latency_control.frame_options()
+        n_detect = len(self.t_detect)
+        # Motion Correction
+        t_mot = time()
+        if self.params.get('online', 'motion_correct'):    # motion correct
+            frame_cor = self.mc_next(t, frame_)
+        else:
+            frame_cor = frame_
+        self.t_motion.append(time() - t_mot)
+
+        if self.params.get('online', 'normalize'):
+            frame_cor = frame_cor/self.img_norm
+        # Fit next frame
+        self.fit_next(t, frame_cor.reshape(-1, order='F'), **fit_options)
+        if latency_control is not None:
+            latency_control.record(t, time() - t_mot, self.t_motion[-1],
+                                   self.t_detect[-1] if len(self.t_detect) > n_detect else 0.,
+                                   self.t_stat[-1], self.t_shapes[-1])
+        return frame_cor
+
+    def _latency_controller(self):
+        """LatencyController for the realtime mode, None if it is off"""
+        if not self.params.get('online', 'realtime'):
+            return None
+        budget = self.params.get('online', 'latency_budget')
+        return LatencyController(1. / self.params.get('data', 'fr') if budget is None else budget,
+                                 window=self.params.get('online', 'latency_window'),
+                                 pct=self.params.get('online', 'latency_pct'))
+
+    def _finalize_estimates(self, t, epochs, dims=None):
+        """Set A, b, C, f, S, YrA from the online state after t frames were
+        fitted in the given number of epochs. With ds_factor > 1 the components
+        are upsampled to the dimensions dims of the raw frames"""
         if self.params.get('online', 'normalize'):
             self.estimates.Ab = csc_matrix(self.estimates.Ab.multiply(
                 self.img_norm.reshape(-1, order='F')[:, np.newaxis]))
@@ -1306,7 +1572,6 @@ class OnACID(object):
             self.estimates.bl = [0] * self.estimates.C.shape[0]
             self.estimates.S = np.zeros_like(self.estimates.C)
         if self.params.get('online', 'ds_factor') > 1:
-            dims = frame.shape
             self.estimates.A = hstack([coo_matrix(cv2.resize(self.estimates.A[:, i].reshape(self.estimates.dims, order='F').toarray(),
                                                             dims[::-1]).reshape(-1, order='F')[:,None]) for i in range(self.N)], format='csc')
             if self.estimates.b.shape[-1] > 0:
@@ -1320,15 +1585,18 @@ class OnACID(object):
                 self.estimates.b0 = b0.reshape((-1, 1), order='F')
             self.params.set('data', {'dims': dims})
             self.estimates.dims = dims
-        if self.params.get('online', 'save_online_movie'):
-            out.release()
-        if self.params.get('online', 'show_movie'):
-            cv2.destroyAllWindows()
-        self.t_online = t_online
         self.estimates.C_on = self.estimates.C_on[:self.M]
         self.estimates.noisyC = self.estimates.noisyC[:self.M]
 
-        return self
+    def _prepare_frame(self, frame):
+        """Downsample a raw frame and make it nonnegative, as expected by mc_next"""
+        frame_ = frame.astype(np.float32)
+        if self.params.get('online', 'ds_factor') > 1:
+            frame_ = cv2.resize(frame_, self.img_norm.shape[::-1])
+
+        if self.params.get('online', 'normalize'):
+            frame_ -= self.img_min     # make data non-negative
+        return frame_
 
     def create_frame(self, frame_cor, show_residuals=True, resize_fact=3, transpose=True):
         if show_residuals:
@@ -1610,7 +1878,7 @@ def HALS4shapes(Yr, A, C, iters=2):
 # definitions for demixed time series extraction and denoising/deconvolving
 @profile
 def HALS4activity(Yr, A, noisyC, AtA=None, iters=5, tol=1e-3, groups=None,
-                  order=None):
+                  order=None, AtY=None):
     """Solves C = argmin_C ||Yr-AC|| using block-coordinate decent. Can use
     groups to update non-overlapping components in parallel or a specified
     order.
@@ -1640,6 +1908,9 @@ def HALS4activity(Yr, A, noisyC, AtA=None, iters=5, tol=1e-3, groups=None,
         order : list
             Update components in that order (used if nonempty and groups=None)
 
+        AtY : np.array, optional (# of components x t)
+            A.T.dot(Yr) if already computed, e.g. for a block of frames at once
+
     Returns:
         C : np.array (# of components x t)
             solution of HALS
@@ -1648,7 +1919,8 @@ def HALS4activity(Yr, A, noisyC, AtA=None, iters=5, tol=1e-3, groups=None,
             solution of HALS + residuals, i.e, (C + YrA)
     """
 
-    AtY = A.T.dot(Yr)
+    if AtY is None:
+        AtY = A.T.dot(Yr)
     num_iters = 0
     C_old = np.zeros_like(noisyC)
     C = noisyC.copy()
@@ -1675,7 +1947,7 @@ def HALS4activity(Yr, A, noisyC, AtA=None, iters=5, tol=1e-3, groups=None,
 
 
 def demix1p(y, A, noisyC, AtA, Atb, AtW, AtWA, iters=5, tol=1e-3,
-            groups=None, downscale_matrix=None, ssub_B=1):
+            groups=None, downscale_matrix=None, ssub_B=1, AtY=None, AtWy=None):
     """
     Solve C = argmin_C ||Yr-AC-B|| using block-coordinate decent
     where B = W(Y-AC-b0) + b0  (ring model for 1p data)
@@ -1701,10 +1973,16 @@ def demix1p(y, A, noisyC, AtA, Atb, AtW, AtWA, iters=5, tol=1e-3,
         Tolerance.
     groups: list of lists
         groups of components to update in parallel
+    AtY : ndarray of float, optional
+        A'y if already computed, e.g. for a block of frames at once
+    AtWy : ndarray of float, optional
+        A'Wy (with y downscaled if ssub_B > 1) if already computed
     """
-    AtY = A.T.dot(y)
-    AtWyb = AtW.dot(y if ssub_B == 1 else downscale_matrix.dot(y) *
-                    ssub_B**2) - Atb  # Atb is A'(Wb0-b0)
+    if AtY is None:
+        AtY = A.T.dot(y)
+    if AtWy is None:
+        AtWy = AtW.dot(y if ssub_B == 1 else downscale_matrix.dot(y) * ssub_B**2)
+    AtWyb = AtWy - Atb  # Atb is A'(Wb0-b0)
     num_iters = 0
     C_old = np.zeros_like(noisyC)
     C = noisyC.copy()
@@ -1809,6 +2087,146 @@ def demix_and_deconvolve(C, noisyC, AtY, AtA, OASISinstances, iters=3, n_refit=0
 
 
 #%% Estimate shapes on small initial batch
+class LatencyController(object):
+    """Adapt the work done by OnACID on each frame to a time budget per frame.
+
+    When the rolling percentile of the time per frame exceeds the budget, the
+    controller moves to the next degradation level, and back when it is well
+    under the budget again:
+        0: full processing
+        1: search for new components on every second frame
+        2: search on every fourth frame, fewer HALS iterations for the traces
+        3: search on every eighth frame, defer shape updates (one every
+           max_defer frames at most)
+
+    The timing of every frame is kept in a log, see timing_log().
+    """
+
+    levels = ({},
+              {'find_new_every': 2},
+              {'find_new_every': 4, 'num_iters_hals': 1},
+              {'find_new_every': 8, 'num_iters_hals': 1, 'defer_shapes': True})
+
+    def __init__(self, budget, window=100, pct=99, num_iters_hals=3, max_defer=10):
+        """
+        Args:
+            budget: float
+                target time per frame (seconds), usually 1/frame rate
+
+            window: int
+                number of frames of the rolling percentile
+
+            pct: float
+                percentile of the time per frame compared to the budget
+
+            num_iters_hals: int
+                iterations of HALS for the traces at full processing
+
+            max_defer: int
+                maximum number of frames a shape update is deferred
+        """
+        self.budget = budget
+        self.window = window
+        self.pct = pct
+        self.num_iters_hals = num_iters_hals
+        self.max_defer = max_defer
+        self.level = 0
+        self._recent:collections.deque = collections.deque(maxlen=window)
+        self._since_change = 0
+        self._frame_count = 0
+        self._deferred = 0
+        self._options:dict = {}
+        self._log:List = []
+
+    def frame_options(self) -> dict:
+        """arguments of fit_next for the next frame"""
+        level = self.levels[self.level]
+        find_new = self._frame_count % level.get('find_new_every', 1) == 0
+        shape_update = not level.get('defer_shapes', False) or self._deferred >= self.max_defer
+        self._deferred = 0 if shape_update else self._deferred + 1
+        self._frame_count += 1
+        self._options = {'num_iters_hals': level.get('num_iters_hals', self.num_iters_hals),
+                         'find_new': find_new, 'shape_update': shape_update}
+        return self._options
+
+    def record(self, t, t_total, t_motion, t_detect, t_stat, t_shapes):
+        """log the timing (seconds) of frame t, fitted with the last frame_options, and update the level"""
+        self._log.append((t, self.level, self._options['find_new'], self._options['num_iters_hals'],
+                          self._options['shape_update'], t_total, t_motion, t_detect, t_stat, t_shapes))
+        self._recent.append(t_total)
+        self._since_change += 1
+        if self._since_change < self.window // 4:
+            return
+        rolling = np.percentile(self._recent, self.pct)
+        if rolling > self.budget and self.level < len(self.levels) - 1:
+            self.level += 1
+        elif rolling < .7 * self.budget and self.level > 0:
+            self.level -= 1
+        else:
+            return
+        logging.info('Time per frame p{} {:.4f}s for a budget of {:.4f}s at frame {}: degradation level {}'.format(
+            self.pct, rolling, self.budget, t, self.level))
+        self._since_change = 0
+
+    def timing_log(self) -> np.ndarray:
+        """per frame log as a structured array"""
+        return np.array(self._log, dtype=[('t', np.int64), ('level', np.int8), ('find_new', bool),
+                                          ('num_iters_hals', np.int8), ('shape_update', bool),
+                                          ('total', float), ('motion', float), ('detect', float),
+                                          ('stat', float), ('shapes', float)])
+
+
+class Prefetcher(object):
+    """Iterator that consumes another iterator in a background thread,
+    keeping up to maxsize items ahead of the caller in a bounded queue.
+    Exceptions raised by the wrapped iterator are raised by next() in the
+    caller's thread, in order.
+    """
+
+    _done = object()
+
+    def __init__(self, iterator, maxsize=10):
+        self.queue:queue.Queue = queue.Queue(maxsize)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(iterator,), daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self, iterator):
+        try:
+            for item in iterator:
+                if not self._put((item, None)):
+                    return
+        except BaseException as e:
+            self._put((None, e))
+        self._put((self._done, None))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item, exc = self.queue.get()
+        if exc is not None:
+            raise exc
+        if item is self._done:
+            self.queue.put((item, None))  # keep raising StopIteration
+            raise StopIteration
+        return item
+
+    def close(self):
+        """stop the reader thread, discarding the items read ahead"""
+        self._stop.set()
+        self._thread.join()
+
+
 def init_shapes_and_sufficient_stats(Y, A, C, b, f, W=None, b0=None, ssub_B=1, bSiz=3,
                                      downscale_matrix=None, upscale_matrix=None):
     # smooth the components
@@ -1849,6 +2267,19 @@ def init_shapes_and_sufficient_stats(Y, A, C, b, f, W=None, b0=None, ssub_B=1, b
 
 
 @profile
+def update_AtA(AtA, Ab, idx):
+    """ Recomputes the rows and columns idx of the overlap matrix AtA = Ab.T.dot(Ab)
+    after the footprints idx of Ab changed, with a cost that scales with the number
+    of changed components rather than with the total. AtA is updated in place
+    (after a conversion to a float32 array if needed) and returned."""
+    AtA = np.asarray(AtA, dtype=np.float32)
+    idx = np.asarray(idx, dtype=int)
+    if len(idx) > 0:
+        AtA[:, idx] = Ab.T.dot(Ab[:, idx]).toarray()
+        AtA[idx] = AtA[:, idx].T
+    return AtA
+
+
 def update_shapes(CY, CC, Ab, ind_A, sn=None, q=0.5, indicator_components=None,
                   Ab_dense=None, update_bkgrd=True, iters=5):
 
@@ -1857,8 +2288,10 @@ def update_shapes(CY, CC, Ab, ind_A, sn=None, q=0.5, indicator_components=None,
     nb = M - N
     if indicator_components is None:
         idx_comp = range(nb, M)
-    else:
+    elif np.asarray(indicator_components).dtype == bool:
         idx_comp = np.where(indicator_components)[0] + nb
+    else:  # indices of the components
+        idx_comp = np.asarray(indicator_components) + nb
     if sn is None or q == 0.5:  # avoid costly construction of L=np.zeros((M, D), dtype=np.float32)
         for _ in range(iters):  # it's presumably better to run just 1 iter but update more neurons
             if Ab_dense is None:
@@ -1944,16 +2377,35 @@ def update_shapes(CY, CC, Ab, ind_A, sn=None, q=0.5, indicator_components=None,
 
 
 class RingBuffer(np.ndarray):
-    """ implements ring buffer efficiently"""
+    """ implements ring buffer efficiently
+
+    The rows are stored twice, one after the other, so that the rows in
+    chronological order, or any number of the most recent ones, are a
+    contiguous view of the storage and are returned without copying. These
+    views are only valid until the next append and must not be modified.
+    The sum of the rows is maintained at every append, so that their mean
+    (running_mean) costs the size of a row.
+
+    Writes through item assignment (buf[key] = x, buf[:, idx] -= x) and
+    in-place arithmetic on the whole buffer keep both copies in sync; writes
+    through views of the buffer do not."""
+
+    _storage = None     # both copies of the rows, None for arrays derived from a buffer
+    _sum = None
+    _appends = 0
 
     def __new__(cls, input_array, num_els):
-        obj = np.asarray(input_array).view(cls)
-        obj.max_ = num_els
-        obj.cur = 0
+        input_array = np.asarray(input_array)
         if input_array.shape[0] != num_els:
             print([input_array.shape[0], num_els])
             raise Exception('The first dimension should equal num_els')
-
+        storage = np.concatenate([input_array, input_array], axis=0)
+        obj = storage[:num_els].view(cls)
+        obj.max_ = num_els
+        obj.cur = 0
+        obj._storage = storage
+        obj._sum = None
+        obj._appends = 0
         return obj
 
     def __array_finalize__(self, obj):
@@ -1963,43 +2415,168 @@ class RingBuffer(np.ndarray):
 
         self.max_ = getattr(obj, 'max_', None)
         self.cur = getattr(obj, 'cur', None)
+        # arrays derived from a buffer are plain ring buffers without a second copy
+        self._storage = None
+        self._sum = None
+        self._appends = 0
+
+    def __reduce__(self):
+        if self._storage is None:
+            return super(RingBuffer, self).__reduce__()
+        return (RingBuffer, (np.asarray(self), self.max_), {'cur': self.cur})
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            self.cur = state['cur']
+        else:
+            super(RingBuffer, self).__setstate__(state)
+
+    def __setitem__(self, key, value):
+        if self._storage is None:
+            return super(RingBuffer, self).__setitem__(key, value)
+        region = np.ndarray.__getitem__(self, key)
+        columns = None
+        if isinstance(key, tuple) and len(key) == 2 and isinstance(key[0], slice) and key[0] == slice(None):
+            columns = key[1]
+        if self._sum is not None and columns is not None:
+            old_sum = region.sum(0, dtype=np.float64)
+        super(RingBuffer, self).__setitem__(key, value)
+        region = np.ndarray.__getitem__(self, key)
+        self._storage[self.max_:][key] = region
+        if self._sum is not None:
+            if columns is not None:
+                self._sum[columns] += region.sum(0, dtype=np.float64) - old_sum
+            else:
+                self._sum = None
+
+    def _sync(self):
+        if self._storage is not None:
+            self._storage[self.max_:] = self._storage[:self.max_]
+            self._sum = None
+
+    def __iadd__(self, other):
+        super(RingBuffer, self).__iadd__(other)
+        self._sync()
+        return self
+
+    def __isub__(self, other):
+        super(RingBuffer, self).__isub__(other)
+        self._sync()
+        return self
+
+    def __imul__(self, other):
+        super(RingBuffer, self).__imul__(other)
+        self._sync()
+        return self
+
+    def __itruediv__(self, other):
+        super(RingBuffer, self).__itruediv__(other)
+        self._sync()
+        return self
 
     def append(self, x):
-        self[self.cur] = x
+        if self._storage is None:
+            super(RingBuffer, self).__setitem__(self.cur, x)
+        else:
+            if self._sum is not None:
+                self._sum += x
+                self._sum -= self._storage[self.cur]
+            self._storage[self.cur] = x
+            self._storage[self.cur + self.max_] = x
+            self._appends += 1
+            if self._appends % self.max_ == 0:
+                self._sum = None    # recompute the sum now and then to avoid drift
         self.cur = (self.cur + 1) % self.max_
 
     def get_ordered(self):
+        if self._storage is not None:
+            return self._storage[self.cur:self.cur + self.max_]
         return np.concatenate([self[self.cur:], self[:self.cur]], axis=0)
 
     def get_first(self):
         return self[self.cur]
 
     def get_last_frames(self, num_frames):
+        if self._storage is not None and num_frames <= self.max_:
+            return self._storage[self.cur + self.max_ - num_frames:self.cur + self.max_]
         if self.cur >= num_frames:
             return self[self.cur - num_frames:self.cur]
         else:
             return np.concatenate([self[(self.cur - num_frames):], self[:self.cur]], axis=0)
 
+    def running_mean(self):
+        """mean of the rows in the buffer"""
+        if self._storage is None:
+            return np.asarray(self).mean(0)
+        if self._sum is None:
+            self._sum = self._storage[:self.max_].sum(0, dtype=np.float64)
+        return (self._sum / self.max_).astype(self.dtype)
+
 
 #%%
+def _append_into(buf, arr, new):
+    """ Writes new after arr into buf, where arr is a prefix view of buf, and returns
+    the buffer and a view of the concatenation. When buf is missing or too small it is
+    replaced by one with twice the needed capacity, so that repeated appends copy every
+    element only a constant number of times on average."""
+    n, n_new = len(arr), len(new)
+    dtype = np.result_type(arr, new)
+    if (buf is None or arr.base is not buf or buf.dtype != dtype or len(buf) < n + n_new
+            or arr.ctypes.data != buf.ctypes.data):
+        buf_ = np.empty(max(2 * (n + n_new), 16), dtype=dtype)
+        buf_[:n] = arr
+        buf = buf_
+    buf[n:n + n_new] = new
+    return buf, buf[:n + n_new]
+
+
+def _compressed_append(a, b, shape):
+    """ Appends the data, indices and indptr of b to those of a (both csc or both csr).
+    The arrays of a become views of buffers with spare capacity that are kept on a,
+    hence appending to a matrix repeatedly costs amortized O(1) per stored element."""
+    buffers = getattr(a, '_append_buffers', (None, None, None))
+    new = (b.data, b.indices, (b.indptr + a.nnz)[1:])
+    buffers, arrays = zip(*[_append_into(buf, arr, arr_new) for buf, arr, arr_new in
+                            zip(buffers, (a.data, a.indices, a.indptr), new)])
+    a.data, a.indices, a.indptr = arrays
+    a._append_buffers = buffers
+    a._shape = shape
+
+
 def csc_append(a, b):
     """ Takes in 2 csc_matrices and appends the second one to the right of the first one.
     Much faster than scipy.sparse.hstack but assumes the type to be csc and overwrites
-    the first matrix instead of copying it. The data, indices, and indptr still get copied."""
-    a.data = np.concatenate((a.data, b.data))
-    a.indices = np.concatenate((a.indices, b.indices))
-    a.indptr = np.concatenate((a.indptr, (b.indptr + a.nnz)[1:]))
-    a._shape = (a.shape[0], a.shape[1] + b.shape[1])
+    the first matrix instead of copying it. The data, indices, and indptr of the first
+    matrix are kept in buffers with spare capacity, so they only get copied when the
+    capacity is exhausted."""
+    _compressed_append(a, b, (a.shape[0], a.shape[1] + b.shape[1]))
 
 
 def csr_append(a, b):
     """ Takes in 2 csr_matrices and appends the second one below the first one.
     Much faster than scipy.sparse.vstack but assumes the type to be csr and overwrites
-    the first matrix instead of copying it. The data, indices, and indptr still get copied."""
-    a.data = np.concatenate((a.data, b.data))
-    a.indices = np.concatenate((a.indices, b.indices))
-    a.indptr = np.concatenate((a.indptr, (b.indptr + a.nnz)[1:]))
-    a._shape = (a.shape[0] + b.shape[0], a.shape[1])
+    the first matrix instead of copying it. The data, indices, and indptr of the first
+    matrix are kept in buffers with spare capacity, so they only get copied when the
+    capacity is exhausted."""
+    _compressed_append(a, b, (a.shape[0] + b.shape[0], a.shape[1]))
+
+
+def grow_square(A, n_new, dtype=None):
+    """ Returns the square matrix A enlarged by n_new rows and columns, with the values
+    of A in the top left block and the new rows and columns uninitialized.
+    The result is a view of a buffer whose capacity doubles when exhausted, so that
+    adding components one at a time to matrices such as AtA or CC does not reallocate
+    and copy the whole matrix at every addition. Only grow the matrix holding the
+    state, since views of the same buffer share the spare capacity."""
+    n = A.shape[0]
+    dtype = A.dtype if dtype is None else np.dtype(dtype)
+    buf = A.base
+    if (buf is None or buf.ndim != 2 or buf.shape[0] != buf.shape[1] or buf.dtype != dtype
+            or buf.shape[0] < n + n_new or A.ctypes.data != buf.ctypes.data or A.strides != buf.strides):
+        cap = max(2 * (n + n_new), 16)
+        buf = np.empty((cap, cap), dtype=dtype)
+        buf[:n, :n] = A
+    return buf[:n + n_new, :n + n_new]
 
 
 def corr(a, b):
@@ -2037,6 +2614,36 @@ def rank1nmf(Ypx, ain, iters=10):
     cin = np.maximum(cin_res, 0)
     return ain, cin, cin_res
 
+
+def rank1nmf_batch(Ypx, ain, iters=10):
+    """
+    perform rank1nmf on a stack of patches at once
+
+    Args:
+        Ypx: np.ndarray
+            patches X pixels X frames
+
+        ain: np.ndarray
+            patches X pixels, initial shapes
+
+    Returns:
+        ain, cin, cin_res: the results of rank1nmf for each patch, stacked
+    """
+    eps = np.finfo(np.float32).eps
+    ain = ain[:, None, :]
+    YpxT = Ypx.transpose(0, 2, 1)
+    for t in range(iters):
+        cin_res = np.matmul(ain, Ypx)
+        cin = np.maximum(cin_res, 0)
+        ain = np.maximum(np.matmul(cin, YpxT), 0)
+        if t in (0, iters-1):
+            ain /= np.sqrt((ain * ain).sum(-1, keepdims=True)) + eps
+        elif t % 2 == 0:  # division by squared norm every 2nd iter is faster yet numerically stable
+            ain /= (ain * ain).sum(-1, keepdims=True) + eps
+    cin_res = np.matmul(ain, Ypx)
+    cin = np.maximum(cin_res, 0)
+    return ain[:, 0], cin[:, 0], cin_res[:, 0]
+
 #%%
 @profile
 def get_candidate_components(sv, dims, Yres_buf, min_num_trial=3, gSig=(5, 5),
@@ -2044,12 +2651,15 @@ def get_candidate_components(sv, dims, Yres_buf, min_num_trial=3, gSig=(5, 5),
                              patch_size=50, loaded_model=None, test_both=False,
                              thresh_CNN_noisy=0.5, use_peak_max=False,
                              thresh_std_peak_resid = 1, mean_buff=None,
-                             tf_in=None, tf_out=None):
+                             tf_in=None, tf_out=None, cnn_thread=False):
     """
     Extract new candidate components from the residual buffer and test them
     using space correlation or the CNN classifier. The function runs the CNN
     classifier in batch mode which can bring speed improvements when
-    multiple components are considered in each timestep.
+    multiple components are considered in each timestep. Likewise the rank 1
+    NMF and the space correlation are computed for all the candidates at once,
+    with cnn_thread concurrently with the CNN classifier.
+    The traces Cin, Cin_res are in the (circular) order of the rows of Yres_buf.
     """
     Ain = []
     Ain_cnn = []
@@ -2060,7 +2670,6 @@ def get_candidate_components(sv, dims, Yres_buf, min_num_trial=3, gSig=(5, 5),
     ijsig_all = []
     cnn_pos:List = []
     local_maxima:List = []
-    Y_patch = []
     ksize = tuple([int(3 * i / 2) * 2 + 1 for i in gSig])
     compute_corr = test_both
 
@@ -2131,14 +2740,18 @@ def get_candidate_components(sv, dims, Yres_buf, min_num_trial=3, gSig=(5, 5),
         if na:
             ain /= sqrt(na)
             Ain.append(ain)
-            if compute_corr:
-                Y_patch.append(Yres_buf.T[indices, :])
-            else:
-                all_indices.append(indices)
+            all_indices.append(indices)
             idx.append(ind)
             if sniper_mode:
                 Ain_cnn.append(ain_cnn)
 
+    def fit_candidates(keep):
+        # rank 1 NMF of the residual buffer in the patches of the candidates keep, all at once
+        Ypx = np.asarray(Yres_buf)[:, np.stack([all_indices[kp] for kp in keep])]
+        Ypx = np.ascontiguousarray(Ypx.transpose(1, 2, 0))   # candidates X pixels X frames
+        return (Ypx,) + rank1nmf_batch(Ypx, np.stack([Ain[kp] for kp in keep]))
+
+    predictions = None
     if sniper_mode & (len(Ain_cnn) > 0):
         Ain_cnn = np.stack(Ain_cnn)
         Ain2 = Ain_cnn.copy()
@@ -2146,42 +2759,49 @@ def get_candidate_components(sv, dims, Yres_buf, min_num_trial=3, gSig=(5, 5),
         Ain2 /= np.std(Ain2,axis=1)[:,None]
         Ain2 = np.reshape(Ain2,(-1,) + tuple(np.diff(ijSig_cnn).squeeze()),order= 'F')
         Ain2 = np.stack([cv2.resize(ain,(patch_size ,patch_size)) for ain in Ain2])
-        if tf_in is None:
-            predictions = loaded_model.predict(Ain2[:,:,:,np.newaxis], batch_size=min_num_trial, verbose=0)
+
+        def classify():
+            if tf_in is None:
+                return loaded_model.predict(Ain2[:,:,:,np.newaxis], batch_size=min_num_trial, verbose=0)
+            else:
+                return loaded_model.run(tf_out, feed_dict={tf_in: Ain2[:, :, :, np.newaxis]})
+        if cnn_thread and compute_corr and len(Ain) > 0:
+            pool = ThreadPoolExecutor(max_workers=1)
+            predictions = pool.submit(classify)
+            pool.shutdown(wait=False)
         else:
-            predictions = loaded_model.run(tf_out, feed_dict={tf_in: Ain2[:, :, :, np.newaxis]})
+            predictions = classify()
+
+    if compute_corr and len(Ain) > 0:
+        Ypx, Ain, Cin, Cin_res = fit_candidates(range(len(Ain)))
+        Ym = Ypx.mean(-1)
+        Ym -= Ym.mean(-1, keepdims=True)
+        Ac = Ain - Ain.mean(-1, keepdims=True)
+        rval = (Ac * Ym).sum(-1) / np.sqrt((Ac * Ac).sum(-1) * (Ym * Ym).sum(-1) + np.finfo(float).eps)
+        keep_corr = list(np.where(rval > rval_thr)[0])
+    else:
+        keep_corr = []
+
+    if predictions is not None:
+        if not isinstance(predictions, np.ndarray):
+            predictions = predictions.result()
         keep_cnn = list(np.where(predictions[:, 0] > thresh_CNN_noisy)[0])
         cnn_pos = Ain2[keep_cnn]
     else:
         keep_cnn = []  # list(range(len(Ain_cnn)))
 
     if compute_corr:
-        keep_corr = []
-        for i, (ain, Ypx) in enumerate(zip(Ain, Y_patch)):
-            ain, cin, cin_res = rank1nmf(Ypx, ain)
-            Ain[i] = ain
-            Cin.append(cin)
-            Cin_res.append(cin_res)
-            rval = corr(ain.copy(), np.mean(Ypx, -1))
-            if rval > rval_thr:
-                keep_corr.append(i)
-        keep_final:List = list(set().union(keep_cnn, keep_corr))
+        keep_final:List = sorted(set().union(keep_cnn, keep_corr))
         if len(keep_final) > 0:
-            Ain = np.stack(Ain)[keep_final]
+            Ain, Cin, Cin_res = Ain[keep_final], Cin[keep_final], Cin_res[keep_final]
         else:
-            Ain = []
-        Cin = [Cin[kp] for kp in keep_final]
-        Cin_res = [Cin_res[kp] for kp in keep_final]
+            Ain, Cin, Cin_res = [], [], []
         idx = list(np.array(idx)[keep_final])
-    else:
-        Ain = [Ain[kp] for kp in keep_cnn]
-        Y_patch = [Yres_buf.T[all_indices[kp]] for kp in keep_cnn]
+    elif len(keep_cnn) > 0:
+        _, Ain, Cin, Cin_res = fit_candidates(keep_cnn)
         idx = list(np.array(idx)[keep_cnn])
-        for i, (ain, Ypx) in enumerate(zip(Ain, Y_patch)):
-            ain, cin, cin_res = rank1nmf(Ypx, ain)
-            Ain[i] = ain
-            Cin.append(cin)
-            Cin_res.append(cin_res)
+    else:
+        Ain, idx = [], []
 
     return Ain, Cin, Cin_res, idx, ijsig_all, cnn_pos, local_maxima
 
@@ -2202,7 +2822,7 @@ def update_num_components(t, sv, Ab, Cf, Yres_buf, Y_buf, rho_buf,
                           corr_img=None, first_moment=None, second_moment=None,
                           crosscorr=None, col_ind=None, row_ind=None, corr_img_mode=None,
                           max_img=None, downscale_matrix=None, upscale_matrix=None,
-                          tf_in=None, tf_out=None):
+                          tf_in=None, tf_out=None, cnn_thread=False):
     """
     Checks for new components in the residual buffer and incorporates them if they pass the acceptance tests
     """
@@ -2232,7 +2852,7 @@ def update_num_components(t, sv, Ab, Cf, Yres_buf, Y_buf, rho_buf,
         sniper_mode=sniper_mode, rval_thr=rval_thr, patch_size=50,
         loaded_model=loaded_model, thresh_CNN_noisy=thresh_CNN_noisy,
         use_peak_max=use_peak_max, test_both=test_both, mean_buff=mean_buff,
-        tf_in=tf_in, tf_out=tf_out)
+        tf_in=tf_in, tf_out=tf_out, cnn_thread=cnn_thread)
 
     ind_new_all = ijsig_all
 
@@ -2248,7 +2868,7 @@ def update_num_components(t, sv, Ab, Cf, Yres_buf, Y_buf, rho_buf,
                 np.ix_(*[np.arange(ij[0], ij[1])
                        for ij in ijSig]), dims, order='F').ravel()
 
-        cin_circ = cin.get_ordered()
+        cin_circ = np.roll(cin, -Yres_buf.cur)    # chronological order
         useOASIS = False  # whether to use faster OASIS for cell detection
         accepted = True   # flag indicating new component has not been rejected yet
 
@@ -2277,7 +2897,7 @@ def update_num_components(t, sv, Ab, Cf, Yres_buf, Y_buf, rho_buf,
             #      3 * sigma * sqrt(1-sum(gamma)) corresponds roughly to the 99.7% percentile of (non-zero) spike sizes
             s_min = -s_min * sqrt((ain**2).dot(sn[indices]**2)) * sqrt(1 - np.sum(g))
 
-        cin_res = cin_res.get_ordered()
+        cin_res = np.roll(cin_res, -Yres_buf.cur)
         if accepted:
             if useOASIS:
                 oas = OASIS(g=g, s_min=s_min,
@@ -2335,11 +2955,9 @@ def update_num_components(t, sv, Ab, Cf, Yres_buf, Y_buf, rho_buf,
 
             tt = t * 1.
 
-            # preallocate memory for speed up?
-            CC1 = np.hstack([CC, Cf.dot(cin_circ / tt)[:, None]])
-            CC2 = np.hstack(
-                [(Cf.dot(cin_circ)).T, cin_circ.dot(cin_circ)]) / tt
-            CC = np.vstack([CC1, CC2])
+            CC = grow_square(CC, 1)
+            CC[:M, M] = CC[M, :M] = Cf.dot(cin_circ / tt)
+            CC[M, M] = cin_circ.dot(cin_circ) / tt
             Cf = np.vstack([Cf, cin_circ])
 
             if W is not None:  # 1p data, subtract background
@@ -2431,7 +3049,7 @@ def update_num_components(t, sv, Ab, Cf, Yres_buf, Y_buf, rho_buf,
 
 #%% remove components online
 def remove_components_online(ind_rem, gnb, Ab, use_dense, Ab_dense, AtA, CY,
-                             CC, M, N, noisyC, OASISinstances, C_on, exp_comps):
+                             CC, M, N, noisyC, OASISinstances, C_on, exp_comps, groups=None):
 
     """
     Remove components indexed by ind_r (indexing starts at zero)
@@ -2446,6 +3064,8 @@ def remove_components_online(ind_rem, gnb, Ab, use_dense, Ab_dense, AtA, CY,
         use_dense bool
             use dense representation
         Ab_dense ndarray
+        groups list of lists
+            groups of components updated in parallel, updated incrementally if given
     """
 
     ind_rem.sort()
@@ -2473,7 +3093,10 @@ def remove_components_online(ind_rem, gnb, Ab, use_dense, Ab_dense, AtA, CY,
     Ab = csc_matrix(Ab[:, ind_keep])
     ind_A = list(
         [(Ab.indices[Ab.indptr[ii]:Ab.indptr[ii+1]]) for ii in range(gnb, M)])
-    groups = list(map(list, update_order(Ab)[0]))
+    if groups is None:
+        groups = list(map(list, update_order(Ab)[0]))
+    else:
+        groups = update_order_incremental(groups, AtA, removed=ind_rem)[0]
 
     return Ab, Ab_dense, CC, CY, M, N, noisyC, OASISinstances, C_on, exp_comps, ind_A, groups, AtA
 
@@ -2619,5 +3242,43 @@ def load_OnlineCNMF(filename, dview = None):
 
     return new_obj
 
+def load_OnACID_state(filename, dview=None, T=None):
+    """load the state of an online fit saved with OnACID.save_state, to resume
+    the fit at the frame it was saved at, e.g. with
+
+        cnm = load_OnACID_state(filename)
+        for t, frame in enumerate(frames, start=cnm.t):
+            cnm.process_frame(t, cnm._prepare_frame(frame))
+
+    or with OnlineIngest(cnm, ring, resume=True).run()
+
+    Args:
+        filename: str
+            file written by OnACID.save_state
+
+        dview: multiprocessing or ipyparallel object
+            useful to set up parllelization in the objects
+
+        T: int
+            total number of frames the traces are allocated for, if larger
+            than when the state was saved
+
+    Returns:
+        onacid: OnACID
+            object with the saved state, its attribute t is the index of the next frame
+    """
+    with open(caiman.paths.fn_relocated(filename), 'rb') as f:
+        saved = pickle.load(f)
+    if saved.get('version') != ONACID_STATE_VERSION:
+        raise Exception('Unsupported OnACID state version ' + str(saved.get('version')))
+    state = saved['state']
+    new_obj = OnACID(params=state['params'])
+    new_obj.__dict__.update(state)
+    new_obj.dview = dview
+    new_obj._load_classifier()
+    if T is not None:
+        new_obj._reserve_frames(T)
+    return new_obj
+
 def inv_mat_vec(A):
     return np.linalg.solve(A[0], A[1])
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+""" Live ingestion of frames into OnACID
+
+Frames are pushed by an acquisition process into a FrameRing, a ring of frame
+slots in shared memory, and an OnlineIngest object fits them with OnACID as
+they arrive, without writing them to files first:
+
+    ring = FrameRing(dims, n_slots=100, policy='block')
+    acquisition = multiprocessing.Process(target=acquire, args=(ring,))
+    acquisition.start()     # acquire() calls ring.put(frame) for every frame, then ring.close()
+    cnm = OnlineIngest(OnACID(params=opts), ring, max_frames=100000).run()
+    ring.unlink()
+
+When the analysis falls behind, the ring either blocks the producer
+(backpressure) or drops frames, according to its policy, and OnlineIngest can
+additionally skip frames that waited longer than a maximum lag.
+
+A fit can be paused by saving its state when the stream ends, and resumed
+later, possibly on another machine, on a new stream:
+
+    OnlineIngest(OnACID(params=opts), ring).run(state_file='session.pkl')
+    ...
+    cnm = OnlineIngest(load_OnACID_state('session.pkl'), ring2, resume=True).run()
+"""
+
+import logging
+import multiprocessing
+import numpy as np
+from time import time
+from typing import Dict, List
+
+from ...cluster import attach_shared_memory
+
+
+class FrameRing(object):
+    """Ring of frame slots in shared memory, written by one producer and read
+    by one consumer, possibly in different processes. The ring can be passed as
+    an argument to a multiprocessing.Process created with the same context.
+
+    What happens when the producer puts a frame while all the slots hold
+    unread frames depends on the policy:
+        'block': put() waits until the consumer frees a slot (backpressure)
+        'drop_newest': the new frame is discarded
+        'drop_oldest': the oldest unread frame is overwritten
+    """
+
+    def __init__(self, frame_shape, n_slots=64, dtype=np.float32, policy='block', ctx=None):
+        from multiprocessing import shared_memory
+        if policy not in ('block', 'drop_newest', 'drop_oldest'):
+            raise Exception('Unknown ring policy ' + str(policy))
+        ctx = ctx or multiprocessing.get_context()
+        self.frame_shape = tuple(frame_shape)
+        self.n_slots = n_slots
+        self.dtype = np.dtype(dtype)
+        self.policy = policy
+        nbytes = int(np.prod(self.frame_shape)) * n_slots * self.dtype.itemsize
+        self._shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        self._owner = True
+        self._cond = ctx.Condition()
+        self._written = ctx.Value('q', 0, lock=False)     # frames written so far
+        self._read = ctx.Value('q', 0, lock=False)        # frames read or dropped by the consumer
+        self._dropped = ctx.Value('q', 0, lock=False)     # frames dropped by the ring
+        self._closed = ctx.Value('b', 0, lock=False)
+        self._timestamps = ctx.Array('d', n_slots, lock=False)
+        self._frames = self._array()
+
+    def _array(self):
+        return np.ndarray((self.n_slots,) + self.frame_shape, dtype=self.dtype, buffer=self._shm.buf)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shm'] = self._shm.name
+        del state['_frames']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shm = attach_shared_memory(state['_shm'])
+        self._owner = False
+        self._frames = self._array()
+
+    def put(self, frame, timeout=None) -> bool:
+        """Write a frame into the ring, stamped with the current time
+
+        Args:
+            frame: np.ndarray
+                frame of shape frame_shape
+
+            timeout: float
+                with the 'block' policy, maximum time to wait for a free slot
+
+        Returns:
+            True if the frame was written, False if it was dropped
+        """
+        with self._cond:
+            if self._closed.value:
+                raise Exception('Cannot put frames into a closed ring')
+            while self._written.value - self._read.value >= self.n_slots:
+                if self.policy == 'drop_newest':
+                    self._dropped.value += 1
+                    return False
+                elif self.policy == 'drop_oldest':
+                    self._read.value += 1
+                    self._dropped.value += 1
+                elif not self._cond.wait(timeout):
+                    self._dropped.value += 1
+                    return False
+            slot = self._written.value % self.n_slots
+            self._frames[slot] = frame
+            self._timestamps[slot] = time()
+            self._written.value += 1
+            self._cond.notify_all()
+        return True
+
+    def get(self, timeout=None):
+        """Read the oldest unread frame
+
+        Args:
+            timeout: float
+                maximum time to wait for a frame
+
+        Returns:
+            (frame, timestamp) with the time at which the frame was put, or
+            None if the ring is closed and empty or the timeout expired
+        """
+        with self._cond:
+            while self._written.value == self._read.value:
+                if self._closed.value or not self._cond.wait(timeout):
+                    return None
+            slot = self._read.value % self.n_slots
+            frame = self._frames[slot].copy()
+            timestamp = self._timestamps[slot]
+            self._read.value += 1
+            self._cond.notify_all()
+        return frame, timestamp
+
+    def backlog(self) -> int:
+        """number of frames written and not read yet"""
+        with self._cond:
+            return self._written.value - self._read.value
+
+    @property
+    def dropped(self) -> int:
+        """number of frames dropped by the ring"""
+        return self._dropped.value
+
+    def close(self):
+        """signal the consumer that no more frames will be put"""
+        with self._cond:
+            self._closed.value = 1
+            self._cond.notify_all()
+
+    def unlink(self):
+        """free the shared memory, once the ring is not used anymore"""
+        del self._frames
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+class OnlineIngest(object):
+    """Fit the frames read from a FrameRing with OnACID as they arrive.
+
+    The first init_batch frames initialize the OnACID object, unless the fit
+    is resumed, the following ones are prepared, motion corrected and fitted
+    one at a time. The latency
+    of every frame, from the time it was put into the ring to the end of its
+    fit, is recorded.
+    """
+
+    def __init__(self, onacid, ring, max_frames=100000, max_lag=None, resume=False):
+        """
+        Args:
+            onacid: OnACID
+                object used for the fit, with params['data']['fnames'] not needed
+
+            ring: FrameRing
+                source of the frames
+
+            max_frames: int
+                maximum number of frames fitted, including the initialization batch,
+                for which the traces are preallocated
+
+            max_lag: float or None
+                frames that waited longer than max_lag seconds in the ring are skipped
+                to catch up with the acquisition. None fits every frame read from the ring
+
+            resume: bool
+                continue the fit of an onacid restored with load_OnACID_state, at frame
+                onacid.t, instead of initializing it on the first frames of the stream
+        """
+        self.onacid = onacid
+        self.ring = ring
+        self.max_frames = max_frames
+        self.max_lag = max_lag
+        self.resume = resume
+        self.latency:List = []      # seconds from put to end of fit, per fitted frame
+        self.frame_index:List = []  # index in the stream of each fitted frame
+        self.skipped = 0
+
+    def run(self, timeout=None, state_file=None):
+        """Consume frames until the ring is closed and empty
+
+        Args:
+            timeout: float
+                stop if no frame arrives for timeout seconds
+
+            state_file: str
+                if given, the state of the fit is saved to this file with
+                OnACID.save_state before the estimates are finalized
+
+        Returns:
+            onacid: the fitted OnACID object
+        """
+        cnm = self.onacid
+        if self.resume:
+            logging.info('Resuming the fit at frame {}'.format(cnm.t))
+            cnm._reserve_frames(self.max_frames)
+            count = t = cnm.t
+        else:
+            init_batch = cnm.params.get('online', 'init_batch')
+            Y_init = []
+            while len(Y_init) < init_batch:
+                item = self.ring.get(timeout)
+                if item is None:
+                    raise Exception('The stream ended before the {} frames of the initialization'.format(init_batch))
+                Y_init.append(item[0])
+            logging.info('Initializing on the first {} frames of the stream'.format(init_batch))
+            cnm.initialize_online(Y=np.array(Y_init), T=self.max_frames)
+            del Y_init
+            count = t = init_batch
+        t_online = []
+        latency_control = cnm._latency_controller()
+        while t < self.max_frames:
+            item = self.ring.get(timeout)
+            if item is None:
+                break
+            frame, timestamp = item
+            count += 1
+            if self.max_lag is not None and time() - timestamp > self.max_lag:
+                self.skipped += 1
+                continue
+            t_frame_start = time()
+            if np.isnan(np.sum(frame)):
+                raise Exception('Frame ' + str(count - 1) + ' contains NaN')
+            cnm.process_frame(t, cnm._prepare_frame(frame), latency_control)
+            t += 1
+            t_online.append(time() - t_frame_start)
+            self.latency.append(time() - timestamp)
+            self.frame_index.append(count - 1)
+        if t == self.max_frames and self.ring.backlog() > 0:
+            logging.warning('Stopped after max_frames={} frames'.format(self.max_frames))
+        cnm.t_online = t_online
+        if latency_control is not None:
+            cnm.timing_log = latency_control.timing_log()
+        if state_file is not None:
+            cnm.save_state(state_file, t)
+        cnm._finalize_estimates(t, 1, self.ring.frame_shape)
+        pct = self.latency_percentiles()
+        logging.info('Fitted {} frames, skipped {}, dropped by the ring {}. Latency (s): {}'.format(
+            t, self.skipped, self.ring.dropped, ', '.join('p{}={:.4f}'.format(q, v) for q, v in pct.items())))
+        return cnm
+
+    def latency_percentiles(self, q=(50, 90, 99)) -> Dict:
+        """percentiles of the latency (seconds) of the fitted frames"""
+        if len(self.latency) == 0:
+            return {}
+        return dict(zip(q, np.percentile(self.latency, q)))
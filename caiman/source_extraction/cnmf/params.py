@@ -78,6 +78,10 @@ class CNMFParams(object):
             last_commit: str
                 hash of last commit in the caiman repo
 
+            checkpoint_dir: str or None, default: None
+                directory where CNMF.fit saves its state after each stage (and the results of each patch).
+                A rerun on the same movie with the same parameters resumes after the last completed stage
+
             mmap_F: list[str]
                 paths to F-order memory mapped files after motion correction
 
@@ -135,6 +139,14 @@ class CNMFParams(object):
             in_memory: bool, default: True
                 Whether to load patches in memory
 
+            schedule: str, default: 'grid'
+                Order in which patches are dispatched to the workers. 'grid' follows the grid of patches,
+                'size' sends the largest patches first and 'activity' weights the size of each patch by
+                its mean local correlation, which shortens the wait for the last patches when they
+                differ in cost. The patches draw the random order in which their components are updated
+                in turn, so the order can change the result within that randomness. The wall time and
+                the estimated cost of each patch are reported in the optional outputs of run_CNMF_patches
+
         PRE-PROCESS PARAMS (CNMFParams.preprocess) #############
 
             sn: np.array or None, default: None
@@ -313,9 +325,10 @@ class CNMFParams(object):
             update_background_components: bool, default: True
                 whether to update the spatial background components
 
-            method_ls: 'lasso_lars'|'nnls_L0', default: 'lasso_lars'
+            method_ls: 'lasso_lars'|'lasso_batched'|'nnls_L0', default: 'lasso_lars'
                 'nnls_L0'. Nonnegative least square with L0 penalty
                 'lasso_lars' lasso lars function from scikit learn
+                'lasso_batched' same problem as 'lasso_lars', solving together the pixels that share their components
 
             block_size : int, default: 5000
                 Number of pixels to process at the same time for dot product. Reduce if you face memory problems
@@ -423,6 +436,15 @@ class CNMFParams(object):
             batch_update_suff_stat: bool, default: False
                 Whether to update sufficient statistics in batch mode
 
+            batch_frames: int, default: 1
+                Number of frames fitted together with OnACID.fit_next_batch in fit_online, when motion_correct,
+                ring_CNN, realtime and show_movie are off. Larger values speed up the processing of stored
+                data with the same results up to numerical precision
+
+            cnn_thread: bool, default: False
+                With test_both, run the CNN classifier in a separate thread while the candidate
+                components are tested by space correlation
+
             ds_factor: int, default: 1,
                 spatial downsampling factor for faster processing (if > 1)
 
@@ -448,6 +470,15 @@ class CNMFParams(object):
             iters_shape: int, default: 5
                 Number of block-coordinate decent iterations for each shape update
 
+            latency_budget: float or None, default: None
+                Target processing time per frame (seconds) in realtime mode. None uses 1/fr
+
+            latency_pct: float, default: 99
+                Percentile of the processing time per frame compared to the budget in realtime mode
+
+            latency_window: int, default: 100
+                Number of recent frames over which the percentile of the processing time is computed
+
             max_comp_update_shape: int, default: np.inf
                 Maximum number of spatial components to be updated at each time
 
@@ -478,6 +509,10 @@ class CNMFParams(object):
             normalize: bool, default: False
                 Whether to normalize each frame prior to online processing
 
+            n_prefetch: int, default: 10
+                Number of frames read (and downsampled) ahead by a background thread in fit_online. 0 reads
+                each frame when it is processed
+
             n_refit: int, default: 0
                 Number of additional iterations for computing traces
 
@@ -489,6 +524,11 @@ class CNMFParams(object):
             path_to_model: str, default: os.path.join(caiman_datadir(), 'model', 'cnn_model_online.h5')
                 Path to online CNN classifier
 
+            realtime: bool, default: False
+                Whether to adapt the processing of each frame to the latency budget when the processing time
+                exceeds it: search for new components less often, use fewer HALS iterations and defer shape
+                updates. The timing of every frame is stored in the timing_log attribute of OnACID
+
             rval_thr: float, default: 0.8
                 space correlation threshold for accepting a new component
 
@@ -538,6 +578,12 @@ class CNMFParams(object):
                 flag for allowing NaN in the boundaries. True allows NaN, whereas 'copy' copies the value of the
                 nearest data point.
 
+            fft_batch_size: int or None, default: None
+                number of frames registered together in vectorized batches. If None frames are registered one at a time
+
+            flow_downsample: int, default: 1
+                with nonrigid_engine='optical_flow', downsampling factor of the frames for estimating the flow
+
             gSig_filt: int or None, default: None
                 size of kernel for high pass spatial filtering in 1p data. If None no spatial filtering is performed
 
@@ -559,6 +605,10 @@ class CNMFParams(object):
             nonneg_movie: bool, default: True
                 flag for producing a non-negative movie.
 
+            nonrigid_engine: str, default: 'pwrigid'
+                registration used for pw-rigid motion correction, 'pwrigid' (shifts of patches) or
+                'optical_flow' (dense Farneback optical flow, faster with fine grids and for 1p data)
+
             num_frames_split: int, default: 80
                 split movie every x frames for parallel processing
 
@@ -571,6 +621,10 @@ class CNMFParams(object):
             pw_rigid: bool, default: False
                 flag for performing pw-rigid motion correction.
 
+            pyramid_levels: int, default: 0
+                if > 0, rigid shifts are estimated on frames downsampled by 2**pyramid_levels, then refined
+                at full resolution. Faster for large frames and max_shifts. Ignored if fft_batch_size is set
+
             shifts_opencv: bool, default: True
                 flag for applying shifts using cubic interpolation (otherwise FFT)
 
@@ -580,6 +634,9 @@ class CNMFParams(object):
             splits_rig: int, default: 14
                 number of splits across time for rigid registration
 
+            streaming_template: bool, default: False
+                with niter_rig > 1, refine the rigid template in a single pass, updating it as chunks are registered
+
             strides: (int, int), default: (96, 96)
                 how often to start a new patch in pw-rigid registration. Size of each patch will be strides + overlaps
 
@@ -648,7 +705,8 @@ class CNMFParams(object):
             'caiman_version': pkg_resources.get_distribution('caiman').version,
             'last_commit': None,
             'mmap_F': None,
-            'mmap_C': None
+            'mmap_C': None,
+            'checkpoint_dir': None
         }
 
         self.patch = {
@@ -663,6 +721,7 @@ class CNMFParams(object):
             'p_patch': 0,                 # AR order within patch
             'remove_very_bad_comps': remove_very_bad_comps,
             'rf': rf,
+            'schedule': 'grid',           # order in which patches are dispatched
             'skip_refinement': False,
             'p_ssub': p_ssub,             # spatial downsampling factor
             'stride': stride,
@@ -800,6 +859,8 @@ class CNMFParams(object):
         self.online = {
             'N_samples_exceptionality': N_samples_exceptionality,  # timesteps to compute SNR
             'batch_update_suff_stat': batch_update_suff_stat,
+            'batch_frames': 1,                 # frames fitted together when replaying stored data
+            'cnn_thread': False,               # run the CNN classifier in a thread while testing space correlation
             'dist_shape_update': False,        # update shapes in a distributed way
             'ds_factor': 1,                    # spatial downsampling for faster processing
             'epochs': 1,                       # number of epochs
@@ -808,6 +869,9 @@ class CNMFParams(object):
             'init_batch': 200,                 # length of mini batch for initialization
             'init_method': 'bare',             # initialization method for first batch,
             'iters_shape': iters_shape,        # number of block-CD iterations
+            'latency_budget': None,            # target time per frame in realtime mode (default 1/fr)
+            'latency_pct': 99,                 # percentile of the time per frame compared to the budget
+            'latency_window': 100,             # frames in the rolling percentile of the time per frame
             'max_comp_update_shape': max_comp_update_shape,
             'max_num_added': max_num_added,    # maximum number of new components for each frame
             'max_shifts_online': 10,           # maximum shifts during motion correction
@@ -818,12 +882,14 @@ class CNMFParams(object):
             'motion_correct': True,            # flag for motion correction
             'movie_name_online': 'online_movie.mp4',  # filename of saved movie (appended to directory where data is located)
             'normalize': False,                # normalize frame
+            'n_prefetch': 10,                  # frames read ahead by a background thread
             'n_refit': n_refit,                # Additional iterations to simultaneously refit
             # path to CNN model for testing new comps
             'num_times_comp_updated': num_times_comp_updated,
             'opencv_codec': 'H264',            # FourCC video codec for saving movie. Check http://www.fourcc.org/codecs.php
             'path_to_model': os.path.join(caiman_datadir(), 'model',
                                           'cnn_model_online.h5'),
+            'realtime': False,                 # adapt the processing to the latency budget
             'ring_CNN': False,                 # flag for using a ring CNN background model 
             'rval_thr': rval_thr,              # space correlation threshold
             'save_online_movie': False,        # flag for saving online movie
@@ -846,6 +912,8 @@ class CNMFParams(object):
 
         self.motion = {
             'border_nan': 'copy',               # flag for allowing NaN in the boundaries
+            'fft_batch_size': None,             # number of frames registered together (None: one at a time)
+            'flow_downsample': 1,               # downsampling factor for estimating the optical flow
             'gSig_filt': None,                  # size of kernel for high pass spatial filtering in 1p data
             'is3D': False,                      # flag for 3D recordings for motion correction
             'max_deviation_rigid': 3,           # maximum deviation between rigid and non-rigid
@@ -853,14 +921,17 @@ class CNMFParams(object):
             'min_mov': None,                    # minimum value of movie
             'niter_rig': 1,                     # number of iterations rigid motion correction
             'nonneg_movie': True,               # flag for producing a non-negative movie
+            'nonrigid_engine': 'pwrigid',       # registration for pw-rigid motion correction ('pwrigid' or 'optical_flow')
             'num_frames_split': 80,             # split across time every x frames
             'num_splits_to_process_els': None,  # DO NOT MODIFY
             'num_splits_to_process_rig': None,  # DO NOT MODIFY
             'overlaps': (32, 32),               # overlap between patches in pw-rigid motion correction
             'pw_rigid': False,                  # flag for performing pw-rigid motion correction
+            'pyramid_levels': 0,                # levels of coarse to fine rigid registration (0: full resolution)
             'shifts_opencv': True,              # flag for applying shifts using cubic interpolation (otherwise FFT)
             'splits_els': 14,                   # number of splits across time for pw-rigid registration
             'splits_rig': 14,                   # number of splits across time for rigid registration
+            'streaming_template': False,        # refine the rigid template in one pass as chunks are registered
             'strides': (96, 96),                # how often to start a new patch in pw-rigid registration
             'upsample_factor_grid': 4,          # motion field upsampling factor during FFT shifts
             'use_cuda': False,                  # flag for using a GPU
@@ -22,6 +22,7 @@ import scipy
 import shutil
 import tempfile
 import logging
+from ...cluster import get_executor
 from ...mmapping import load_memmap
 
 #%%
@@ -251,18 +252,7 @@ def get_noise_fft_parallel(Y, n_pixels_per_process=100, dview=None, **kwargs):
         results = list(map(fft_psd_multithreading, argsin))
 
     else:
-        if 'multiprocessing' in str(type(dview)):
-            results = dview.map_async(
-                fft_psd_multithreading, argsin).get(4294967)
-        else:
-            ne = len(dview)
-            print(('Running on %d engines.' % (ne)))
-            if dview.client.profile == 'default':
-                results = dview.map_sync(fft_psd_multithreading, argsin)
-
-            else:
-                print(('PROFILE:' + dview.client.profile))
-                results = dview.map_sync(fft_psd_multithreading, argsin)
+        results = get_executor(dview).map(fft_psd_multithreading, argsin)
 
     _, _, psx_ = results[0]
     sn_s = np.zeros(Y.shape[0])
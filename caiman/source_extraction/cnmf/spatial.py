@@ -29,7 +29,8 @@ import time
 import psutil
 from typing import List
 
-from ...mmapping import load_memmap, parallel_dot_product
+from ...cluster import SharedMemoryPool, get_executor, resolve_shared
+from ...mmapping import load_memmap, parallel_dot_product, ChunkedMemmap
 from ...utils.stats import csc_column_remove
 
 
@@ -117,6 +118,7 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
             method to perform the regression for the basis pursuit denoising.
                  'nnls_L0'. Nonnegative least square with L0 penalty
                  'lasso_lars' lasso lars function from scikit learn
+                 'lasso_batched' same as 'lasso_lars', with the pixels that share their components solved together
 
             normalize_yyt_one: bool
                 whether to normalize the C and A matrices so that diag(C*C.T) are ones
@@ -220,27 +222,22 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
         pixel_groups.append([Y_name, C_name, sn, ind2_[(i + n_pixels_per_process):np.prod(dims)], list(
             range(i + n_pixels_per_process, np.prod(dims))), method_ls, cct])
     #A_ = scipy.sparse.lil_matrix((d, nr + np.size(f, 0)))
-    if dview is not None:
-        if 'multiprocessing' in str(type(dview)):
-            parallel_result = dview.map_async(
-                regression_ipyparallel, pixel_groups).get(4294967)
-        else:
-            parallel_result = dview.map_sync(
-                regression_ipyparallel, pixel_groups)
-            dview.results.clear()
-    else:
-        parallel_result = list(map(regression_ipyparallel, pixel_groups))
     data:List = []
     rows:List = []
     cols:List = []
-    for chunk in parallel_result:
-        for pars in chunk:
-            px, idxs_, a = pars
-            #A_[px, idxs_] = a
-            nz = np.where(a>0)[0]
-            data.extend(a[nz])
-            rows.extend(len(nz)*[px])
-            cols.extend(idxs_[nz])
+    try:
+        # every chunk carries its pixel indices, consume them as they complete
+        for chunk in get_executor(dview).imap_unordered(regression_ipyparallel, pixel_groups):
+            for pars in chunk:
+                px, idxs_, a = pars
+                #A_[px, idxs_] = a
+                nz = np.where(a>0)[0]
+                data.extend(a[nz])
+                rows.extend(len(nz)*[px])
+                cols.extend(idxs_[nz])
+    finally:
+        if isinstance(dview, SharedMemoryPool):
+            dview.release(C_name)
     A_ = scipy.sparse.coo_matrix((data, (rows, cols)), shape=(d, nr + np.size(f, 0)))
 
     logging.info("thresholding components")
@@ -267,7 +264,7 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
     if update_background_components:
         A_ = csr_matrix(A_)
         logging.info("Computing residuals")
-        if 'memmap' in str(type(Y)):
+        if 'memmap' in str(type(Y)) or isinstance(Y, ChunkedMemmap):
             bl_siz1 = Y.shape[0] // (num_blocks_per_run_spat - 1)
             bl_siz2 = psutil.virtual_memory().available // (4*Y.shape[-1]*(num_blocks_per_run_spat + 1))
             Y_resf = parallel_dot_product(Y, f.T, dview=dview, block_size=min(bl_siz1, bl_siz2), num_blocks_per_run=num_blocks_per_run_spat) - \
@@ -345,6 +342,8 @@ def regression_ipyparallel(pars):
                method to perform the regression for the basis pursuit denoising.
                     'nnls_L0'. Nonnegative least square with L0 penalty
                     'lasso_lars' lasso lars function from scikit learn
+                    'lasso_batched' same problem as 'lasso_lars', solved by lasso_positive_batched
+                    for all the pixels that search the same components
 
        Returns:
            px: np.ndarray
@@ -376,45 +375,61 @@ def regression_ipyparallel(pars):
         C = np.load(C_name, mmap_mode='r')
         C = np.array(C)
     else:
-        C = C_name
+        C = resolve_shared(C_name)
 
     _, T = np.shape(C)  # initialize values
     As = []
-    for y, px, idx_px_from_0 in zip(Y, idxs_Y, range(len(idxs_C))):
-        c = C[idxs_C[idx_px_from_0], :]
-        idx_only_neurons = idxs_C[idx_px_from_0]
-        if len(idx_only_neurons) > 0:
+    if method_least_square == 'lasso_batched':
+        # pixels that search the same components share their regressors and
+        # are solved together
+        groups:dict = {}
+        for idx_px_from_0, px in enumerate(idxs_Y):
+            if len(idxs_C[idx_px_from_0]) > 0 and noise_sn[px] > 0:
+                groups.setdefault(tuple(idxs_C[idx_px_from_0]), []).append(idx_px_from_0)
+        for idx_only_neurons, rows in groups.items():
+            idx_only_neurons = np.array(idx_only_neurons)
             cct_ = cct[idx_only_neurons[idx_only_neurons < len(cct)]]
-        else:
-            cct_ = []
-
-        # skip if no components OR pixel has 0 activity
-        if np.size(c) > 0 and noise_sn[px] > 0:
-            sn = noise_sn[px] ** 2 * T
-            if method_least_square == 'lasso_lars_old':
-                raise Exception("Obsolete parameter") # Old code, support was removed
-
-            elif method_least_square == 'nnls_L0':  # Nonnegative least square with L0 penalty
-                a = nnls_L0(c.T, y, 1.2 * sn)
-
-            elif method_least_square == 'lasso_lars':  # lasso lars function from scikit learn
-                lambda_lasso = 0 if np.size(cct_) == 0 else \
-                    .5 * noise_sn[px] * np.sqrt(np.max(cct_)) / T
-                model = make_pipeline(
-                    StandardScaler(with_mean=False),
-                    linear_model.LassoLars(alpha=lambda_lasso, positive=True,
-                                                 fit_intercept=True)
-                    )
-                a = model.fit(np.array(c.T), np.ravel(y))['lassolars'].coef_
-
+            pxs = np.array(idxs_Y)[rows]
+            lambdas_lasso = np.zeros(len(rows)) if np.size(cct_) == 0 else \
+                .5 * noise_sn[pxs] * np.sqrt(np.max(cct_)) / T
+            a = lasso_positive_batched(C[idx_only_neurons], Y[rows], lambdas_lasso)
+            As.extend(zip(pxs, [idxs_C[row] for row in rows], a))
+    else:
+        for y, px, idx_px_from_0 in zip(Y, idxs_Y, range(len(idxs_C))):
+            c = C[idxs_C[idx_px_from_0], :]
+            idx_only_neurons = idxs_C[idx_px_from_0]
+            if len(idx_only_neurons) > 0:
+                cct_ = cct[idx_only_neurons[idx_only_neurons < len(cct)]]
             else:
-                raise Exception(
-                    'Least Square Method not found!' + method_least_square)
+                cct_ = []
+
+            # skip if no components OR pixel has 0 activity
+            if np.size(c) > 0 and noise_sn[px] > 0:
+                sn = noise_sn[px] ** 2 * T
+                if method_least_square == 'lasso_lars_old':
+                    raise Exception("Obsolete parameter") # Old code, support was removed
+
+                elif method_least_square == 'nnls_L0':  # Nonnegative least square with L0 penalty
+                    a = nnls_L0(c.T, y, 1.2 * sn)
+
+                elif method_least_square == 'lasso_lars':  # lasso lars function from scikit learn
+                    lambda_lasso = 0 if np.size(cct_) == 0 else \
+                        .5 * noise_sn[px] * np.sqrt(np.max(cct_)) / T
+                    model = make_pipeline(
+                        StandardScaler(with_mean=False),
+                        linear_model.LassoLars(alpha=lambda_lasso, positive=True,
+                                                     fit_intercept=True)
+                        )
+                    a = model.fit(np.array(c.T), np.ravel(y))['lassolars'].coef_
+
+                else:
+                    raise Exception(
+                        'Least Square Method not found!' + method_least_square)
 
-            if not np.isscalar(a):
-                a = a.T
+                if not np.isscalar(a):
+                    a = a.T
 
-            As.append((px, idxs_C[idx_px_from_0], a))
+                As.append((px, idxs_C[idx_px_from_0], a))
 
     if isinstance(Y_name, str):
         del Y
@@ -508,14 +523,7 @@ def threshold_components(A, dims, medw=None, thr_method='max', maxthr=0.1, nrgth
         pars.append([A_1[:, i], i, dims,
                      medw, d, thr_method, se, ss, maxthr, nrgthr, extract_cc])
 
-    if dview is not None:
-        if 'multiprocessing' in str(type(dview)):
-            res = dview.map_async(
-                threshold_components_parallel, pars).get(4294967)
-        else:
-            res = dview.map_async(threshold_components_parallel, pars)
-    else:
-        res = list(map(threshold_components_parallel, pars))
+    res = get_executor(dview).map(threshold_components_parallel, pars)
 
     res.sort(key=lambda x: x[1])
     indices:List = []
@@ -623,6 +631,53 @@ def threshold_components_parallel(pars):
 
     return csr_matrix(Ath2), i
 
+def lasso_positive_batched(C, Y, alphas, max_iter=1000, tol=1e-8):
+    """
+    Nonnegative lasso with intercept for many regressands sharing the same regressors
+
+    For each row y of Y it solves the problem of the 'lasso_lars' method
+    min 1/(2T) ||y - a*X - a0||**2 + alpha*sum(a)
+    with a >= 0, where X is C with each row divided by its standard deviation,
+    by cyclic coordinate descent on all rows at once. The Gram matrix of the
+    centered X is computed once and shared by all the rows
+
+    Args:
+        C: np.ndarray
+            the regressors (components x time)
+
+        Y: np.ndarray
+            the regressands (pixels x time)
+
+        alphas: np.ndarray
+            L1 penalty of each pixel
+
+        max_iter: int
+            maximum number of sweeps over the components
+
+        tol: float
+            stop when no weight changes by more than tol times the largest weight
+
+    Returns:
+        A: np.ndarray
+            the learned weights (pixels x components), of the scaled regressors as for 'lasso_lars'
+    """
+    C = np.asarray(C, dtype=np.float64)
+    T = C.shape[1]
+    scale = C.std(1)
+    scale[scale == 0] = 1
+    X = (C - C.mean(1)[:, None]) / scale[:, None]
+    G = X.dot(X.T) / T
+    Q = X.dot((Y - Y.mean(1)[:, None]).T) / T - np.asarray(alphas)[None, :]
+    W = np.zeros(Q.shape)
+    for _ in range(max_iter):
+        W_old = W.copy()
+        for j in np.where(np.diag(G) > 0)[0]:
+            W[j] = np.maximum(W[j] + (Q[j] - G[j].dot(W)) / G[j, j], 0)
+        if np.abs(W - W_old).max(initial=0) <= tol * np.abs(W).max(initial=1):
+            break
+    return W.T
+
+
 def nnls_L0(X, Yp, noise):
     """
     Nonnegative least square with L0 penalty
@@ -887,14 +942,7 @@ def determine_search_location(A, dims, method='ellipse', min_size=3, max_size=8,
             for i in range(nr):
                 pars.append([Coor, cm[i], A[:, i], Vr, dims,
                              dist, max_size, min_size, d])
-            if dview is None:
-                res = list(map(construct_ellipse_parallel, pars))
-            else:
-                if 'multiprocessing' in str(type(dview)):
-                    res = dview.map_async(
-                        construct_ellipse_parallel, pars).get(4294967)
-                else:
-                    res = dview.map_sync(construct_ellipse_parallel, pars)
+            res = get_executor(dview).map(construct_ellipse_parallel, pars)
             for r in res:
                 dist_indicator.append(r)
 
@@ -932,13 +980,7 @@ def determine_search_location(A, dims, method='ellipse', min_size=3, max_size=8,
             for i in range(nr):
                 pars.append([A[:, i], dims, expandCore, d])
 
-            if 'multiprocessing' in str(type(dview)):
-                parallel_result = dview.map_async(
-                    construct_dilate_parallel, pars).get(4294967)
-            else:
-                parallel_result = dview.map_sync(
-                    construct_dilate_parallel, pars)
-                dview.results.clear()
+            parallel_result = get_executor(dview).map(construct_dilate_parallel, pars)
 
             i = 0
             for res in parallel_result:
@@ -1105,8 +1147,8 @@ def creatememmap(Y, Cf, dview):
                calcium activity of each neuron + background components
 
        Returns:
-           C_name: string
-                the memmapped name of Cf
+           C_name: string or SharedArray
+                the memmapped name of Cf, or its handle if dview is a SharedMemoryPool
 
            Y_name: string
                 the memmapped name of Y
@@ -1125,9 +1167,6 @@ def creatememmap(Y, Cf, dview):
         Y_name = Y
         C_name = Cf
     else:
-        C_name = os.path.join(folder, 'C_temp.npy')
-        np.save(C_name, Cf)
-
         if isinstance(Y, np.core.memmap):  # if input file is already memory mapped then find the filename
             Y_name = Y.filename
         # if not create a memory mapped version (necessary for parallelization)
@@ -1138,6 +1177,12 @@ def creatememmap(Y, Cf, dview):
             np.save(Y_name, Y)
             Y, _, _, _ = load_memmap(Y_name)
             raise Exception('Not implemented consistently')
+
+        if isinstance(dview, SharedMemoryPool):
+            C_name = dview.publish(Cf)
+        else:
+            C_name = os.path.join(folder, 'C_temp.npy')
+            np.save(C_name, Cf)
     return C_name, Y_name, folder
 
 def circular_constraint(img_original):
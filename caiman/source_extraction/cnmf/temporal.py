@@ -13,8 +13,8 @@ import platform
 import psutil
 from .deconvolution import constrained_foopsi
 from .utilities import update_order_greedy
-import sys
-from ...mmapping import parallel_dot_product
+from ...cluster import get_executor, IpyparallelExecutor, SerialExecutor
+from ...mmapping import parallel_dot_product, ChunkedMemmap
 
 def make_G_matrix(T, g):
     """
@@ -203,7 +203,7 @@ def update_temporal_components(Y, A, b, Cin, fin, bl=None, c1=None, g=None, sn=N
 
     logging.info('Generating residuals')
 #    dview_res = None if block_size >= 500 else dview
-    if 'memmap' in str(type(Y)):
+    if 'memmap' in str(type(Y)) or isinstance(Y, ChunkedMemmap):
         bl_siz1 = d // (np.maximum(num_blocks_per_run_temp - 1, 1))
         bl_siz2 = int(psutil.virtual_memory().available/(num_blocks_per_run_temp + 1) - 4*A.nnz) // int(4*T)
         # block_size_temp
@@ -336,6 +336,13 @@ def update_iteration(parrllcomp, len_parrllcomp, nb, C, S, bl, nr,
 """
 
     lam = np.repeat(None, nr)
+    executor = get_executor(dview)
+    if isinstance(executor, IpyparallelExecutor):
+        if platform.system() == 'Darwin':
+            executor = SerialExecutor()
+        elif debug:
+            # print the output of the engines
+            executor = IpyparallelExecutor(executor.view, echo_output=True)
     for _ in range(ITER):
 
         for count, jo_ in enumerate(parrllcomp):
@@ -348,27 +355,7 @@ def update_iteration(parrllcomp, len_parrllcomp, nb, C, S, bl, nr,
             args_in = [(np.squeeze(np.array(Ytemp[:, jj])), nT[jj], jj, None,
                         None, None, None, kwargs) for jj in range(len(jo))]
             # computing the most likely discretized spike train underlying a fluorescence trace
-            if 'multiprocessing' in str(type(dview)):
-                results = dview.map_async(
-                    constrained_foopsi_parallel, args_in).get(4294967)
-
-            elif dview is not None and platform.system() != 'Darwin':
-                if debug:
-                    results = dview.map_async(
-                        constrained_foopsi_parallel, args_in)
-                    results.get()
-                    for outp in results.stdout:
-                        print((outp[:-1]))
-                        sys.stdout.flush()
-                    for outp in results.stderr:
-                        print((outp[:-1]))
-                        sys.stderr.flush()
-                else:
-                    results = dview.map_sync(
-                        constrained_foopsi_parallel, args_in)
-
-            else:
-                results = list(map(constrained_foopsi_parallel, args_in))
+            results = executor.map(constrained_foopsi_parallel, args_in)
             # unparsing and updating the result
             for chunk in results:
                 C_, Sp_, Ytemp_, cb_, c1_, sn_, gn_, jj_, lam_ = chunk
@@ -392,9 +379,6 @@ def update_iteration(parrllcomp, len_parrllcomp, nb, C, S, bl, nr,
             YrA -= AA[ii, :].T.dot((cc - Cin[ii])[None, :]).T
             C[ii, :] = cc
 
-        if dview is not None and not('multiprocessing' in str(type(dview))):
-            dview.results.clear()
-
         try:
             if scipy.linalg.norm(Cin - C, 'fro') <= 1e-3*scipy.linalg.norm(C, 'fro'):
                 logging.info("stopping: overall temporal component not changing" +
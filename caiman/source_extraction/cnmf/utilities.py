@@ -36,8 +36,8 @@ from typing import List
 
 from .initialization import greedyROI
 from ...base.rois import com
-from ...mmapping import parallel_dot_product, load_memmap
-from ...cluster import extract_patch_coordinates
+from ...mmapping import parallel_dot_product, load_memmap, ChunkedMemmap
+from ...cluster import extract_patch_coordinates, get_executor
 from ...utils.stats import df_percentile
 
 
@@ -424,7 +424,7 @@ def extract_DF_F(Yr, A, C, bl, quantileMin=8, frames_window=200, block_size=400,
     nA = np.array(np.sqrt(A.power(2).sum(0)).T)
 
     T = C.shape[-1]
-    if 'memmap' in str(type(Yr)):
+    if 'memmap' in str(type(Yr)) or isinstance(Yr, ChunkedMemmap):
         if block_size >= 500:
             print('Forcing single thread for memory issues')
             dview_res = None
@@ -920,6 +920,74 @@ def update_order(A, new_a=None, prev_list=None, method='greedy'):
 
         return prev_list, count_list
 
+def update_order_incremental(groups, AtA, changed=None, removed=None, num_groups_greedy=None, max_growth=1.5):
+    """Updates the groups of components that can be updated in parallel (see
+    update_order) after some components were removed or their footprints
+    changed, touching only these components instead of recomputing all groups.
+    Moving single components never merges groups, so all the groups are
+    recomputed with the greedy method once they grow too numerous
+
+    Args:
+        groups: list of lists
+            groups of (indices of) components that do not overlap, before the change
+
+        AtA: np.ndarray
+            overlap matrix A.T.dot(A) of the components, after the change
+
+        changed: list or np.ndarray
+            indices (after the removal) of the components whose footprints changed
+
+        removed: list or np.ndarray
+            indices (before the removal) of the removed components
+
+        num_groups_greedy: int
+            number of groups of the last greedy grouping of all the components,
+            the number of groups passed if None
+
+        max_growth: float
+            the groups are recomputed when there are more than max_growth * num_groups_greedy
+
+    Returns:
+        groups: list of lists
+            every component in exactly one group, and no two overlapping components in the same group
+
+        num_groups_greedy: int
+            number of groups of the last greedy grouping, to pass to the next call
+    """
+    if num_groups_greedy is None:
+        num_groups_greedy = len(groups)
+    if removed is not None and len(removed) > 0:
+        keep = np.ones(AtA.shape[0] + len(removed), dtype=bool)
+        keep[list(removed)] = False
+        new_index = np.cumsum(keep) - 1
+        groups = [[int(new_index[m]) for m in group if keep[m]] for group in groups]
+        groups = [group for group in groups if len(group) > 0]
+    else:
+        groups = [list(group) for group in groups]
+    if changed is not None and len(changed) > 0:
+        which = {m: k for k, group in enumerate(groups) for m in group}
+        for m in changed:
+            group = groups[which[m]]
+            others = [j for j in group if j != m]
+            if not others or not np.any(AtA[m, others] > 0):
+                continue
+            # m overlaps now with a component of its group: move it to the first group it fits in
+            group.remove(m)
+            for k, gr in enumerate(groups):
+                if not np.any(AtA[m, gr] > 0):
+                    gr.append(m)
+                    which[m] = k
+                    break
+            else:
+                groups.append([m])
+                which[m] = len(groups) - 1
+        groups = [group for group in groups if len(group) > 0]
+    if len(groups) > max_growth * num_groups_greedy:
+        groups = update_order_greedy(csr_matrix(AtA > 0))[0]
+        num_groups_greedy = len(groups)
+    return groups, num_groups_greedy
+
+
 def order_components(A, C):
     """Order components based on their maximum temporal value and size
 
@@ -1308,10 +1376,7 @@ def fast_graph_Laplacian(mmap_file, dims, max_radius=10, kernel='heat',
         for i in range(Np):
             pars.append([i, mmap_file, dims, max_radius, kernel, sigma, thr,
                          p, normalize, use_NN])
-        if dview is None:
-            res = list(map(fast_graph_Laplacian_pixel, pars))
-        else:
-            res = dview.map(fast_graph_Laplacian_pixel, pars, chunksize=128)
+        res = get_executor(dview).map(fast_graph_Laplacian_pixel, pars, chunksize=128)
         indptr = np.cumsum(np.array([0] + [len(r[0]) for r in res]))
         indeces = [item for sublist in res for item in sublist[0]]
         data = [item for sublist in res for item in sublist[1]]
@@ -1324,10 +1389,7 @@ def fast_graph_Laplacian(mmap_file, dims, max_radius=10, kernel='heat',
         for i in range(len(indices)):
             pars.append([mmap_file, indices[i], kernel, sigma, thr, p,
                          normalize, use_NN])
-        if dview is None:
-            res = list(map(fast_graph_Laplacian_patches, pars))
-        else:
-            res = dview.map(fast_graph_Laplacian_patches, pars)
+        res = get_executor(dview).map(fast_graph_Laplacian_patches, pars)
         W = res
         D = [scipy.sparse.spdiags(w.sum(0), 0, w.shape[0], w.shape[0]) for w in W]
         L = [d - w for (d, w) in zip(W, D)]
@@ -4,6 +4,7 @@
 import logging
 import numpy as np
 from . import atm
+from ...cluster import get_executor
 from . import spikepursuit
 
 try:
@@ -147,12 +148,7 @@ class VOLPY(object):
                     weights = self.params.data['weights'][i]
                 args_in.append([fnames, fr, idx, ROIs, weights, self.params.volspike])
 
-            if 'multiprocessing' in str(type(dview)):
-                results_part = dview.map_async(volspike, args_in).get(4294967)
-            elif dview is not None:
-                results_part = dview.map_sync(volspike, args_in)
-            else:
-                results_part = list(map(volspike, args_in))
+            results_part = get_executor(dview).map(volspike, args_in)
             results = results + results_part
         
         for i in results[0].keys():
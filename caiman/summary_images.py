@@ -18,6 +18,7 @@ from scipy.sparse import coo_matrix
 from typing import Any, List, Optional, Tuple
 
 import caiman as cm
+from caiman.cluster import get_executor
 from caiman.source_extraction.cnmf.pre_processing import get_noise_fft
 from caiman.source_extraction.cnmf.utilities import get_file_size
 
@@ -388,17 +389,20 @@ def correlation_image_ecobost(mov, chunk_size: int = 1000, dview=None):
     """
     # MAP
     if isinstance(mov, list):
-        if dview is not None:
-            res = dview.map(map_corr, mov)
-        else:
-            res = map(map_corr, mov)
+        res = get_executor(dview).map(map_corr, mov)
 
     else:
         scan = mov.astype(np.float32)
         num_frames = scan.shape[0]
         res = map(map_corr, iter_chunk_array(scan, chunk_size))
 
-    sum_x, sum_sqx, sum_xy, num_frames = [np.sum(np.array(a), 0) for a in zip(*res)]
+    return correlation_image_from_sums(*[np.sum(np.array(a), 0) for a in zip(*res)])
+
+
+def correlation_image_from_sums(sum_x, sum_sqx, sum_xy, num_frames) -> np.ndarray:
+    """ Correlation image from the sums returned by map_corr, added over the
+    chunks of a movie (see correlation_image_ecobost)
+    """
     denom_factor = np.sqrt(num_frames * sum_sqx - sum_x**2)
     corrs = np.zeros(sum_xy.shape)
     for k in [0, 1, 2, 3]:
@@ -764,14 +768,7 @@ def local_correlations_movie_offline(file_name,
                    order_mean, ismulticolor, remove_baseline, winSize_baseline,
                    quantil_min_baseline, gaussian_blur])
 
-    if dview is None:
-        parallel_result = list(map(local_correlations_movie_parallel, params))
-    else:
-        if 'multiprocessing' in str(type(dview)):
-            parallel_result = dview.map_async(local_correlations_movie_parallel, params).get(4294967)
-        else:
-            parallel_result = dview.map_sync(local_correlations_movie_parallel, params)
-            dview.results.clear()
+    parallel_result = get_executor(dview).map(local_correlations_movie_parallel, params)
 
     mm = cm.movie(np.concatenate(parallel_result, axis=0), fr=fr/len(parallel_result))
     return mm
@@ -831,14 +828,7 @@ def mean_image(file_name,
     if remain_frames > 0:
         params.append([file_name, range(int(Tot_frames / window) * window, Tot_frames)])
 
-    if dview is None:
-        parallel_result = list(map(mean_image_parallel, params))
-    else:
-        if 'multiprocessing' in str(type(dview)):
-            parallel_result = dview.map_async(mean_image_parallel, params).get(4294967)
-        else:
-            parallel_result = dview.map_sync(mean_image_parallel, params)
-            dview.results.clear()
+    parallel_result = get_executor(dview).map(mean_image_parallel, params)
 
     mm = cm.movie(np.concatenate(parallel_result, axis=0), fr=fr/len(parallel_result))
     if remain_frames > 0:
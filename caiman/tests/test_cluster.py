@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+import concurrent.futures
+import multiprocessing.pool
+import numpy.testing as npt
+import numpy as np
+import os
+import tempfile
+
+import caiman as cm
+from caiman.cluster import (Executor, FuturesExecutor, PoolExecutor, SerialExecutor, SharedMemoryPool, get_executor,
+                            resolve_shared, setup_cluster)
+from caiman.mmapping import parallel_dot_product
+
+
+def _sum_rows(pars):
+    handle, idx = pars
+    return resolve_shared(handle)[idx].sum()
+
+
+def _square(x):
+    return x ** 2
+
+
+def test_executors():
+    thread_pool = multiprocessing.pool.ThreadPool(2)
+    futures_pool = concurrent.futures.ThreadPoolExecutor(2)
+    try:
+        for dview, kind in [(None, SerialExecutor), (thread_pool, PoolExecutor),
+                            (futures_pool, FuturesExecutor)]:
+            executor = get_executor(dview)
+            npt.assert_(isinstance(executor, kind))
+            npt.assert_(get_executor(executor) is executor)
+            npt.assert_equal(executor.map(_square, range(20), chunksize=3), [x ** 2 for x in range(20)])
+            npt.assert_equal(sorted(executor.imap_unordered(_square, iter(range(20)), chunksize=3)),
+                             [x ** 2 for x in range(20)])
+            npt.assert_(not executor.local_processes)
+    finally:
+        thread_pool.terminate()
+        futures_pool.shutdown()
+    # engines must implement map and imap_unordered
+    npt.assert_raises(TypeError, Executor)
+
+
+def test_shared_memory_pool():
+    _, dview, _ = setup_cluster(backend='shared_memory', n_processes=2)
+    try:
+        npt.assert_(isinstance(dview, SharedMemoryPool))
+        npt.assert_(get_executor(dview).local_processes)
+        X = np.random.rand(50, 20)
+        handle = dview.publish(X)
+        res = dview.map_async(_sum_rows, [(handle, i) for i in range(len(X))]).get(4294967)
+        npt.assert_allclose(res, X.sum(1))
+        dview.release(handle)
+
+        # parallel_dot_product publishes the dense factor instead of pickling it for each block
+        fname = os.path.join(tempfile.mkdtemp(), cm.paths.memmap_frames_filename('test', (10, 10), 30, 'C'))
+        Yr = np.memmap(fname, mode='w+', dtype=np.float32, shape=(100, 30), order='C')
+        Yr[:] = np.random.rand(100, 30)
+        Yr.flush()
+        Yr, _, _ = cm.load_memmap(fname)
+        b = np.random.rand(30, 4)
+        npt.assert_allclose(parallel_dot_product(Yr, b, block_size=30, dview=dview),
+                            Yr.dot(b), rtol=1e-5)
+        npt.assert_(len(dview._blocks) == 0)
+        # and releases it when a block fails
+        os.remove(fname)
+        npt.assert_raises(FileNotFoundError, parallel_dot_product, Yr, b, block_size=30, dview=dview)
+        npt.assert_(len(dview._blocks) == 0)
+    finally:
+        cm.stop_server(dview=dview)
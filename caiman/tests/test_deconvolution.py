@@ -1,11 +1,13 @@
 #!/usr/bin/env python
 
 import logging
+import pickle
 import numpy.testing as npt
 import numpy as np
 from time import time
 
 from caiman.source_extraction.cnmf.deconvolution import constrained_foopsi
+from caiman.source_extraction.cnmf.oasis import OASIS, fit_next_all
 
 # Set up the logger; change this if you like.
 # You can log to a file using the filename parameter, or make the output more or less
@@ -77,3 +79,40 @@ def foo(method, p):
 def test_oasis():
     foo('oasis', 1)
     foo('oasis', 2)
+
+
+def test_oasis_fit_next_all():
+    # one call for all instances matches fitting each instance on its own
+    for g in ([.95], [1.7, -.71]):
+        Y = gen_data(g, .2, T=300, N=5)[0].astype(np.float32) - 10
+        def instances():
+            return [OASIS(g[0], s_min=.1, num_empty_samples=n, g2=g[1] if len(g) > 1 else 0)
+                    for n in range(5)]
+        single, batch = instances(), instances()
+        C_single = np.zeros((5, 300), dtype=np.float32)
+        C_batch = np.zeros((5, 300), dtype=np.float32)
+        for t in range(5, 300):
+            for n, o in enumerate(single):
+                o.fit_next(Y[n, t])
+                C_single[n, t - o.get_l_of_last_pool() + 1:t + 1] = o.get_c_of_last_pool()
+            fit_next_all(batch, Y[:, t], C_batch, t)
+        npt.assert_allclose(C_batch, C_single)
+        for o1, o2 in zip(single, batch):
+            npt.assert_allclose(o1.c, o2.c)
+            npt.assert_equal(o1.t, o2.t)
+
+
+def test_oasis_pickle():
+    # an instance restored from a pickle continues the fit of the original one
+    for g in ([.95], [1.7, -.71]):
+        y = gen_data(g, .2, T=300, N=1)[0][0].astype(np.float32) - 10
+        o = OASIS(g[0], s_min=.1, g2=g[1] if len(g) > 1 else 0)
+        for t in range(150):
+            o.fit_next(y[t])
+        o2 = pickle.loads(pickle.dumps(o))
+        for t in range(150, 300):
+            o.fit_next(y[t])
+            o2.fit_next(y[t])
+        npt.assert_allclose(o2.c, o.c)
+        npt.assert_allclose(o2.s, o.s)
+        npt.assert_equal(o2.t, o.t)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import h5py
+import numpy.testing as npt
+import numpy as np
+import os
+import tempfile
+
+import caiman as cm
+from caiman.cluster import setup_cluster
+from caiman.source_extraction.cnmf.map_reduce import _permute_rows, run_CNMF_patches
+from caiman.source_extraction.cnmf.params import CNMFParams
+from caiman.tests.test_toydata import gen_data
+
+
+def test_permute_rows():
+    X = np.random.rand(50, 7)
+    order = np.random.permutation(50)
+    Y = X.copy()
+    _permute_rows(Y, order)
+    npt.assert_array_equal(Y, X[order])
+
+
+def _save_toy_memmap():
+    Yr, _, _, _, _, dims = gen_data(2)
+    T = Yr.shape[1]
+    fname = os.path.join(tempfile.mkdtemp(), cm.paths.memmap_frames_filename('patches', dims, T, 'C'))
+    Y = np.memmap(fname, mode='w+', dtype=np.float32, shape=Yr.shape, order='C')
+    Y[:] = Yr
+    Y.flush()
+    del Y
+    return fname, dims, T
+
+
+def test_run_CNMF_patches_parallel():
+    # results are folded in as patches complete, but must not depend on the completion order
+    fname, dims, T = _save_toy_memmap()
+    opts = CNMFParams(dims=dims, k=3, gSig=[2, 2], rf=8, stride=3)
+    res = run_CNMF_patches(fname, dims + (T,), opts, gnb=1)
+    opts_par = CNMFParams(dims=dims, k=3, gSig=[2, 2], rf=8, stride=3)
+    opts_par.set('patch', {'schedule': 'activity'})
+    _, dview, _ = setup_cluster(backend='multiprocessing', n_processes=3)
+    try:
+        res_par = run_CNMF_patches(fname, dims + (T,), opts_par, gnb=1, dview=dview)
+    finally:
+        cm.stop_server(dview=dview)
+    # up to differences in floating point rounding between processes
+    npt.assert_allclose(res[0].toarray(), res_par[0].toarray(), rtol=1e-3, atol=1e-3)
+    for r, r_par in zip(res[1:-1], res_par[1:-1]):
+        npt.assert_allclose(r, r_par, rtol=1e-3, atol=1e-3)
+    npt.assert_array_equal(res[-1]['id_patch_tot'], res_par[-1]['id_patch_tot'])
+    num_patches = len(res_par[-1]['patch_costs'])
+    npt.assert_equal(len(res_par[-1]['patch_times']), num_patches)
+    npt.assert_(np.all(res_par[-1]['patch_times'] > 0))
+
+
+def test_run_CNMF_patches_checkpoint():
+    # patches stored in the checkpoint are not processed again and give the same result
+    fname, dims, T = _save_toy_memmap()
+    checkpoint = os.path.join(os.path.dirname(fname), 'patches.hdf5')
+    opts = CNMFParams(dims=dims, k=3, gSig=[2, 2], rf=8, stride=3)
+    # the patches are seeded with their position, leaving the generator of the caller as it was
+    np.random.seed(1)
+    res = run_CNMF_patches(fname, dims + (T,), opts, gnb=1, checkpoint=checkpoint)
+    npt.assert_equal(np.random.rand(), np.random.RandomState(1).rand())
+    with h5py.File(checkpoint, 'a') as h5file:
+        num_patches = len(h5file['patches'])
+        for jj in range(0, num_patches, 2):
+            del h5file['patches/' + str(jj)]
+    res_resumed = run_CNMF_patches(fname, dims + (T,), opts, gnb=1, checkpoint=checkpoint)
+    npt.assert_allclose(res[0].toarray(), res_resumed[0].toarray())
+    for r, r_resumed in zip(res[1:-1], res_resumed[1:-1]):
+        npt.assert_allclose(r, r_resumed)
+    patch_times = res_resumed[-1]['patch_times']
+    npt.assert_(np.all(patch_times[::2] > 0))
+    npt.assert_(np.all(patch_times[1::2] == 0))
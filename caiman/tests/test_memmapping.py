@@ -1,10 +1,16 @@
+import os
 import pathlib
+import tempfile
 
 import numpy as np
 import nose
+import tifffile
 
 from caiman import mmapping
 from caiman.paths import caiman_datadir
+from caiman.source_extraction import cnmf
+from caiman.source_extraction.cnmf.params import CNMFParams
+from caiman.tests.test_toydata import gen_data
 
 
 TWO_D_FNAME = (
@@ -73,3 +79,85 @@ def test_load_successful_3d():
     assert (d1, d2, d3) == (10, 11, 13)
     assert T == 12
     assert isinstance(Yr, np.memmap)
+
+
+def test_save_memmap_streaming():
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, "mov.tif")
+    mov = np.random.RandomState(0).rand(53, 20, 24).astype(np.float32)
+    tifffile.imwrite(fname, mov)
+    for order in ("C", "F"):
+        fname_new = mmapping.save_memmap([fname], base_name=os.path.join(tmpdir, "s" + order), order=order,
+                                         remove_init=3, streaming=True, batch_size=10)
+        Yr, dims, T = mmapping.load_memmap(fname_new)
+        assert (dims, T) == ((20, 24), 50)
+        mov_new = np.reshape(Yr.T, (T,) + dims, order="F")
+        np.testing.assert_allclose(mov_new, mov[3:] + 0.0001, rtol=1e-5)
+
+    fname_ref = mmapping.save_memmap([fname], base_name=os.path.join(tmpdir, "ref"), order="C",
+                                     resize_fact=(0.5, 0.5, 1), border_to_0=2)
+    # the border is set to the minimum of the whole movie, not of each batch
+    fname_new = mmapping.save_memmap([fname], base_name=os.path.join(tmpdir, "new"), order="C",
+                                     resize_fact=(0.5, 0.5, 1), border_to_0=2, streaming=True, batch_size=20)
+    np.testing.assert_allclose(mmapping.load_memmap(fname_new)[0], mmapping.load_memmap(fname_ref)[0])
+
+
+def test_zarr_store():
+    try:
+        import zarr
+    except ImportError:
+        raise nose.SkipTest("zarr is not installed")
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, "Yr_d1_10_d2_11_d3_1_order_C_frames_12_.mmap")
+    Yr = np.memmap(fname, mode="w+", dtype=np.float32, shape=(110, 12), order="C")
+    Yr[:] = np.random.RandomState(0).rand(110, 12)
+    Yr.flush()
+    fname_zarr = mmapping.memmap_to_zarr(fname, tile=4, frames_per_chunk=5)
+    Yz, (d1, d2), T = mmapping.load_memmap(fname_zarr)
+    assert (d1, d2) == (10, 11)
+    assert T == 12
+    assert isinstance(Yz, mmapping.ChunkedMemmap)
+    np.testing.assert_array_equal(np.array(Yz), Yr)
+    np.testing.assert_array_equal(Yz[[3, 40, 41, 99]], Yr[[3, 40, 41, 99]])
+    np.testing.assert_array_equal(Yz[list(range(20, 70))], Yr[20:70])
+    np.testing.assert_array_equal(Yz[:, 4:9], Yr[:, 4:9])
+    b = np.random.RandomState(1).rand(12, 3)
+    np.testing.assert_allclose(mmapping.parallel_dot_product(Yz, b, block_size=30), Yr.dot(b), rtol=1e-5)
+    # writes to a subset of the pixels rewrite the tiles containing them
+    Yz = mmapping.ChunkedMemmap(fname_zarr, mode="r+")
+    Yz[[3, 40, 41, 99], 2:4] = -1
+    Yr[[3, 40, 41, 99], 2:4] = -1
+    Yz[57] = 2
+    Yr[57] = 2
+    np.testing.assert_array_equal(np.array(Yz), Yr)
+    Yz = mmapping.ChunkedMemmap(fname_zarr, mode="r")
+    with np.testing.assert_raises(ValueError):
+        Yz[:, 0] = 0
+
+
+def test_cnmf_fit_zarr():
+    try:
+        import zarr
+    except ImportError:
+        raise nose.SkipTest("zarr is not installed")
+    Yr, _, _, _, _, dims = gen_data(2)
+    T = Yr.shape[1]
+    fname = os.path.join(tempfile.mkdtemp(), "Yr_d1_20_d2_30_d3_1_order_C_frames_300_.mmap")
+    Y = np.memmap(fname, mode="w+", dtype=np.float32, shape=Yr.shape, order="C")
+    Y[:] = Yr
+    Y.flush()
+    del Y
+    fname_zarr = mmapping.memmap_to_zarr(fname, tile=8, frames_per_chunk=100)
+    Y, _, _ = mmapping.load_memmap(fname)
+    images = np.reshape(Y.T, (T,) + dims, order="F")
+    estimates = []
+    # the chunked store is passed as returned by load_memmap
+    for Y in (images, mmapping.load_memmap(fname_zarr)[0]):
+        opts = CNMFParams(dims=dims, k=3, gSig=[2, 2], rf=8, stride=3, p=1)
+        # the components are updated in random order
+        np.random.seed(0)
+        cnm = cnmf.CNMF(1, params=opts).fit(Y)
+        estimates.append(cnm.estimates)
+    assert estimates[1].A.shape == (np.prod(dims), estimates[0].A.shape[1]) and estimates[0].A.shape[1] > 0
+    np.testing.assert_allclose(estimates[1].A.toarray(), estimates[0].A.toarray(), rtol=1e-4, atol=1e-4)
+    np.testing.assert_allclose(estimates[1].C, estimates[0].C, rtol=1e-3, atol=1e-3)
@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 
+import cv2
 import numpy.testing as npt
+import os
+import pickle
 import numpy as np
+import tempfile
 from scipy.ndimage import gaussian_filter
 from skimage.data import lfw_subset
 import caiman as cm
 from caiman.motion_correction import *
+from caiman.motion_correction import _streaming_template_rigid
 
 
 def gen_frame_n_templ(true_shifts=np.array([2, 4])):
@@ -45,6 +50,18 @@ def test_register_n_apply_3d():
     _test_register_n_apply(3)
 
 
+def test_register_translation_pyramid():
+    img = gaussian_filter(np.random.RandomState(0).randn(200, 200), 3)
+    templ = img[40:168, 40:168]
+    for true_shifts in ([13, -21], [-3, 5], [30, 0]):
+        frame = img[40-true_shifts[0]:168-true_shifts[0], 40-true_shifts[1]:168-true_shifts[1]]
+        shifts = register_translation_pyramid(frame, templ, upsample_factor=10, max_shifts=(32, 32),
+                                              levels=2)[0]
+        npt.assert_allclose(shifts, true_shifts, atol=.1)
+        npt.assert_allclose(shifts, register_translation(frame, templ, upsample_factor=10,
+                                                         max_shifts=(32, 32))[0], atol=.1)
+
+
 def _test_tile_and_correct(D):
     true_shifts = np.array([2, 4, 1])[:D]
     frame, templ, _ = gen_frame_n_templ(true_shifts)
@@ -63,6 +80,133 @@ def test_tile_and_correct_3d():
     _test_tile_and_correct(3)
 
 
+def test_sliding_window_array():
+    img = np.random.RandomState(0).rand(50, 61)
+    patches, starts = sliding_window_array(img, (6, 8), (10, 12))
+    expected = list(sliding_window(img, (6, 8), (10, 12)))
+    npt.assert_array_equal(patches, [it[-1] for it in expected])
+    npt.assert_array_equal([(x, y) for x in starts[0] for y in starts[1]], [it[2:4] for it in expected])
+    stack = sliding_window_array(np.array([img, 2 * img]), (6, 8), (10, 12))[0]
+    npt.assert_array_equal(stack, [patches, 2 * patches])
+
+
+def test_apply_shifts_dft_batch():
+    imgs = gaussian_filter(np.random.RandomState(0).rand(5, 20, 24), (0, 2, 2))
+    shifts = [[1.5, -2.3], [-.4, 0], [3, 2.2], [0, 0], [-2.7, -1.1]]
+    diffphase = np.zeros(5)
+    for border_nan in (True, False, 'copy', 'min'):
+        expected = [apply_shifts_dft(img, sh, 0, is_freq=False, border_nan=border_nan)
+                    for img, sh in zip(imgs, shifts)]
+        npt.assert_allclose(apply_shifts_dft_batch(imgs, shifts, diffphase, border_nan=border_nan),
+                            expected, atol=1e-10)
+
+
+def _tile_and_correct_loop(img, template, strides, overlaps, max_shifts, upsample_factor_grid=4,
+                           upsample_factor_fft=10, max_deviation_rigid=2, add_to_movie=0, border_nan=True):
+    # tile_and_correct with shifts_opencv=False as it was before the patches were processed at once,
+    # registering, shifting and blending them one at a time
+    img = img.astype(np.float64) + add_to_movie
+    template = template.astype(np.float64) + add_to_movie
+    rigid_shts = register_translation(img, template, upsample_factor=upsample_factor_fft, max_shifts=max_shifts)[0]
+    lb_shifts = np.ceil(np.subtract(rigid_shts, max_deviation_rigid)).astype(int)
+    ub_shifts = np.floor(np.add(rigid_shts, max_deviation_rigid)).astype(int)
+    windows = list(sliding_window(img, overlaps=overlaps, strides=strides))
+    dim_grid = tuple(np.add(windows[-1][:2], 1))
+    res = [register_translation(it[-1], it_templ[-1], upsample_factor=upsample_factor_fft, shifts_lb=lb_shifts,
+                                shifts_ub=ub_shifts, max_shifts=max_shifts)
+           for it, it_templ in zip(windows, sliding_window(template, overlaps=overlaps, strides=strides))]
+    newstrides = tuple(np.round(np.divide(strides, upsample_factor_grid)).astype(int))
+    newshapes = np.add(newstrides, overlaps)
+    windows = list(sliding_window(img, overlaps=overlaps, strides=newstrides))
+    dim_new_grid = tuple(np.add(windows[-1][:2], 1))
+    shift_img_x, shift_img_y, diffs_phase = [
+        cv2.resize(np.reshape(grid, dim_grid), dim_new_grid[::-1], interpolation=cv2.INTER_CUBIC).ravel()
+        for grid in ([r[0][0] for r in res], [r[0][1] for r in res], [r[2] for r in res])]
+    total_shifts = [(-x, -y) for x, y in zip(shift_img_x, shift_img_y)]
+    normalizer = np.zeros_like(img) * np.nan
+    new_img = np.zeros_like(img) * np.nan
+    for (grid_1, grid_2, x, y, patch), sh, dffphs in zip(windows, total_shifts, diffs_phase):
+        im = apply_shifts_dft(patch, sh, dffphs, is_freq=False, border_nan=border_nan)
+        weight_mat = np.ones(newshapes)
+        if grid_1 > 0:
+            weight_mat[:overlaps[0], :] = np.linspace(0, 1, overlaps[0])[:, None]
+        if grid_1 < dim_new_grid[0] - 1:
+            weight_mat[-overlaps[0]:, :] = np.linspace(1, 0, overlaps[0])[:, None]
+        if grid_2 > 0:
+            weight_mat[:, :overlaps[1]] *= np.linspace(0, 1, overlaps[1])[None, :]
+        if grid_2 < dim_new_grid[1] - 1:
+            weight_mat[:, -overlaps[1]:] *= np.linspace(1, 0, overlaps[1])[None, :]
+        window = (slice(x, x + newshapes[0]), slice(y, y + newshapes[1]))
+        normalizer[window] = np.nansum(np.dstack([~np.isnan(im) * 1 * weight_mat, normalizer[window]]), -1)
+        new_img[window] = np.nansum(np.dstack([im * weight_mat, new_img[window]]), -1)
+    return new_img / normalizer - add_to_movie, total_shifts
+
+
+def test_tile_and_correct_patch_loop():
+    Y = gen_data(2)[0][:10]
+    templ = np.median(Y, 0)
+    for border_nan in (True, 'copy'):
+        for img in Y:
+            frame_ref, shifts_ref = _tile_and_correct_loop(img, templ, (16, 16), (8, 8), (4, 4), add_to_movie=1,
+                                                           border_nan=border_nan)
+            frame_cor, shifts = tile_and_correct(img, templ, (16, 16), (8, 8), (4, 4), max_deviation_rigid=2,
+                                                 shifts_opencv=False, add_to_movie=1, border_nan=border_nan)[:2]
+            npt.assert_allclose(shifts, shifts_ref, atol=1e-8)
+            npt.assert_allclose(frame_cor, frame_ref, atol=1e-6)
+
+
+def test_tile_and_correct_batch():
+    Y = gen_data(2)[0][:20]
+    templ = np.median(Y, 0)
+    for max_deviation_rigid in (0, 2):
+        for shifts_opencv in (True, False):
+            kwargs = dict(max_deviation_rigid=max_deviation_rigid, shifts_opencv=shifts_opencv,
+                          add_to_movie=1, border_nan='copy')
+            res = tile_and_correct_batch(Y, templ, (16, 16), (8, 8), (4, 4), **kwargs)
+            for img, (frame_cor, shifts, _, _) in zip(Y, res):
+                frame_ref, shifts_ref = tile_and_correct(img, templ, (16, 16), (8, 8), (4, 4), **kwargs)[:2]
+                npt.assert_allclose(shifts, shifts_ref, atol=1e-8)
+                npt.assert_allclose(frame_cor, frame_ref, atol=1e-6)
+
+
+def test_tile_and_correct_flow():
+    rng = np.random.RandomState(0)
+    templ = 100 * gaussian_filter(rng.rand(96, 112), 2).astype(np.float32)
+    # smooth nonrigid deformation on top of a rigid shift
+    y_grid, x_grid = np.mgrid[:96, :112].astype(np.float32)
+    flow_x = 1.5 + np.sin(y_grid / 30).astype(np.float32)
+    flow_y = -1 + np.cos(x_grid / 40).astype(np.float32)
+    frame = cv2.remap(templ, x_grid - flow_x, y_grid - flow_y, cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+    interior = (slice(8, -8), slice(8, -8))
+    for downsample in (1, 2):
+        frame_cor, shifts, _, xy_grid = tile_and_correct_flow(frame, templ, (24, 24), (12, 12), (6, 6),
+                                                              border_nan='copy', downsample=downsample)
+        npt.assert_equal(len(shifts), len(xy_grid))
+        err = np.abs(frame_cor - templ)[interior].mean()
+        npt.assert_(err < .25 * np.abs(frame - templ)[interior].mean())
+        # the shifts are those needed to correct the frame, as returned by tile_and_correct
+        npt.assert_allclose(np.mean(shifts, 0), [-np.mean(flow_y), -np.mean(flow_x)], atol=.3)
+
+
+def test_precomputed_template():
+    Y = gen_data(2)[0][:10]
+    templ = np.median(Y, 0)
+    kwargs = dict(max_deviation_rigid=2, shifts_opencv=False, add_to_movie=1, border_nan='copy')
+    res = tile_and_correct_batch(Y, templ, (16, 16), (8, 8), (4, 4), **kwargs)
+    precomputed = PrecomputedTemplate(templ, (16, 16), (8, 8), max_deviation_rigid=2, add_to_movie=1)
+    precomputed.share()
+    try:
+        # pickling a shared template only transfers the names of the blocks
+        shipped = pickle.loads(pickle.dumps(precomputed))
+        npt.assert_array_equal(shipped.patches_freq, precomputed.patches_freq)
+        res_pre = tile_and_correct_batch(Y, shipped, (16, 16), (8, 8), (4, 4), **kwargs)
+    finally:
+        precomputed.unlink()
+    for r, r_pre in zip(res, res_pre):
+        npt.assert_array_equal(r[0], r_pre[0])
+        npt.assert_array_equal(r[1], r_pre[1])
+
+
 def _test_iteration(fast):
     true_shifts = np.array([2, 4])
     frame, templ, nans = gen_frame_n_templ(true_shifts)
@@ -147,3 +291,56 @@ def test_motion_correct_rigid():
 
 def test_motion_correct_rigid_3d():
     _test_motion_correct_rigid(3)
+
+
+def test_motion_correct_rigid_streaming_template():
+    Y, C, S, A, centers, dims, shifts = gen_data(2)
+    fname = os.path.join(tempfile.mkdtemp(), 'testMovie.tif')
+    cm.movie(Y).save(fname)
+    params_dict = {'max_shifts': (4, 4), 'pw_rigid': False, 'border_nan': True,
+                   'niter_rig': 2, 'splits_rig': 6, 'streaming_template': True}
+    opts = cm.source_extraction.cnmf.params.CNMFParams(params_dict=params_dict)
+    mc = MotionCorrect(fname, dview=None, **opts.get_group('motion'))
+    mc.motion_correct(save_movie=True)
+    npt.assert_equal(len(mc.shifts_rig), len(Y))
+    npt.assert_(np.corrcoef(shifts.T, np.transpose(mc.shifts_rig))[:2, 2:].diagonal().mean() > .8)
+    # the refinement stops once the template settles, with chunks registered
+    # one at a time or in groups of the size of the pool
+    _, dview, n_processes = cm.cluster.setup_cluster(backend='multiprocessing', n_processes=2)
+    try:
+        for chunks_per_update, dv in ((1, None), (n_processes, dview)):
+            np.random.seed(0)
+            _, num_chunks = _streaming_template_rigid(
+                fname, 40, bin_median(Y[:50]), chunks_per_update=chunks_per_update, dview=dv,
+                max_shifts=(4, 4), add_to_movie=-np.min(Y), border_nan=True)
+            npt.assert_(num_chunks < 40)
+        mc_par = MotionCorrect(fname, dview=dview, **opts.get_group('motion'))
+        mc_par.motion_correct(save_movie=True)
+    finally:
+        cm.stop_server(dview=dview)
+    npt.assert_(np.abs(np.array(mc_par.shifts_rig) - mc.shifts_rig).mean() < .1)
+
+
+def test_motion_correct_to_c_memmap():
+    Y = gen_data(2)[0]
+    tmpdir = tempfile.mkdtemp()
+    fname = os.path.join(tmpdir, 'testMovie.tif')
+    cm.movie(Y).save(fname)
+    params_dict = {'max_shifts': (4, 4), 'pw_rigid': False, 'border_nan': 'copy'}
+    opts = cm.source_extraction.cnmf.params.CNMFParams(params_dict=params_dict)
+    mc = MotionCorrect(fname, dview=None, **opts.get_group('motion'))
+    mc.motion_correct(save_movie=True)
+    fname_ref = cm.save_memmap(mc.mmap_file, base_name=os.path.join(tmpdir, 'ref_'), order='C', border_to_0=2)
+    mc = MotionCorrect(fname, dview=None, **opts.get_group('motion'))
+    mc.motion_correct(save_movie=True, order='C', border_to_0=2, summary_images=True)
+    Yr_ref, dims_ref, T_ref = cm.load_memmap(fname_ref)
+    Yr, dims, T = cm.load_memmap(mc.mmap_file)
+    npt.assert_equal((dims, T), (dims_ref, T_ref))
+    npt.assert_allclose(Yr, Yr_ref, rtol=1e-5, atol=1e-5)
+    # the images are computed before the border is set
+    images = np.reshape(Yr.T, [T] + list(dims), order='F')[:, 2:-2, 2:-2]
+    npt.assert_allclose(mc.mean_img[2:-2, 2:-2], images.mean(0), rtol=1e-4, atol=1e-4)
+    npt.assert_allclose(mc.max_img[2:-2, 2:-2], images.max(0), rtol=1e-4, atol=1e-4)
+    # the mean is removed per chunk, which differ from those of correlation_image_ecobost
+    Cn = cm.summary_images.correlation_image_ecobost(images)
+    npt.assert_(np.corrcoef(mc.Cn[2:-2, 2:-2].ravel(), Cn.ravel())[0, 1] > .9)
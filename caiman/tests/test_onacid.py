@@ -1,11 +1,21 @@
 #!/usr/bin/env python
+import multiprocessing
+import numpy as np
 import numpy.testing as npt
 import os
+import pickle
+import tempfile
+import caiman
 from caiman.source_extraction import cnmf
+from caiman.source_extraction.cnmf.online_cnmf import (LatencyController, Prefetcher, RingBuffer, csc_append,
+                                                      grow_square, rank1nmf, rank1nmf_batch)
+from caiman.source_extraction.cnmf.online_stream import FrameRing, OnlineIngest
 from caiman.paths import caiman_datadir
+from caiman.utils.utils import gen_data
+from scipy.sparse import csc_matrix, random as sparse_random
 
 
-def demo():
+def demo_params():
 
     fname = [os.path.join(caiman_datadir(), 'example_movies', 'demoMovie.tif')]
     fr = 10                    # frame rate (Hz)
@@ -41,9 +51,14 @@ def demo():
         'thresh_CNN_noisy': thresh_CNN_noisy,
         'K': K
     }
-    opts = cnmf.params.CNMFParams(params_dict=params_dict)
+    return params_dict
+
+
+def demo():
+    opts = cnmf.params.CNMFParams(params_dict=demo_params())
     cnm = cnmf.online_cnmf.OnACID(params=opts)
     cnm.fit_online()
+    npt.assert_equal(len(cnm.t_read), len(cnm.t_online))
     cnm.save('test_online.hdf5')
     cnm2 = cnmf.online_cnmf.load_OnlineCNMF('test_online.hdf5')
     npt.assert_allclose(cnm.estimates.A.sum(), cnm2.estimates.A.sum())
@@ -53,3 +68,229 @@ def demo():
 def test_onacid():
     demo()
     pass
+
+
+def test_onacid_batch_frames():
+    # fitting blocks of frames gives the same results as fitting them one at a time
+    res = []
+    for batch_frames in (1, 16):
+        opts = cnmf.params.CNMFParams(params_dict=dict(demo_params(), update_num_comps=False,
+                                                       batch_frames=batch_frames))
+        cnm = cnmf.online_cnmf.OnACID(params=opts)
+        cnm.fit_online()
+        res.append(cnm)
+    npt.assert_allclose(res[0].estimates.C, res[1].estimates.C, rtol=1e-3, atol=1e-3)
+    npt.assert_allclose(res[0].estimates.A.toarray(), res[1].estimates.A.toarray(), rtol=1e-3, atol=1e-4)
+
+
+def test_onacid_save_state():
+    # a fit resumed from a saved state continues exactly as the uninterrupted fit
+    params = demo_params()
+    Y = np.asarray(caiman.base.movies.load(params['fnames'][0], subindices=slice(500)))
+    cnm = cnmf.online_cnmf.OnACID(params=cnmf.params.CNMFParams(params_dict=params))
+    cnm.initialize_online(Y=np.array(Y[:params['init_batch']]), T=500)
+    for t in range(params['init_batch'], 450):
+        cnm.process_frame(t, cnm._prepare_frame(Y[t]))
+    fname = os.path.join(tempfile.mkdtemp(), 'online_state.pkl')
+    cnm.save_state(fname, 450)
+    cnm2 = cnmf.online_cnmf.load_OnACID_state(fname)
+    npt.assert_equal(cnm2.t, 450)
+    for c in (cnm, cnm2):
+        for t in range(450, 500):
+            c.process_frame(t, c._prepare_frame(Y[t]))
+    npt.assert_equal(cnm.M, cnm2.M)
+    npt.assert_allclose(cnm.estimates.C_on[:cnm.M], cnm2.estimates.C_on[:cnm2.M])
+    npt.assert_allclose(cnm.estimates.Ab.toarray(), cnm2.estimates.Ab.toarray())
+
+
+def toy_movie(T):
+    # half of the neurons start firing after the initialization batch, see gen_data
+    Yr, _, _, _, _, _, _, dims = gen_data(dims=(48, 48), N=10, T=T, fluctuating_bkgrd=False)
+    Y = np.ascontiguousarray(np.reshape(Yr.T, (-1,) + dims, order='F'), dtype=np.float32)
+    params = {'fr': 30, 'decay_time': 1., 'gSig': [3, 3], 'p': 1, 'nb': 1, 'K': 2, 'init_batch': 300,
+              'init_method': 'bare', 'motion_correct': False, 'min_SNR': 2.5, 'rval_thr': .85,
+              'sniper_mode': False, 'expected_comps': 6, 'dims': dims}
+    return Y, params
+
+
+def test_onacid_save_state_add_components():
+    # components found after resuming from a saved state grow the restored arrays
+    Y, params = toy_movie(1000)
+    cnm = cnmf.online_cnmf.OnACID(params=cnmf.params.CNMFParams(params_dict=params))
+    cnm.initialize_online(Y=Y[:300], T=1000)
+    for t in range(300, 500):
+        cnm.process_frame(t, cnm._prepare_frame(Y[t]))
+    fname = os.path.join(tempfile.mkdtemp(), 'online_state.pkl')
+    cnm.save_state(fname, 500)
+    cnm2 = cnmf.online_cnmf.load_OnACID_state(fname)
+    N = cnm2.N
+    for c in (cnm, cnm2):
+        for t in range(500, 1000):
+            c.process_frame(t, c._prepare_frame(Y[t]))
+    npt.assert_(cnm2.N > N)
+    npt.assert_equal(cnm.M, cnm2.M)
+    npt.assert_allclose(cnm.estimates.C_on[:cnm.M], cnm2.estimates.C_on[:cnm2.M])
+    npt.assert_allclose(cnm.estimates.Ab.toarray(), cnm2.estimates.Ab.toarray())
+
+
+def test_prefetcher():
+    def frames():
+        yield from range(20)
+        raise RuntimeError('end of file')
+    it = Prefetcher(frames(), maxsize=3)
+    npt.assert_equal([next(it) for _ in range(20)], list(range(20)))
+    npt.assert_raises(RuntimeError, next, it)
+    it.close()
+    it = Prefetcher(iter(range(100)), maxsize=2)
+    npt.assert_equal(next(it), 0)
+    it.close()
+    npt.assert_equal(list(Prefetcher(iter(range(5)))), list(range(5)))
+
+
+def _put_frames(ring, num_frames):
+    for i in range(num_frames):
+        ring.put(np.full(ring.frame_shape, i, dtype=np.float32))
+    ring.close()
+
+
+def test_frame_ring():
+    # frames put by another process are read in order, the producer waits when the ring is full
+    ring = FrameRing((4, 5), n_slots=3)
+    proc = multiprocessing.Process(target=_put_frames, args=(ring, 20))
+    proc.start()
+    frames = []
+    while True:
+        item = ring.get(timeout=10)
+        if item is None:
+            break
+        frames.append(item[0])
+    proc.join()
+    npt.assert_equal([f[0, 0] for f in frames], np.arange(20))
+    npt.assert_equal(ring.dropped, 0)
+    ring.unlink()
+
+
+def test_frame_ring_drop():
+    for policy, kept in (('drop_newest', [0, 1, 2]), ('drop_oldest', [7, 8, 9])):
+        ring = FrameRing((2, 2), n_slots=3, policy=policy)
+        _put_frames(ring, 10)
+        frames = [ring.get()[0][0, 0] for _ in range(3)]
+        npt.assert_equal(frames, kept)
+        npt.assert_equal(ring.dropped, 7)
+        npt.assert_(ring.get() is None)
+        ring.unlink()
+
+
+def _put_movie(ring, Y):
+    for frame in Y:
+        ring.put(frame)
+    ring.close()
+
+
+def _ingest(onacid, Y, resume=False, state_file=None):
+    # fit the frames of Y, put into a ring by another process
+    ring = FrameRing(Y.shape[1:], n_slots=16)
+    proc = multiprocessing.Process(target=_put_movie, args=(ring, Y))
+    proc.start()
+    try:
+        return OnlineIngest(onacid, ring, max_frames=800, resume=resume).run(timeout=60, state_file=state_file)
+    finally:
+        proc.join()
+        ring.unlink()
+
+
+def test_online_ingest():
+    # streaming a movie gives the same fit as reading it from a file, also when resumed mid stream
+    Y, params = toy_movie(800)
+    tmpdir = tempfile.mkdtemp()
+    params['fnames'] = [os.path.join(tmpdir, 'stream.tif')]
+    caiman.movie(Y).save(params['fnames'][0])
+    np.random.seed(0)
+    cnm = cnmf.online_cnmf.OnACID(params=cnmf.params.CNMFParams(params_dict=params))
+    cnm.fit_online()
+    np.random.seed(0)
+    cnm_stream = _ingest(cnmf.online_cnmf.OnACID(params=cnmf.params.CNMFParams(params_dict=params)), Y)
+    state_file = os.path.join(tmpdir, 'online_state.pkl')
+    np.random.seed(0)
+    _ingest(cnmf.online_cnmf.OnACID(params=cnmf.params.CNMFParams(params_dict=params)), Y[:500],
+            state_file=state_file)
+    cnm_resumed = _ingest(cnmf.online_cnmf.load_OnACID_state(state_file), Y[500:], resume=True)
+    for c in (cnm_stream, cnm_resumed):
+        npt.assert_equal(c.estimates.C.shape, cnm.estimates.C.shape)
+        npt.assert_allclose(c.estimates.A.toarray(), cnm.estimates.A.toarray())
+        for key in ('b', 'C', 'f', 'S', 'YrA'):
+            npt.assert_allclose(getattr(c.estimates, key), getattr(cnm.estimates, key))
+
+
+def test_latency_controller():
+    ctrl = LatencyController(budget=.01, window=20, pct=99, max_defer=3)
+    for t in range(60):     # over budget: degrade up to the last level
+        ctrl.frame_options()
+        ctrl.record(t, .02, 0., 0., 0., 0.)
+    npt.assert_equal(ctrl.level, len(LatencyController.levels) - 1)
+    opts = [ctrl.frame_options() for _ in range(16)]
+    npt.assert_equal(sum(o['find_new'] for o in opts), 2)
+    npt.assert_equal(sum(o['shape_update'] for o in opts), 4)
+    npt.assert_(all(o['num_iters_hals'] == 1 for o in opts))
+    for t in range(60, 200):     # well under budget: back to full processing
+        ctrl.frame_options()
+        ctrl.record(t, .001, 0., 0., 0., 0.)
+    npt.assert_equal(ctrl.level, 0)
+    log = ctrl.timing_log()
+    npt.assert_equal(len(log), 200)
+    npt.assert_equal(log['t'], np.arange(200))
+
+
+def test_growable_storage():
+    rng = np.random.RandomState(0)
+    cols = [sparse_random(50, 1, density=.2, format='csc', dtype=np.float32, random_state=rng)
+            for _ in range(100)]
+    Ab = cols[0].copy()
+    for i, col in enumerate(cols[1:]):
+        csc_append(Ab, col)
+        if i == 50:
+            Ab_half = Ab.copy()
+    npt.assert_equal(Ab.shape, (50, 100))
+    npt.assert_allclose(Ab.toarray(), np.hstack([c.toarray() for c in cols]))
+    npt.assert_allclose(Ab_half.toarray(), np.hstack([c.toarray() for c in cols[:52]]))
+    A = rng.rand(100, 100)
+    AtA = A[:, :3].T.dot(A[:, :3])
+    for m in range(3, 100):
+        AtA = grow_square(AtA, 1)
+        AtA[:, m] = AtA[m] = A[:, :m + 1].T.dot(A[:, m])
+    npt.assert_allclose(AtA, A.T.dot(A))
+
+
+def test_ring_buffer():
+    rng = np.random.RandomState(0)
+    frames = rng.rand(30, 7).astype(np.float32)
+    buf = RingBuffer(frames[:10], 10)
+    for t in range(10, 30):
+        buf.append(frames[t])
+        npt.assert_array_equal(buf.get_ordered(), frames[t - 9:t + 1])
+        npt.assert_array_equal(buf.get_last_frames(3), frames[t - 2:t + 1])
+        npt.assert_allclose(buf.running_mean(), frames[t - 9:t + 1].mean(0), rtol=1e-5)
+    ind = np.array([1, 4])
+    buf[:, ind] -= 1
+    expected = frames[20:].copy()
+    expected[:, ind] -= 1
+    npt.assert_array_equal(buf.get_ordered(), expected)
+    npt.assert_allclose(buf.running_mean(), expected.mean(0), rtol=1e-5)
+    buf -= 1
+    buf.append(frames[0])
+    npt.assert_array_equal(buf.get_ordered(), np.vstack([expected[1:] - 1, frames[:1]]))
+    buf2 = pickle.loads(pickle.dumps(buf))
+    for b in (buf, buf2):
+        b.append(frames[1])
+    npt.assert_array_equal(buf2.get_ordered(), buf.get_ordered())
+    npt.assert_allclose(buf2.running_mean(), buf.running_mean(), rtol=1e-5)
+
+
+def test_rank1nmf_batch():
+    rng = np.random.RandomState(0)
+    Ypx = rng.rand(4, 121, 100).astype(np.float32)
+    ain = rng.rand(4, 121).astype(np.float32)
+    res = rank1nmf_batch(Ypx, ain)
+    for k in range(4):
+        for r, r1 in zip(res, rank1nmf(Ypx[k], ain[k])):
+            npt.assert_allclose(r[k], r1, rtol=1e-4, atol=1e-6)
@@ -0,0 +1,39 @@
+
+import numpy as np
+import numpy.testing as npt
+
+from caiman.source_extraction.cnmf.spatial import lasso_positive_batched, regression_ipyparallel
+
+
+def test_lasso_positive_batched():
+    # same weights as a scikit-learn LassoLars fit of each pixel
+    from sklearn.linear_model import LassoLars
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+    rng = np.random.RandomState(0)
+    C = np.maximum(rng.randn(4, 200), 0)
+    Y = rng.rand(30, 4).dot(C) + 5 + .1 * rng.randn(30, 200)
+    alphas = rng.rand(30) * .05
+    A = lasso_positive_batched(C, Y, alphas, tol=1e-12)
+    for y, alpha, a in zip(Y, alphas, A):
+        model = make_pipeline(StandardScaler(with_mean=False),
+                              LassoLars(alpha=alpha, positive=True, fit_intercept=True))
+        npt.assert_allclose(a, model.fit(C.T, y)['lassolars'].coef_, atol=1e-6)
+
+
+def test_regression_lasso_batched():
+    rng = np.random.RandomState(1)
+    C = np.maximum(rng.randn(5, 300), 0)
+    C = np.vstack([C, np.ones((1, 300))])   # background
+    cct = np.diag(C[:5].dot(C[:5].T))
+    idxs_Y = list(range(40))
+    idxs_C = [np.array([px % 3, 3 + px % 2, 5]) if px % 7 else np.array([5]) for px in idxs_Y]
+    Y = np.array([rng.rand(len(idx)).dot(C[idx]) + .1 * rng.randn(300) for idx in idxs_C], dtype=np.float32)
+    sn = np.full(40, .1)
+    res = {px: (idx, a) for px, idx, a in
+           regression_ipyparallel([Y, C, sn, idxs_C, idxs_Y, 'lasso_lars', cct])}
+    res_batched = regression_ipyparallel([Y, C, sn, idxs_C, idxs_Y, 'lasso_batched', cct])
+    npt.assert_equal(len(res_batched), len(res))
+    for px, idx, a in res_batched:
+        npt.assert_array_equal(idx, res[px][0])
+        npt.assert_allclose(a, res[px][1], atol=1e-5)
@@ -2,6 +2,8 @@
 
 import numpy.testing as npt
 import numpy as np
+import os
+import tempfile
 from scipy.ndimage.filters import gaussian_filter
 
 import caiman.source_extraction.cnmf.params
@@ -34,11 +36,7 @@ def gen_data(D=3, noise=.5, T=300, framerate=30, firerate=2.):
     return Yr, trueC, trueS, trueA, centers, dims
 
 
-def pipeline(D):
-    #%% GENERATE GROUND TRUTH DATA
-    Yr, trueC, trueS, trueA, centers, dims = gen_data(D)
-    N, T = trueC.shape
-    # INIT
+def toy_params(D, dims):
     params = caiman.source_extraction.cnmf.params.CNMFParams(dims=dims,
                                                              k=4,
                                                              gSig=[2, 2, 2][:D],
@@ -48,6 +46,15 @@ def pipeline(D):
                                                              block_size_temp=np.prod(dims))
     params.spatial['thr_method'] = 'nrg'
     params.spatial['extract_cc'] = False
+    return params
+
+
+def pipeline(D):
+    #%% GENERATE GROUND TRUTH DATA
+    Yr, trueC, trueS, trueA, centers, dims = gen_data(D)
+    N, T = trueC.shape
+    # INIT
+    params = toy_params(D, dims)
     cnm = cnmf.CNMF(2, params=params)
     # FIT
     images = np.reshape(Yr.T, (T,) + dims, order='F')
@@ -72,3 +79,46 @@ def test_2D():
 
 def test_3D():
     pipeline(3)
+
+
+class InterruptedCNMF(cnmf.CNMF):
+    # stops the fit when the refinement starts, after the merge stage
+    def update_spatial(self, Y, use_init=True, **kwargs):
+        if not use_init:
+            raise KeyboardInterrupt
+        return super().update_spatial(Y, use_init=use_init, **kwargs)
+
+
+class ResumedCNMF(cnmf.CNMF):
+    # the stages saved in the checkpoint must not run again
+    def initialize(self, Y, **kwargs):
+        raise AssertionError('initialize ran again')
+
+    def merge_comps(self, Y, **kwargs):
+        raise AssertionError('merge ran again')
+
+
+def test_fit_checkpoint():
+    # a fit interrupted between two stages resumes from the last completed one
+    Yr, trueC, trueS, trueA, centers, dims = gen_data(2)
+    images = np.reshape(Yr.T, (-1,) + dims, order='F').astype(np.float32)
+    checkpoint_dir = tempfile.mkdtemp()
+
+    def params(checkpoint_dir=None):
+        opts = toy_params(2, dims)
+        opts.set('patch', {'only_init': False})
+        # the movie is checked for NaNs again when the preprocess stage is skipped
+        opts.set('preprocess', {'check_nan': True})
+        opts.set('data', {'checkpoint_dir': checkpoint_dir})
+        return opts
+
+    np.random.seed(0)
+    cnm = cnmf.CNMF(1, params=params()).fit(images.copy())
+    np.random.seed(0)
+    npt.assert_raises(KeyboardInterrupt, InterruptedCNMF(1, params=params(checkpoint_dir)).fit, images.copy())
+    npt.assert_equal(len(os.listdir(checkpoint_dir)), 1)
+    np.random.seed(0)
+    cnm_resumed = ResumedCNMF(1, params=params(checkpoint_dir)).fit(images.copy())
+    npt.assert_allclose(cnm.estimates.A.toarray(), cnm_resumed.estimates.A.toarray())
+    for key in ('b', 'C', 'f', 'S', 'YrA', 'sn'):
+        npt.assert_allclose(getattr(cnm.estimates, key), getattr(cnm_resumed.estimates, key))
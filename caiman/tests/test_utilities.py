@@ -5,6 +5,8 @@ import numpy as np
 from scipy import ndimage as ndi
 from skimage.feature import peak_local_max
 from caiman.source_extraction.cnmf import utilities
+from caiman.source_extraction.cnmf.online_cnmf import update_AtA
+from scipy.sparse import random as sparse_random
 
 
 def _test_gaussian_filter(D):
@@ -115,3 +117,54 @@ def test_peak_local_max():
         for m in (1, 2, 3, 4):
             npt.assert_array_equal(peak_local_max(img, min_distance=m),
                                    utilities.peak_local_max(img, min_distance=m))
+
+
+def _check_groups(groups, AtA):
+    members = sorted(m for group in groups for m in group)
+    npt.assert_equal(members, np.arange(len(AtA)))
+    for group in groups:
+        overlap = AtA[np.ix_(group, group)] > 0
+        np.fill_diagonal(overlap, False)
+        npt.assert_(not overlap.any())
+
+
+def test_update_order_incremental():
+    rng = np.random.RandomState(0)
+    Ab = sparse_random(400, 60, density=.02, format='csc', dtype=np.float32, random_state=rng)
+    AtA = Ab.T.dot(Ab).toarray()
+    groups = list(map(list, utilities.update_order(Ab)[0]))
+    _check_groups(groups, AtA)
+    for _ in range(5):
+        # change the values of some footprints, keeping their support (as in update_shapes)
+        changed = rng.choice(Ab.shape[1], 10, replace=False)
+        for m in changed:
+            Ab.data[Ab.indptr[m]:Ab.indptr[m + 1]] = rng.rand(Ab.indptr[m + 1] - Ab.indptr[m]) * \
+                (rng.rand(Ab.indptr[m + 1] - Ab.indptr[m]) > .3)
+        AtA = update_AtA(AtA, Ab, changed)
+        npt.assert_allclose(AtA, Ab.T.dot(Ab).toarray(), rtol=1e-5)
+        groups = utilities.update_order_incremental(groups, AtA, changed=changed)[0]
+        _check_groups(groups, AtA)
+        # remove some components
+        removed = rng.choice(Ab.shape[1], 3, replace=False)
+        keep = np.setdiff1d(np.arange(Ab.shape[1]), removed)
+        Ab = Ab[:, keep].tocsc()
+        AtA = AtA[np.ix_(keep, keep)]
+        groups = utilities.update_order_incremental(groups, AtA, removed=removed)[0]
+        _check_groups(groups, AtA)
+
+
+def test_update_order_incremental_bounded():
+    # every step, one component overlaps with a member of each group, including its own, so
+    # moving it opens a new group, while two groups suffice; the groups are then recomputed
+    K = 40
+    groups, num_groups_greedy = [list(range(K))], 1
+    for m in range(20):
+        AtA = np.eye(K)
+        for group in groups:
+            others = [j for j in group if j != m]
+            if others:
+                AtA[m, others[0]] = AtA[others[0], m] = 1
+        groups, num_groups_greedy = utilities.update_order_incremental(
+            groups, AtA, changed=[m], num_groups_greedy=num_groups_greedy)
+        _check_groups(groups, AtA)
+        npt.assert_(len(groups) <= 3)
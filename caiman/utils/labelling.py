@@ -8,6 +8,7 @@ Created on Thu Oct 20 15:18:21 2016
 """
 
 import caiman as cm
+from caiman.cluster import get_executor
 #%%
 
 def pre_preprocess_movie_labeling(dview, file_names, median_filter_size=(2, 1, 1),
@@ -69,10 +70,6 @@ def pre_preprocess_movie_labeling(dview, file_names, median_filter_size=(2, 1, 1
         args.append(
             [name, resize_factors, diameter_bilateral_blur, median_filter_size])
 
-    if dview is not None:
-        file_res = dview.map_sync(pre_process_handle, args)
-        dview.results.clear()
-    else:
-        file_res = list(map(pre_process_handle, args))
+    file_res = get_executor(dview).map(pre_process_handle, args)
 
     return file_res
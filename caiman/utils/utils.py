@@ -35,6 +35,7 @@ except:
     pass
 
 
+from ..cluster import get_executor
 from ..external.cell_magic_wand import cell_magic_wand
 from ..source_extraction.cnmf.spatial import threshold_components
 from caiman.paths import caiman_datadir
@@ -406,10 +407,7 @@ def apply_magic_wand(A, gSig, dims, A_thr=None, coms=None, dview=None,
 
     logging.debug(len(params))
 
-    if dview is not None:
-        masks = np.array(list(dview.map(cell_magic_wand_wrapper, params)))
-    else:
-        masks = np.array(list(map(cell_magic_wand_wrapper, params)))
+    masks = np.array(get_executor(dview).map(cell_magic_wand_wrapper, params))
 
     return masks
 
@@ -570,6 +568,8 @@ def recursively_load_dict_contents_from_group(h5file:h5py.File, path:str) -> Dic
             elif key in ['dims', 'medw', 'sigma_smooth_snmf', 'dxy', 'max_shifts', 'strides', 'overlaps']:
                 if isinstance(item[()], np.ndarray):
                     ans[key] = tuple(item[()])
+                elif item[()] == b'NoneType':
+                    ans[key] = None
                 else:
                     ans[key] = item[()]
             else:
@@ -93,6 +93,8 @@ setup(
     entry_points = { 'console_scripts': ['caimanmanager = caiman.caimanmanager:main' ] },
     data_files=data_files,
     install_requires=[''],
+    # chunked, compressed movie stores (save_memmap(..., store='zarr'))
+    extras_require={'zarr': ['zarr', 'numcodecs']},
     ext_modules=cythonize(ext_modules, language_level="3"),
     cmdclass={'build_ext': build_ext}
 )